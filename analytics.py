@@ -0,0 +1,147 @@
+"""
+Vectorized quiz analytics: answers are encoded into a users x questions matrix of category codes.
+
+Keep this module free of db_handler and telebot imports: its functions run in worker processes.
+"""
+
+
+import io
+import json
+import typing
+
+import numpy
+import pandas
+
+
+class AnalyticalLevel(typing.NamedTuple):
+    """Most popular answer to one question among users who gave all previous most popular answers"""
+    answer: str or None
+    percent: float
+    respondents: int  # number of users on this level
+    distribution: dict  # {answer_text: count} on this level
+
+
+def encode_answers(users_id, quests_id, answers, questions_count: int) -> tuple:
+    """Encodes answers into a users x questions matrix
+
+    Users are numbered in order of their first answer, missing answers get the category None.
+
+    :param users_id: internal user id of each answer
+    :param quests_id: quest id of each answer
+    :param answers: answer text of each answer
+    :param questions_count: number of questions in quiz (answers to other questions are ignored)
+    :return: (matrix with category codes, list of categories)
+    """
+    user_codes, _ = pandas.factorize(numpy.asarray(users_id))
+    answer_codes, categories = pandas.factorize(numpy.asarray(answers, dtype=object))
+    categories = list(categories) + [None]
+    answer_codes[answer_codes == -1] = len(categories) - 1  # NULL answers
+    quests_id = numpy.asarray(quests_id, dtype=numpy.int64)
+
+    matrix = numpy.full((user_codes.max(initial=-1) + 1, questions_count), len(categories) - 1)
+    valid = (quests_id >= 1) & (quests_id <= questions_count)
+    matrix[user_codes[valid], quests_id[valid] - 1] = answer_codes[valid]
+    return matrix, categories
+
+
+def conditional_mode_chain(matrix: numpy.ndarray, categories: list) -> list[AnalyticalLevel]:
+    """Finds the most popular answer to each question among users who gave all previous most
+    popular answers (ties go to the answer met first)
+
+    :param matrix: users x questions matrix from encode_answers
+    :param categories: categories from encode_answers
+    :return: list with analytics.AnalyticalLevel for each question
+    """
+    levels = []
+    mask = numpy.ones(matrix.shape[0], dtype=bool)
+    for column_index in range(matrix.shape[1]):
+        column = matrix[:, column_index]
+        values = column[mask]
+        if values.size == 0:
+            break
+        counts = numpy.bincount(values, minlength=len(categories))
+        candidates = numpy.flatnonzero(counts == counts.max())
+        if candidates.size > 1:
+            first_seen = [numpy.argmax(values == candidate) for candidate in candidates]
+            mode = int(candidates[numpy.argmin(first_seen)])
+        else:
+            mode = int(candidates[0])
+        levels.append(AnalyticalLevel(
+            categories[mode],
+            round(int(counts[mode]) / int(values.size) * 100, 2),
+            int(values.size),
+            {categories[code]: int(counts[code]) for code in numpy.flatnonzero(counts)}
+        ))
+        mask &= column == mode
+    return levels
+
+
+def get_analytical_levels(answer_rows: dict, questions_count: int) -> list[AnalyticalLevel]:
+    """Returns analytics.AnalyticalLevel for each question
+
+    :param answer_rows: columns like {'internal_user_id': [...], 'quest_id': [...],
+        'answer': [...]} (see db_handler.get_quiz_answer_rows)
+    :param questions_count: number of questions in quiz
+    """
+    if not answer_rows['quest_id'] or not questions_count:
+        return []
+    matrix, categories = encode_answers(
+        answer_rows['internal_user_id'],
+        answer_rows['quest_id'],
+        answer_rows['answer'],
+        questions_count
+    )
+    return conditional_mode_chain(matrix, categories)
+
+
+def format_analytical_message(levels: list[AnalyticalLevel], questions_text: list) -> str:
+    """Prepare analytical message"""
+    info_analytical_list = []
+    for level, quest_text in zip(levels, questions_text):
+        info_analytical_list.append(
+            f'{quest_text}\nСамый популярный ответ ({level.percent}%): {level.answer}'
+        )
+    return '\n'.join(info_analytical_list)
+
+
+def group_answer_counts(answer_counts: dict) -> dict:
+    """Groups answer counts like {question_1_text: {answer_1_text: count, ...}, ...}
+
+    :param answer_counts: columns from db_handler.get_quiz_answer_counts
+    """
+    info_dict = dict()
+    for quest_text, answer, count in zip(
+            answer_counts['quest_text'],
+            answer_counts['answer'],
+            answer_counts['count']
+    ):
+        info_dict.setdefault(quest_text, dict())[answer] = count
+    return info_dict
+
+
+def build_report_documents(quiz_id, answer_rows: dict, answer_counts: dict, questions_text: list):
+    """Builds /quiz {id} report documents in memory
+
+    :param quiz_id: quiz id (for file names)
+    :param answer_rows: columns from db_handler.get_quiz_answer_rows
+    :param answer_counts: columns from db_handler.get_quiz_answer_counts
+    :param questions_text: list with texts of quiz questions
+    :return: list of tuples (file name, bytes)
+    """
+    levels = get_analytical_levels(answer_rows, len(questions_text))
+    analytical_message = format_analytical_message(levels, questions_text) or 'Ответов пока нет'
+    quiz_json = json.dumps(group_answer_counts(answer_counts), ensure_ascii=False)
+    # xlsx-table (answers in rows, questions in columns)
+    if answer_counts['count']:
+        table = pandas.DataFrame(answer_counts).pivot_table(
+            index='answer', columns='quest_text', values='count', aggfunc='sum', sort=False
+        )
+    else:
+        table = pandas.DataFrame()
+    table_buffer = io.BytesIO()
+    table.to_excel(table_buffer)
+    return [
+        (f'quiz_{quiz_id}_analytic.txt', analytical_message.encode('utf-8')),
+        (f'quiz_{quiz_id}_answers.json', quiz_json.encode('utf-8')),
+        (f'quiz_{quiz_id}_table.xlsx', table_buffer.getvalue())
+    ]
@@ -0,0 +1,477 @@
+"""
+Asyncio runtime: python async_bot.py instead of python bot_body.py.
+
+User handlers (quiz flow, menus, callbacks) are ported to AsyncTeleBot and async_db, so one
+process keeps many quiz sessions moving while waiting for Telegram and PostgreSQL. Admin
+commands and documents are rare - they run the handlers of bot_body in threads. Settings,
+markups, mailings, reports and timers are shared with bot_body.
+"""
+
+
+import asyncio
+import contextlib
+import datetime
+import threading
+
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import InlineKeyboardButton
+from telebot.types import InlineKeyboardMarkup
+
+import async_db
+import bot_body
+import bot_init
+import cluster
+import db_handler
+import log_writer
+import migrations
+import webhook
+from bot_body import flood_limiter
+from bot_body import get_available_quiz_menu
+from bot_body import get_help_inline_markup
+from bot_body import get_message_kind
+from bot_body import get_question_menu
+from bot_body import get_welcome_markup
+from bot_init import init_logger
+
+
+# bot init
+async_bot = AsyncTeleBot(bot_init.get_bot_api_token())
+event_loop = None
+user_locks = dict()  # {tg_id: [asyncio.Lock, number of waiting handlers]}
+
+
+@contextlib.asynccontextmanager
+async def user_lock(tg_id):
+    """Handlers of one user run one after another (in order of arrival)"""
+    lock_info = user_locks.setdefault(tg_id, [asyncio.Lock(), 0])
+    lock_info[1] += 1
+    try:
+        async with lock_info[0]:
+            yield
+    finally:
+        lock_info[1] -= 1
+        if not lock_info[1]:
+            del user_locks[tg_id]
+
+
+# region wrappers
+def ordered(func):
+    """Decorator that runs handlers of one user one after another (use it as the outer one)"""
+
+    async def wrapper(*args):
+        async with user_lock(args[0].from_user.id):
+            await func(*args)
+
+    return wrapper
+
+
+def message_wrapper(func):
+    """Async version of bot_body.message_wrapper"""
+
+    async def wrapper(*args):
+        message: telebot.types.Message = args[0]
+        quiz_session = await async_db.get_quiz_session(message.from_user.id)
+        is_allowed = flood_limiter.hit(message.from_user.id, get_message_kind(message))
+        log_writer.message_log_writer.put(
+            message.from_user.id,
+            message.id,
+            message.text,
+            float(message.date)
+        )
+        if quiz_session is None:
+            if is_allowed:  # change it in bot settings
+                await func(message)
+            else:
+                await simple_send_message(message.chat.id,
+                                          'Вы отправляете сообщения слишком часто!', None)
+        else:
+            if not quiz_session.is_rewrite:
+                next_question = await async_db.submit_answer(
+                    message.from_user.id,
+                    quiz_session.quiz_id,
+                    quiz_session.quest_id,
+                    message.text
+                )
+                if next_question is False:
+                    await simple_send_message(message.chat.id, 'Не получилось сохранить ответ :('
+                                                               '\n\nПожалуйста, отправьте его'
+                                                               ' ещё раз')
+                elif next_question is None:
+                    await end_quiz(message.from_user.id, message.chat.id, quiz_session.quiz_id,
+                                   False)
+                else:
+                    await send_question(message.from_user.id, message.chat.id, next_question)
+            else:
+                answer_status = await async_db.rewrite_answer(
+                    message.from_user.id,
+                    quiz_session.quiz_id,
+                    quiz_session.quest_id,
+                    message.text
+                )
+                if answer_status is False:
+                    await simple_send_message(message.chat.id, 'Что-то пошло не так :(\n\n'
+                                                           'Попробуйте ещё раз или свяжитесь с'
+                                                           ' администратором')
+                else:
+                    await simple_send_message(
+                        message.chat.id,
+                        'Ответ успешно перезаписан!',
+                        get_welcome_markup()
+                    )
+
+    return wrapper
+
+
+def callback_wrapper(func):
+    """Async version of bot_body.callback_wrapper"""
+
+    async def wrapper(*args):
+        call: telebot.types.CallbackQuery = args[0]
+        await async_bot.edit_message_reply_markup(call.message.chat.id, call.message.id,
+                                                  reply_markup=None)
+        is_allowed = flood_limiter.hit(call.from_user.id, 'callback')
+        log_writer.message_log_writer.put(
+            call.from_user.id,
+            call.message.id,
+            f'In-Line: {call.data}',
+            datetime.datetime.now().timestamp()
+        )
+        if is_allowed:  # change in bot settings
+            await func(call)
+        else:
+            await simple_send_message(
+                call.message.chat.id,
+                'Вы отправляете сообщения слишком часто!',
+                None
+            )
+
+    return wrapper
+
+
+def rule_wrapper(rules):
+    """Async version of bot_body.rule_wrapper"""
+
+    def decorator(func):
+
+        async def wrapper(*args):
+            message: telebot.types.Message = args[0]
+            user = await async_db.get_user_info(message.from_user.id)
+            if user.is_ban:
+                await simple_send_message(message.chat.id, 'Вы забанены!\n\n'
+                                                           'Если Вы считаете, что полученная'
+                                                           ' блокировка несправедлива, свяжитесь с'
+                                                           ' администартором: введите команду'
+                                                           ' /help и нажмите на пункт "Мне нужна'
+                                                           ' помощь!"')
+            elif user.group in rules:
+                await func(message)
+
+        return wrapper
+
+    return decorator
+
+
+def thread_handler(sync_handler):
+    """Runs a handler of bot_body in a thread"""
+
+    async def wrapper(message: telebot.types.Message):
+        await asyncio.to_thread(sync_handler, message)
+
+    return wrapper
+# endregion
+
+
+# region general functions
+async def end_quiz(tg_id, chat_id, quiz_id, reset_status=True):
+    """Async version of bot_body.end_quiz"""
+    quiz_definition = await async_db.get_quiz_definition(quiz_id)
+    if quiz_definition is None:
+        gratitude_message = db_handler.default_end_message
+    else:
+        gratitude_message = quiz_definition.gratitude
+    await simple_send_message(chat_id, gratitude_message, get_welcome_markup())
+    if reset_status:
+        await async_db.finish_quiz_session(tg_id)
+
+
+async def simple_send_message(chat_id, message_text, markup=None):
+    """Simple send-message function"""
+    await async_bot.send_message(chat_id, message_text, reply_markup=markup)
+    init_logger.info('Message "%s" to user with id: %s' % (message_text, chat_id))
+
+
+async def send_question(tg_id: int, chat_id: int, current_question=None):
+    """Async version of bot_body.send_question"""
+    is_rewrite = False
+    if current_question is None:
+        quiz_session = await async_db.get_quiz_session(tg_id)
+        current_quiz_id = quiz_session.quiz_id
+        current_question_id = quiz_session.quest_id
+        is_rewrite = quiz_session.is_rewrite
+    else:
+        current_quiz_id = current_question.quiz_id
+        current_question_id = current_question.quest_id
+    quiz_definition = await async_db.get_quiz_definition(current_quiz_id)
+    if quiz_definition is None:  # the quiz is deleted
+        await end_quiz(tg_id, chat_id, current_quiz_id)
+        return
+    # the answer to a dependent question is rewritten without any checks
+    if not is_rewrite and quiz_definition.plan.get_conditions(current_question_id):
+        next_question_id, skipped_questions_id = quiz_definition.plan.resolve(
+            current_question_id,
+            await async_db.get_user_quiz_answers(tg_id, current_quiz_id)
+        )
+        if skipped_questions_id:
+            await async_db.skip_questions(
+                tg_id,
+                current_quiz_id,
+                skipped_questions_id,
+                next_question_id
+            )
+        if next_question_id is None:
+            await end_quiz(tg_id, chat_id, current_quiz_id, False)
+            return
+        current_question_id = next_question_id
+    current_question = quiz_definition.get_question(current_question_id)
+    if current_question is None:
+        await end_quiz(tg_id, chat_id, current_quiz_id)
+        return
+    await simple_send_message(
+        chat_id,
+        current_question.quest_text,
+        get_question_menu(quiz_definition, current_question)
+    )
+# endregion
+
+
+# region message handlers
+# region commands
+@async_bot.message_handler(commands=['start'])
+@ordered
+async def welcome_handler(message: telebot.types.Message):
+    """Async version of bot_body.welcome_handler"""
+    await async_db.add_user(message.from_user.id, float(message.date))
+    log_writer.message_log_writer.put(
+        message.from_user.id,
+        message.id,
+        message.text,
+        float(message.date)
+    )
+    await simple_send_message(message.chat.id, bot_body.get_welcome_text(), get_welcome_markup())
+
+
+@async_bot.message_handler(commands=['stop', 'resume'])
+@ordered
+@rule_wrapper(('user', 'editor', 'admin', 'm_admin'))
+async def quiz_session_handler(message: telebot.types.Message):
+    """Async version of bot_body.quiz_session_handler"""
+    is_allowed = flood_limiter.hit(message.from_user.id, get_message_kind(message))
+    log_writer.message_log_writer.put(
+        message.from_user.id,
+        message.id,
+        message.text,
+        float(message.date)
+    )
+    if not is_allowed:
+        await simple_send_message(message.chat.id, 'Вы отправляете сообщения слишком часто!', None)
+    elif await async_db.get_quiz_session(message.from_user.id) is None:
+        await simple_send_message(message.chat.id, 'Вы сейчас не проходите опрос',
+                                  get_welcome_markup())
+    elif get_message_kind(message) == 'stop':
+        await async_db.finish_quiz_session(message.from_user.id, 'abandoned')
+        await simple_send_message(message.chat.id, 'Опрос прерван', get_welcome_markup())
+    else:
+        await send_question(message.from_user.id, message.chat.id)
+
+
+@async_bot.message_handler(commands=['help', 'h'])
+@ordered
+@message_wrapper
+async def help_handler(message: telebot.types.Message):
+    """/help handler"""
+    await simple_send_message(message.chat.id, 'Что случилось?', get_help_inline_markup())
+
+
+# admin and editor commands
+for commands, sync_handler in (
+        (['role'], bot_body.set_role_handler),
+        (['ban'], bot_body.ban_handler),
+        (['unban'], bot_body.unban_handler),
+        (['message'], bot_body.message_handler),
+        (['quiz', 'editor'], bot_body.editor_handler)
+):
+    async_bot.message_handler(commands=commands)(ordered(thread_handler(sync_handler)))
+# endregion
+
+
+# region types
+@async_bot.message_handler(content_types='text')
+@ordered
+@rule_wrapper(('user', 'editor', 'admin', 'm_admin'))
+@message_wrapper
+async def main_message_handler(message: telebot.types.Message):
+    """Async version of bot_body.main_message_handler"""
+    if message.text in ('Пройти опрос', 'пройти опрос', 'Ghjqnb jghjc', 'ghjqnb jghjc'):
+        generation = db_handler.catalog.generation
+        available_quiz_list, quiz_progress = await asyncio.gather(
+            async_db.get_visible_quizzes(),
+            async_db.get_quiz_progress(message.from_user.id)
+        )
+        quizzes_menu = get_available_quiz_menu(
+            available_quiz_list,
+            quiz_progress,
+            generation,
+            db_handler.catalog.page_size
+        )
+        if quizzes_menu is not None:
+            await simple_send_message(message.chat.id, 'Вам доступны следующие опросы:',
+                                      quizzes_menu)
+        else:
+            await simple_send_message(message.chat.id, 'Кажется, для Вас сейчас опросов нет!',
+                                      get_welcome_markup())
+    elif message.text == 'Изменить ответы в последнем опросе':
+        completed_quizzes_id = await async_db.get_completed_quizzes_id(message.from_user.id)
+        if completed_quizzes_id:
+            quiz_definition = await async_db.get_quiz_definition(max(completed_quizzes_id))
+            if quiz_definition is None:
+                await simple_send_message(message.chat.id, 'Этот опрос больше недоступен!')
+                return
+            await simple_send_message(
+                message.chat.id,
+                'Выберите вопрос, ответ на который вы хотели бы изменить\n\nИзменять ответы на'
+                ' вопросы, зависящие от других вопросов, нужно в ручном режиме',
+                bot_body.get_rewrite_menu(quiz_definition)
+            )
+        else:
+            await simple_send_message(message.chat.id, 'У Вас ещё нет пройденных опросов!')
+    elif message.text == 'Настройки рассылки':
+        current_mailing_status = await async_db.get_current_mailing_status(message.from_user.id)
+        mailing_menu = InlineKeyboardMarkup()
+        mailing_menu.add(InlineKeyboardButton(
+            'Изменить статус', callback_data=f'mailing {not current_mailing_status}')
+        )
+        await simple_send_message(
+            message.chat.id,
+            f'Рассылка позволит вам получать уведомления о новых опросах и сообщения от'
+            f' администраторов.\n\nТекущий статус:'
+            f' {"разрешена" if current_mailing_status else "запрещена"}',
+            mailing_menu
+        )
+    elif message.text == 'Мой статус':
+        user = await async_db.get_user_info(message.from_user.id)
+        await simple_send_message(message.chat.id, bot_body.get_user_info_text(user))
+
+
+@async_bot.callback_query_handler(func=lambda call: True)
+@ordered
+@callback_wrapper
+async def callback_inline(call: telebot.types.CallbackQuery):
+    """Async version of bot_body.callback_inline"""
+    if call.data in ('list', 'visible_list'):
+        ans, page_menu = await asyncio.to_thread(
+            bot_body.quiz_list_prepare,
+            call.data == 'visible_list'
+        )
+        await simple_send_message(call.message.chat.id, ans, page_menu)
+    elif call.data.split()[0] == 'quiz_page':
+        _, catalog_name, direction, quiz_id = call.data.split()
+        ans, page_menu = await asyncio.to_thread(
+            bot_body.quiz_list_prepare,
+            catalog_name == 'visible',
+            int(quiz_id) if direction == 'before' else None,
+            int(quiz_id) if direction == 'after' else None
+        )
+        await simple_send_message(call.message.chat.id, ans, page_menu)
+    elif call.data == 'get_a_project':
+        await simple_send_message(call.message.chat.id, 'Вы можете связаться с моим создателем'
+                                                        ' через его e-mail:'
+                                                        ' vladchesyan@gmail.com\n\n'
+                                                        'Некоммерческое использование бесплатно!')
+    elif call.data in ('help', 'bug_find'):
+        subs_id = call.from_user.id
+        subs_name = call.from_user.username
+        admins_ids = await async_db.get_users_id('m_admin') + await async_db.get_users_id('admin')
+        if call.data == 'bug_find':
+            msg_txt = f'Пользователь @{subs_name} с ID {subs_id} нашёл баг!'
+        else:
+            msg_txt = f'Пользователь @{subs_name} с ID {subs_id} просит о помощи!'
+        for admin_id in admins_ids:
+            await simple_send_message(admin_id, msg_txt, get_welcome_markup())
+        await simple_send_message(call.message.chat.id,
+                                  'Передал администраторам. С Вами скоро свяжутся!')
+    elif call.data.split()[0] == 'start_quiz':
+        quiz_id = int(call.data.split()[1])
+        await async_db.start_quiz_session(
+            call.from_user.id,
+            quiz_id,
+            await async_db.get_resume_quest_id(call.from_user.id, quiz_id)
+        )
+        await send_question(call.from_user.id, call.message.chat.id)
+    elif call.data.split()[0] == 'quiz_rewrite':
+        await async_db.start_quiz_session(
+            call.from_user.id,
+            int(call.data.split()[1]),
+            int(call.data.split()[2]),
+            'rewrite'
+        )
+        await send_question(call.from_user.id, call.message.chat.id)
+    elif call.data.split()[0] == 'mailing':
+        await async_db.update_mailing_status(call.from_user.id, call.data.split()[1] == 'True')
+        await simple_send_message(
+            call.message.chat.id,
+            'Статус рассылки успешно изменён!',
+            get_welcome_markup()
+        )
+
+
+async_bot.message_handler(content_types=['document'])(
+    ordered(thread_handler(bot_body.document_handler))
+)
+# endregion
+# endregion
+
+
+def process_update_json(update_json: dict):
+    """Hands update from webhook (its worker thread) to the event loop"""
+    asyncio.run_coroutine_threadsafe(
+        async_bot.process_new_updates([telebot.types.Update.de_json(update_json)]),
+        event_loop
+    ).result()
+
+
+async def main():
+    """Main coroutine"""
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    if bot_body.run_mode == 'webhook':
+        bot_body.check_webhook_settings()
+        bot_body.webhook_server = webhook.WebhookServer(
+            process_update_json,
+            bot_body.webhook_secret,
+            bot_body.webhook_host,
+            bot_body.webhook_port,
+            bot_body.get_webhook_path(),
+            workers=8
+        )
+        bot_body.webhook_server.start()
+        await async_bot.remove_webhook()
+        await async_bot.set_webhook(url=bot_body.webhook_url, secret_token=bot_body.webhook_secret)
+        init_logger.info('Webhook is set to %s' % bot_body.webhook_url)
+        await asyncio.Event().wait()  # updates come from the webhook server
+    await async_bot.remove_webhook()  # polling doesn't work while webhook is set
+    if db_handler.is_looped:
+        await async_bot.infinity_polling(timeout=1)
+    else:
+        await async_bot.polling(non_stop=True, timeout=1)
+
+
+if __name__ == '__main__':
+    migrations.upgrade()
+    receiver_lock = cluster.take_receiver_lock(db_handler.engine)
+    db_handler.warm_quiz_cache()
+    log_writer.message_log_writer.start()
+    bot_body.start_singleton_jobs()
+    bot_body.timer_scheduler.start()
+    threading.current_thread().name = 'event_loop'
+    asyncio.run(main())
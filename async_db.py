@@ -0,0 +1,335 @@
+"""
+Async versions of the db_handler requests used by the asyncio runtime (see async_bot.py).
+
+Models, statements and the quiz cache are shared with db_handler, the connections go through
+SQLAlchemy async engine with asyncpg.
+"""
+
+
+import asyncio
+import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import delete
+from sqlalchemy.sql import insert
+from sqlalchemy.sql import select
+from sqlalchemy.sql import update
+
+import db_handler
+import quiz_cache
+import quiz_sessions
+from bot_init import init_logger
+from db_handler import QuestionsAnswers
+from db_handler import QuizSession
+from db_handler import User
+from db_handler import active_sessions
+from db_handler import add_event_in_log
+from db_handler import get_internal_user_id_subquery
+
+async_engine = create_async_engine(
+    f"postgresql+asyncpg://{db_handler.db_username}:{db_handler.db_password}@"
+    f"{db_handler.db_host}:{db_handler.db_port}/{db_handler.db_name}",
+    echo=eval(db_handler.echo_mode),
+    pool_size=20,
+    max_overflow=20
+)
+
+
+def get_session() -> AsyncSession:
+    return AsyncSession(async_engine, expire_on_commit=False)
+
+
+async def change_answer_counters(session: AsyncSession, quiz_id, changes: dict):
+    """Same as db_handler.change_answer_counters"""
+    statement = db_handler.get_answer_counters_statement(quiz_id, changes)
+    if statement is not None:
+        await session.execute(statement)
+
+
+async def get_quiz_definition(quiz_id) -> quiz_cache.QuizDefinition or None:
+    """Return cached quiz definition, the cache is filled in a thread (see db_handler)"""
+    definition = db_handler.quiz_definitions.peek(int(quiz_id))
+    if definition is None:
+        definition = await asyncio.to_thread(db_handler.get_quiz_definition, quiz_id)
+    return definition
+
+
+# requests
+# get-requests
+async def get_user_info(tg_id) -> User:
+    """Return db_handler.User"""
+    async with get_session() as user_info_session:
+        statement = select(User).where(User.tg_user_id == tg_id)
+        return (await user_info_session.scalars(statement)).all()[0]
+
+
+async def get_visible_quizzes() -> tuple:
+    """Same as db_handler.catalog.get_visible, the snapshot is loaded in a thread"""
+    quizzes = db_handler.catalog.peek_visible()
+    if quizzes is None:
+        quizzes = await asyncio.to_thread(db_handler.catalog.get_visible)
+    return quizzes
+
+
+async def get_quiz_session(tg_id: int) -> quiz_sessions.SessionState or None:
+    """Same as db_handler.get_quiz_session"""
+    is_cached, state = active_sessions.get(tg_id)
+    if is_cached:
+        return state
+    async with get_session() as quiz_session_session:
+        state = db_handler.get_session_state(await quiz_session_session.get(QuizSession, tg_id))
+    active_sessions.set(tg_id, state)
+    if state is not None and active_sessions.is_expired(state):
+        return None
+    return state
+
+
+async def get_quiz_progress(tg_id) -> dict:
+    """Same as db_handler.get_quiz_progress"""
+    async with get_session() as quiz_progress_session:
+        statement = db_handler.get_quiz_progress_statement(tg_id)
+        return dict((await quiz_progress_session.execute(statement)).all())
+
+
+async def get_completed_quizzes_id(tg_id) -> set[int]:
+    """Return a set with completed user quizzes"""
+    quiz_progress = await get_quiz_progress(tg_id)
+    return {quiz_id for quiz_id, completed_at in quiz_progress.items() if completed_at}
+
+
+async def get_resume_quest_id(tg_id, quiz_id) -> int:
+    """Same as db_handler.get_resume_quest_id"""
+    async with get_session() as resume_quest_id_session:
+        statement = db_handler.get_resume_quest_id_statement(tg_id, quiz_id)
+        return (await resume_quest_id_session.scalars(statement)).one()
+
+
+async def get_user_quiz_answers(tg_id, quiz_id) -> dict:
+    """Return user answers in quiz like {quest_id: answer_text}"""
+    async with get_session() as user_quiz_answers_session:
+        statement = select(QuestionsAnswers.quest_id, QuestionsAnswers.answer).where(
+            QuestionsAnswers.quiz_id == quiz_id,
+            QuestionsAnswers.internal_user_id == get_internal_user_id_subquery(tg_id)
+        )
+        return dict((await user_quiz_answers_session.execute(statement)).all())
+
+
+async def get_current_mailing_status(tg_id) -> bool:
+    """Return user mailing status"""
+    async with get_session() as current_mailing_status_session:
+        statement = select(User.mailing).where(User.tg_user_id == tg_id)
+        return (await current_mailing_status_session.scalars(statement)).all()[0]
+
+
+async def get_users_id(group: str, mailing: bool = False) -> tuple:
+    """Same as db_handler.get_users_id"""
+    async with get_session() as users_id_session:
+        statement = db_handler.get_users_id_statement(group, mailing)
+        return tuple((await users_id_session.scalars(statement)).all())
+
+
+# add-requests
+async def add_user(tg_id, msg_t_stamp):
+    """Checks and optionally adds a new user to table 'user' (the message is logged by caller)"""
+    async with get_session() as session:
+        statement = select(User.tg_user_id).where(User.tg_user_id == tg_id)
+        if (await session.scalars(statement)).first() is None:
+            session.add(User(tg_user_id=tg_id))
+            add_event_in_log(
+                event_msg=f'New user: {tg_id}',
+                event_initiator='system',
+                event_timestamp=db_handler.get_normal_date_from_timestamp(msg_t_stamp),
+                session=session,
+                logger_msg='Added new user with id %s' % tg_id
+            )
+            await session.commit()
+
+
+async def submit_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str) -> \
+        quiz_cache.CachedQuestion or None or bool:
+    """Same as db_handler.submit_answer"""
+    definition = await get_quiz_definition(quiz_id)
+    next_question = definition.get_question(quest_id + 1) if definition is not None else None
+    next_quest_id = None if next_question is None else quest_id + 1
+    state = await get_quiz_session(tg_id)
+    for attempt in range(1, db_handler.submit_attempts + 1):
+        try:
+            async with get_session() as submit_session:
+                await submit_session.execute(
+                    insert(QuestionsAnswers).values(
+                        quiz_id=quiz_id,
+                        quest_id=quest_id,
+                        internal_user_id=get_internal_user_id_subquery(tg_id),
+                        answer=answer_text
+                    )
+                )
+                await change_answer_counters(
+                    submit_session,
+                    quiz_id,
+                    {(quest_id, answer_text): 1}
+                )
+                await submit_session.execute(
+                    db_handler.get_session_step_statement(tg_id, quiz_id, next_quest_id)
+                )
+                if next_quest_id is None:
+                    await submit_session.execute(
+                        db_handler.get_quiz_completion_statement(tg_id, quiz_id)
+                    )
+                add_event_in_log(
+                    msg := 'Answer from user %s for quiz %s, question %s: %s' %
+                           (tg_id, quiz_id, quest_id, answer_text),
+                    tg_id,
+                    datetime.datetime.now(),
+                    submit_session,
+                    msg
+                )
+                await submit_session.commit()
+            break
+        except SQLAlchemyError as exc:  # the session is rolled back when closed
+            init_logger.error('Answer of user %s is not saved (attempt %s): %s\n%s' % (
+                tg_id, attempt, type(exc), exc
+            ))
+    else:
+        active_sessions.drop([tg_id])
+        return False
+    active_sessions.set(tg_id, db_handler.get_next_session_state(state, next_quest_id))
+    return next_question
+
+
+async def skip_questions(tg_id: int, quiz_id: int, quests_id: list or tuple,
+                         next_quest_id: int or None):
+    """Same as db_handler.skip_questions"""
+    internal_user_id = get_internal_user_id_subquery(tg_id)
+    state = await get_quiz_session(tg_id)
+    async with get_session() as skip_session:
+        await skip_session.execute(
+            insert(QuestionsAnswers).values([
+                {
+                    'quiz_id': quiz_id,
+                    'quest_id': quest_id,
+                    'internal_user_id': internal_user_id,
+                    'answer': 'None'
+                } for quest_id in quests_id
+            ])
+        )
+        await change_answer_counters(
+            skip_session,
+            quiz_id,
+            {(quest_id, 'None'): 1 for quest_id in quests_id}
+        )
+        await skip_session.execute(
+            db_handler.get_session_step_statement(tg_id, quiz_id, next_quest_id)
+        )
+        if next_quest_id is None:
+            await skip_session.execute(db_handler.get_quiz_completion_statement(tg_id, quiz_id))
+        add_event_in_log(
+            msg := 'User %s skipped questions %s in quiz %s' % (tg_id, list(quests_id), quiz_id),
+            tg_id,
+            datetime.datetime.now(),
+            skip_session,
+            msg
+        )
+        await skip_session.commit()
+    active_sessions.set(tg_id, db_handler.get_next_session_state(state, next_quest_id))
+
+
+# update-requests
+async def rewrite_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
+    """Same as db_handler.rewrite_answer"""
+    try:
+        async with get_session() as user_answer_update_session:
+            await user_answer_update_session.execute(db_handler.get_answers_lock_statement(quiz_id))
+            answer_filter = (
+                QuestionsAnswers.quiz_id == quiz_id,
+                QuestionsAnswers.quest_id == quest_id,
+                QuestionsAnswers.internal_user_id == get_internal_user_id_subquery(tg_id)
+            )
+            statement = select(QuestionsAnswers.answer).where(*answer_filter).with_for_update()
+            old_answers = (await user_answer_update_session.scalars(statement)).all()
+            await user_answer_update_session.execute(
+                update(QuestionsAnswers).where(*answer_filter).values(answer=answer_text)
+            )
+            counters_changes = {(quest_id, answer_text): len(old_answers)}
+            for old_answer in old_answers:
+                counters_changes[(quest_id, old_answer)] = \
+                    counters_changes.get((quest_id, old_answer), 0) - 1
+            await change_answer_counters(user_answer_update_session, quiz_id, counters_changes)
+            await user_answer_update_session.execute(
+                db_handler.get_session_step_statement(tg_id, quiz_id, None)
+            )
+            add_event_in_log(
+                msg := 'Rewrite answer from user %s for quiz %s, question %s' % (
+                    tg_id, quiz_id, quest_id
+                ),
+                tg_id,
+                datetime.datetime.now(),
+                user_answer_update_session,
+                msg
+            )
+            await user_answer_update_session.commit()
+        active_sessions.set(tg_id, None)
+        return True
+    except Exception as exc:
+        init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+        return False
+
+
+async def start_quiz_session(tg_id: int, quiz_id: int, quest_id: int = 1, mode: str = 'answer'):
+    """Same as db_handler.start_quiz_session"""
+    now = datetime.datetime.now()
+    state = quiz_sessions.SessionState(quiz_id, quest_id, mode, now, now)
+    async with get_session() as start_session_session:
+        await start_session_session.execute(db_handler.get_session_upsert_statement(tg_id, state))
+        if mode == 'answer':
+            await start_session_session.execute(db_handler.get_quiz_start_statement(tg_id, quiz_id))
+        add_event_in_log(
+            msg := 'Start quiz %s (%s from question %s) for user %s' % (
+                quiz_id, mode, quest_id, tg_id
+            ),
+            tg_id,
+            now,
+            start_session_session,
+            msg
+        )
+        await start_session_session.commit()
+    active_sessions.set(tg_id, state)
+
+
+async def finish_quiz_session(tg_id: int, reason: str = 'finished'):
+    """Same as db_handler.finish_quiz_session"""
+    async with get_session() as finish_session_session:
+        statement = delete(QuizSession).where(QuizSession.tg_user_id == tg_id).\
+            returning(QuizSession.quiz_id, QuizSession.mode)
+        quiz_id, mode = (await finish_session_session.execute(statement)).first() or (None, None)
+        if quiz_id is not None:
+            if reason == 'finished' and mode == 'answer':
+                await finish_session_session.execute(
+                    db_handler.get_quiz_completion_statement(tg_id, quiz_id)
+                )
+            add_event_in_log(
+                msg := 'Quiz %s is %s by user %s' % (quiz_id, reason, tg_id),
+                tg_id,
+                datetime.datetime.now(),
+                finish_session_session,
+                msg
+            )
+        await finish_session_session.commit()
+    active_sessions.set(tg_id, None)
+
+
+async def update_mailing_status(tg_id: int, new_status: bool):
+    """Updates mailing status of user"""
+    async with get_session() as update_mailing_status_session:
+        await update_mailing_status_session.execute(
+            update(User).where(User.tg_user_id == tg_id).values(mailing=new_status)
+        )
+        add_event_in_log(
+            'New mailing status %s for user %s' % (new_status, tg_id),
+            tg_id,
+            datetime.datetime.now(),
+            update_mailing_status_session,
+            'Update mailing status "%s" for user %s' % (new_status, tg_id)
+        )
+        await update_mailing_status_session.commit()
@@ -0,0 +1,126 @@
+"""
+Compares threaded and asyncio runtimes on the quiz flow.
+
+Each simulated user passes the quiz: status is read, the answer is submitted and the next
+question is "sent" (sending is simulated with {send_latency} seconds of waiting). The threaded mode
+runs users on {threads} threads with db_handler, the asyncio mode runs all of them at once with
+async_db.
+
+Run it on a test database: it adds users with negative tg ids and their answers.
+
+python benchmark.py {quiz_id} [users] [threads] [send_latency]
+"""
+
+
+import asyncio
+import concurrent.futures
+import statistics
+import sys
+import time
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import async_db
+import db_handler
+import migrations
+
+
+def prepare_users(users_count: int) -> list[int]:
+    """Adds benchmark users (tg ids -1, -2, ...) and ends their quiz sessions"""
+    users_id = [-index for index in range(1, users_count + 1)]
+    with Session(db_handler.engine) as benchmark_session:
+        statement = postgresql.insert(db_handler.User).values(
+            [{'tg_user_id': tg_id} for tg_id in users_id]
+        ).on_conflict_do_nothing()
+        benchmark_session.execute(statement)
+        benchmark_session.query(db_handler.QuizSession).\
+            filter(db_handler.QuizSession.tg_user_id.in_(users_id)).\
+            delete(synchronize_session=False)
+        benchmark_session.commit()
+    db_handler.active_sessions.drop(users_id)
+    return users_id
+
+
+def get_answer(question) -> str:
+    return 'benchmark' if question.is_manual_input else question.answers[0]
+
+
+def pass_quiz_threaded(tg_id, quiz_id, send_latency) -> list[float]:
+    """Passes the quiz with db_handler, returns latency of each answer"""
+    latencies = []
+    db_handler.start_quiz_session(tg_id, quiz_id)
+    question = db_handler.get_quiz_definition(quiz_id).get_question(1)
+    while question:  # False - the answer is not saved (see the log)
+        started = time.perf_counter()
+        db_handler.get_quiz_session(tg_id)
+        question = db_handler.submit_answer(tg_id, quiz_id, question.quest_id, get_answer(question))
+        time.sleep(send_latency)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def pass_quiz_async(tg_id, quiz_id, send_latency) -> list[float]:
+    """Passes the quiz with async_db, returns latency of each answer"""
+    latencies = []
+    await async_db.start_quiz_session(tg_id, quiz_id)
+    question = (await async_db.get_quiz_definition(quiz_id)).get_question(1)
+    while question:  # False - the answer is not saved (see the log)
+        started = time.perf_counter()
+        await async_db.get_quiz_session(tg_id)
+        question = await async_db.submit_answer(
+            tg_id, quiz_id, question.quest_id, get_answer(question)
+        )
+        await asyncio.sleep(send_latency)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_threaded(users_id, quiz_id, threads, send_latency) -> list[float]:
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        results = executor.map(
+            lambda tg_id: pass_quiz_threaded(tg_id, quiz_id, send_latency),
+            users_id
+        )
+        return [latency for latencies in results for latency in latencies]
+
+
+async def run_async(users_id, quiz_id, send_latency) -> list[float]:
+    results = await asyncio.gather(
+        *(pass_quiz_async(tg_id, quiz_id, send_latency) for tg_id in users_id)
+    )
+    await async_db.async_engine.dispose()
+    return [latency for latencies in results for latency in latencies]
+
+
+def report(mode: str, latencies: list[float], elapsed: float):
+    latencies = sorted(latencies)
+    print(
+        f'{mode}: {len(latencies)} answers in {elapsed:.2f} s, '
+        f'{len(latencies) / elapsed:.1f} answers/s, '
+        f'latency p50 {statistics.median(latencies) * 1000:.1f} ms, '
+        f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms'
+    )
+
+
+def main():
+    quiz_id = int(sys.argv[1])
+    users_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    send_latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    migrations.upgrade()
+    if db_handler.get_quiz_definition(quiz_id) is None:
+        exit(f'There is no quiz with id {quiz_id}')
+    users_id = prepare_users(users_count)
+
+    started = time.perf_counter()
+    latencies = run_threaded(users_id, quiz_id, threads, send_latency)
+    report(f'threaded ({threads} threads)', latencies, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    latencies = asyncio.run(run_async(users_id, quiz_id, send_latency))
+    report('asyncio', latencies, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
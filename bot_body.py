@@ -1,19 +1,32 @@
 import datetime
 import functools
-import json
 import logging
+import os
 import threading
 import time
+import urllib.parse
 
-import pandas
 import telebot
 from telebot.types import InlineKeyboardButton
 from telebot.types import InlineKeyboardMarkup
 from telebot.types import ReplyKeyboardMarkup
 
 import bot_init
+import broadcast
+import cluster
 import db_handler
+import dispatcher
+import log_partitions
+import log_writer
+import markup_cache
+import metrics
+import migrations
+import outbound
 import quiz_handler
+import rate_limiter
+import report_jobs
+import scheduler
+import webhook
 from bot_init import init_logger
 from db_handler import is_looped
 
@@ -24,77 +37,144 @@ log_handler.level = logging.INFO
 init_logger.addHandler(log_handler)
 
 
-# bot init
-tg_bot = telebot.TeleBot(bot_init.get_bot_api_token())
+# bot init (handlers are run by update_dispatcher, not by the thread pool of TeleBot)
+tg_bot = telebot.TeleBot(bot_init.get_bot_api_token(), threaded=False)
 
 
 # bot settings
 min_time_delta = 2
+rate_limits = {
+    # kind (command name, content type or 'callback'): (messages, seconds)
+    'default': (1, min_time_delta),
+}
+rate_limit_redis_url = os.environ.get('rate_limit_redis_url')  # shared limits for several processes
+flood_limiter = rate_limiter.RateLimiter(
+    rate_limits,
+    max_users=10000,
+    backend=rate_limiter.RedisBackend(rate_limit_redis_url) if rate_limit_redis_url else None
+)
+
+
+# webhook settings (polling is used if run_mode isn't 'webhook')
+run_mode = os.environ.get('run_mode', 'polling')
+webhook_url = os.environ.get('webhook_url')  # public https url (behind a proxy with TLS)
+webhook_host = os.environ.get('webhook_host', '0.0.0.0')
+webhook_port = int(os.environ.get('webhook_port', 8080))
+webhook_secret = os.environ.get('webhook_secret')  # required, Telegram sends it with updates
+webhook_server = None
+
+
+# dispatcher settings
+dispatcher_shards = int(os.environ.get('dispatcher_shards', 4))
+dispatcher_queue_size = int(os.environ.get('dispatcher_queue_size', 100))
+
+
+def mark_update_dispatched(update: telebot.types.Update):
+    """Moves the polling offset past the queued update (TeleBot does it only after handling)"""
+    tg_bot.last_update_id = max(tg_bot.last_update_id, update.update_id)
+
+
+update_dispatcher = dispatcher.UpdateDispatcher(
+    tg_bot.process_new_updates,
+    dispatcher_shards,
+    dispatcher_queue_size,
+    mark_update_dispatched
+)
+# polling and webhook hand updates to the dispatcher, its workers call the original method
+tg_bot.process_new_updates = update_dispatcher.dispatch
+
+
+# outbound settings: replies are sent by worker threads of the outbound dispatcher
+outbound_workers = int(os.environ.get('outbound_workers', 8))
+outbound_queue_size = int(os.environ.get('outbound_queue_size', 1000))
+# all threads use one session, its pool keeps connections to the Bot API alive
+telebot.apihelper.session = outbound.get_session(outbound_workers + dispatcher_shards + 2)
+outbound_messages = outbound.OutboundDispatcher(
+    tg_bot,
+    outbound_workers,
+    outbound_queue_size,
+    chat_burst=int(os.environ.get('outbound_chat_burst', 3)),
+    chat_rate=float(os.environ.get('outbound_chat_rate', 1))
+)
+
+
+# metrics settings: Prometheus endpoint http://{metrics_host}:{metrics_port}/metrics
+metrics_host = os.environ.get('metrics_host', '127.0.0.1')
+metrics_port = int(os.environ.get('metrics_port', 9464))  # 0 - without the endpoint
+metrics.instrument_engine(db_handler.engine)
+metrics.instrument_module(db_handler)
+
+
+# cluster settings (see cluster.py)
+cluster_lock_id = int(os.environ.get('cluster_lock_id', 7318001))  # advisory lock of the leader
+is_leader = True  # singleton jobs (unbans and mailings) run only in the leader process
+leader_lease = None
 
 
 # region wrappers
+def metrics_wrapper(func):
+    """Decorator that counts updates, their handling time and DB round-trips (see metrics.py)"""
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        with metrics.track_update(func.__name__):
+            func(*args)
+
+    return wrapper
+
+
 def message_wrapper(func):
     """Decorator that writes messages to logs"""
 
+    @functools.wraps(func)
     def wrapper(*args):
         message: telebot.types.Message = args[0]
-        user_quiz_status = db_handler.get_quiz_status(message.from_user.id)
-        last_message_time = db_handler.get_last_timestamp(message.from_user.id)
-        current_message_date = datetime.datetime.fromtimestamp(float(message.date))
-        db_handler.add_message_in_log(
+        quiz_session = db_handler.get_quiz_session(message.from_user.id)
+        is_allowed = flood_limiter.hit(message.from_user.id, get_message_kind(message))
+        log_writer.message_log_writer.put(
             message.from_user.id,
             message.id,
             message.text,
             float(message.date)
         )
-        time_delta = (current_message_date - last_message_time).seconds
-        if user_quiz_status is None:
-            if time_delta >= min_time_delta:  # change it in bot settings
+        if quiz_session is None:
+            if is_allowed:  # change it in bot settings
                 func(message)
             else:
                 simple_send_message(message.chat.id, 'Вы отправляете сообщения слишком часто!',
                                     None)
         else:
-
-            current_quiz = int(user_quiz_status.split()[0])
-            current_question = int(user_quiz_status.split()[1])
-            is_rewrite = False
-            if 'r' in user_quiz_status:
-                is_rewrite = True
-            if is_rewrite is False:
-                answer_status = db_handler.add_new_answer(
+            if not quiz_session.is_rewrite:
+                next_question = db_handler.submit_answer(
                     message.from_user.id,
-                    current_quiz,
-                    current_question,
+                    quiz_session.quiz_id,
+                    quiz_session.quest_id,
                     message.text
                 )
+                if next_question is False:
+                    simple_send_message(message.chat.id, 'Не получилось сохранить ответ :(\n\n'
+                                                         'Пожалуйста, отправьте его ещё раз')
+                elif next_question is None:
+                    end_quiz(message.from_user.id, message.chat.id, quiz_session.quiz_id, False)
+                else:
+                    send_question(message.from_user.id, message.chat.id, next_question)
             else:
                 answer_status = db_handler.rewrite_answer(
                     message.from_user.id,
-                    current_quiz,
-                    current_question,
+                    quiz_session.quiz_id,
+                    quiz_session.quest_id,
                     message.text
                 )
-                simple_send_message(
-                    message.chat.id,
-                    'Ответ успешно перезаписан!',
-                    get_welcome_markup()
-                )
-            if answer_status is False:
-                simple_send_message(message.chat.id, 'Что-то пошло не так :(\n\n'
-                                                     'Попробуйте ещё раз или свяжитесь с'
-                                                     ' администратором')
-            elif not is_rewrite:
-                question_list = db_handler.get_list_of_questions_in_quiz(current_quiz)
-                if len(question_list) > current_question:
-                    db_handler.update_user_quiz_status(
-                        message.from_user.id,
-                        f'{current_quiz} {current_question + 1}'
+                if answer_status is False:
+                    simple_send_message(message.chat.id, 'Что-то пошло не так :(\n\n'
+                                                         'Попробуйте ещё раз или свяжитесь с'
+                                                         ' администратором')
+                else:
+                    simple_send_message(
+                        message.chat.id,
+                        'Ответ успешно перезаписан!',
+                        get_welcome_markup()
                     )
-                    send_question(message.from_user.id, message.chat.id)
-
-                elif len(question_list) <= current_question:
-                    end_quiz(message.from_user.id, message.chat.id, current_quiz)
 
     return wrapper
 
@@ -102,18 +182,17 @@ def message_wrapper(func):
 def document_wrapper(func):
     """Decorator that writes doc-info messages to logs"""
 
+    @functools.wraps(func)
     def wrapper(*args):
         message: telebot.types.Message = args[0]
-        last_message_time = db_handler.get_last_timestamp(message.from_user.id)
-        current_message_date = datetime.datetime.fromtimestamp(float(message.date))
-        db_handler.add_message_in_log(
+        is_allowed = flood_limiter.hit(message.from_user.id, 'document')
+        log_writer.message_log_writer.put(
             message.from_user.id,
             message.id,
             f'Doc: {message.document.file_name}',
             float(message.date)
         )
-        time_delta = (current_message_date - last_message_time).seconds
-        if time_delta >= min_time_delta:  # change in bot settings
+        if is_allowed:  # change in bot settings
             func(message)
         else:
             simple_send_message(message.chat.id, 'Вы отправляете сообщения слишком часто!', None)
@@ -124,19 +203,19 @@ def document_wrapper(func):
 def callback_wrapper(func):
     """Decorator that writes callback messages to logs"""
 
+    @functools.wraps(func)
     def wrapper(*args):
         call: telebot.types.CallbackQuery = args[0]
-        tg_bot.edit_message_reply_markup(call.message.chat.id, call.message.id, reply_markup=None)
-        last_message_time = db_handler.get_last_timestamp(call.from_user.id)
-        current_message_date = datetime.datetime.now()
-        db_handler.add_message_in_log(
+        # queued before the replies of the handler, so the keyboard is removed first
+        outbound_messages.put_markup_edit(call.message.chat.id, call.message.id)
+        is_allowed = flood_limiter.hit(call.from_user.id, 'callback')
+        log_writer.message_log_writer.put(
             call.from_user.id,
             call.message.id,
             f'In-Line: {call.data}',
-            current_message_date.timestamp()
+            datetime.datetime.now().timestamp()
         )
-        time_delta = (current_message_date - last_message_time).seconds
-        if time_delta >= min_time_delta:  # change in bot settings
+        if is_allowed:  # change in bot settings
             func(call)
         else:
             simple_send_message(
@@ -158,6 +237,7 @@ def rule_wrapper(rules):
 
     def decorator(func):
 
+        @functools.wraps(func)
         def wrapper(*args):
             message: telebot.types.Message = args[0]
             user = db_handler.get_user_info(message.from_user.id)
@@ -177,68 +257,116 @@ def rule_wrapper(rules):
 
 
 # region general functions
-def end_quiz(tg_id, chat_id, quiz_id):
-    """Initiates completion of the quiz"""
+def get_message_kind(message: telebot.types.Message) -> str:
+    """Returns command name (without '/') or content type of message for the rate limiter"""
+    if message.text and message.text.startswith('/'):
+        return message.text.split()[0][1:].split('@')[0]
+    return message.content_type
+
+
+def end_quiz(tg_id, chat_id, quiz_id, reset_status=True):
+    """Initiates completion of the quiz
+
+    Use reset_status=False if the quiz session is already finished (like after
+    db_handler.submit_answer)
+    """
     gratitude_message = db_handler.get_end_message(quiz_id)
     simple_send_message(
         chat_id,
         gratitude_message,
         get_welcome_markup()
     )
-    db_handler.update_user_quiz_status(tg_id, None)
+    if reset_status:
+        db_handler.finish_quiz_session(tg_id)
 
 
 def simple_send_message(chat_id, message_text, markup=None):
-    """Simple send-message function"""
-    tg_bot.send_message(chat_id, message_text, reply_markup=markup)
-    init_logger.info('Message "%s" to user with id: %s' % (message_text, chat_id))
+    """Simple send-message function (the message is queued, see outbound.OutboundDispatcher)"""
+    outbound_messages.put(chat_id, message_text, markup)
 
 
-def send_question(tg_id: int, chat_id: int):
+def send_question(tg_id: int, chat_id: int, current_question=None):
     """Initiates checking and sending a message with a question
 
-    Keep in mind that sending several "empty" questions at once is not recommended!!!
+    Questions whose relations aren't satisfied are skipped with one request (see quiz_plan).
 
     :param tg_id: user id (message.from_user.id)
     :param chat_id: chat id (message.chat.id)
+    :param current_question: question to send (quiz_cache.CachedQuestion), if None - it will be
+        taken from the quiz session
     :return: None
     """
-    user = db_handler.get_user_info(tg_id)
-    question_data = user.quiz_status.split()
-    current_quiz_id = int(question_data[0])
-    current_question_id = int(question_data[1])
-    quiz_questions_list = db_handler.get_list_of_questions_in_quiz(current_quiz_id)
-    if len(quiz_questions_list) < current_question_id:
+    is_rewrite = False
+    if current_question is None:
+        quiz_session = db_handler.get_quiz_session(tg_id)
+        current_quiz_id = quiz_session.quiz_id
+        current_question_id = quiz_session.quest_id
+        is_rewrite = quiz_session.is_rewrite
+    else:
+        current_quiz_id = current_question.quiz_id
+        current_question_id = current_question.quest_id
+    quiz_definition = db_handler.get_quiz_definition(current_quiz_id)
+    if quiz_definition is None:  # the quiz is deleted
         end_quiz(tg_id, chat_id, current_quiz_id)
-    current_question: db_handler.QuizQuestions = quiz_questions_list[current_question_id - 1]
-    if current_question.quest_relation:
-        check_quest_id, check_value = current_question.quest_relation.split(' -> ')
-        if not db_handler.check_quest_relation(
-                tg_id, int(current_quiz_id),
-                int(check_quest_id),
-                check_value
-        ):
-            db_handler.add_new_answer(tg_id, current_quiz_id, current_question_id, 'None')
-            db_handler.update_user_quiz_status(
-                tg_id, f'{current_quiz_id} {current_question_id + 1}'
+        return
+    # the answer to a dependent question is rewritten without any checks
+    if not is_rewrite and quiz_definition.plan.get_conditions(current_question_id):
+        next_question_id, skipped_questions_id = quiz_definition.plan.resolve(
+            current_question_id,
+            db_handler.get_user_quiz_answers(tg_id, current_quiz_id)
+        )
+        if skipped_questions_id:
+            db_handler.skip_questions(
+                tg_id,
+                current_quiz_id,
+                skipped_questions_id,
+                next_question_id
             )
-            send_question(tg_id, chat_id)
-        else:
-            quest_text = current_question.quest_text
-            quest_answers = current_question.quest_ans.split(' || ')
-            if quest_answers[0] == 'MANUAL_INPUT':
-                ans_menu = None
-            else:
-                ans_menu = get_question_markup(quest_answers)
-            simple_send_message(chat_id, quest_text, ans_menu)
-    else:
-        quest_text = current_question.quest_text
-        quest_answers = current_question.quest_ans.split(' || ')
-        if quest_answers[0] == 'MANUAL_INPUT':
-            ans_menu = None
-        else:
-            ans_menu = get_question_markup(quest_answers)
-        simple_send_message(chat_id, quest_text, ans_menu)
+        if next_question_id is None:
+            end_quiz(tg_id, chat_id, current_quiz_id, False)
+            return
+        current_question_id = next_question_id
+    current_question = quiz_definition.get_question(current_question_id)
+    if current_question is None:
+        end_quiz(tg_id, chat_id, current_quiz_id)
+        return
+    simple_send_message(
+        chat_id,
+        current_question.quest_text,
+        get_question_menu(quiz_definition, current_question)
+    )
+
+
+def get_welcome_text() -> str:
+    """Returns /start message with rules"""
+    return f'Привет! Я автоматизированная система, созданная для проведения опросов среди' \
+           f' пользователей Telegram ©.\n\n' \
+           f'Правила пользования следующие:\n' \
+           f'1. Будьте вежливы и не пытайтесь меня сломать — у меня тоже есть чувства.\n' \
+           f'2. Внимательно читайте вопросы и ответы, ведь исправить их можно только в последнем' \
+           f' пройденном опросе!\n' \
+           f'3. Я всё ещё нахожусь в состоянии разработки. Если вы нашли баг, пожалуйста, введите' \
+           f' команду /help и воспользуйтесь соответствующим пунктом меню.\n' \
+           f'4. Если Вы начали проходить опрос, то его необходимо закончить (или прервать' \
+           f' командой /stop), прежде чем перейти к другому функционалу. Команда /resume' \
+           f' повторит текущий вопрос.\n' \
+           f'5. Не отправляйте сообщения чаще, чем раз в {min_time_delta} секунд.\n\n' \
+           f'Особенное правило - в любой непонятной ситуации пишите /help'
+
+
+def get_user_info_text(user: db_handler.User) -> str:
+    """Returns message with user id, role and mailing status"""
+    group_dict = {
+        'ban': 'забанен',
+        'user': 'пользователь',
+        'editor': 'редактор',
+        'admin': 'администратор',
+        'm_admin': 'главный администратор'
+    }
+    return f'ID: {user.tg_user_id}\n' \
+           f'Внутренний ID: {user.internal_user_id}\n' \
+           f'Роль: {group_dict[user.group]}\n' \
+           f'Рассылка: {"включена" if user.mailing else "отключена"}'
 
 
 def get_question_markup(ans_list):
@@ -249,17 +377,93 @@ def get_question_markup(ans_list):
     return question_menu
 
 
-def get_available_quiz_inline_markup(input_list: list or tuple, completed_quizzes_id: set):
-    """Create inline menu with available quizzes"""
+def get_available_quiz_inline_markup(input_list: list or tuple, quiz_progress: dict,
+                                     limit: int = 10):
+    """Create inline menu with available quizzes
+
+    :param input_list: (quiz_name, quiz_id) of visible quizzes from newer to older
+    :param quiz_progress: {quiz_id: completed_at or None} from db_handler.get_quiz_progress
+    :param limit: max number of quizzes in the menu
+    :return: InlineKeyboardMarkup without completed quizzes
+    """
     quiz_menu = InlineKeyboardMarkup(row_width=1)
     for _ in input_list:
-        if _[1] not in completed_quizzes_id:
-            quiz_menu.add(
-                InlineKeyboardButton(text=_[0], callback_data=f'start_quiz {_[1]}')
-            )
+        if len(quiz_menu.keyboard) >= limit:
+            break
+        if _[1] not in quiz_progress:
+            button_text = _[0]
+        elif quiz_progress[_[1]] is None:
+            button_text = f'{_[0]} (продолжить)'
+        else:
+            continue
+        quiz_menu.add(
+            InlineKeyboardButton(text=button_text, callback_data=f'start_quiz {_[1]}')
+        )
     return quiz_menu
 
 
+def get_available_quiz_menu(input_list: list or tuple, quiz_progress: dict, generation: int,
+                            limit: int = 10) -> str or None:
+    """Returns serialized get_available_quiz_inline_markup or None if there are no quizzes
+
+    :param input_list: visible quizzes (db_handler.catalog snapshot)
+    :param quiz_progress: {quiz_id: completed_at or None} from db_handler.get_quiz_progress
+    :param generation: catalog generation read before the snapshot
+    :param limit: max number of quizzes in the menu
+    :return: JSON string for reply_markup or None
+    """
+    visible_progress = tuple(
+        (_[1], quiz_progress[_[1]] is None) for _ in input_list if _[1] in quiz_progress
+    )
+
+    def build():
+        quiz_menu = get_available_quiz_inline_markup(input_list, quiz_progress, limit)
+        return quiz_menu if quiz_menu.keyboard else None
+
+    return markups.get(('quiz_menu', limit, visible_progress), generation, build)
+
+
+def get_question_menu(quiz_definition, current_question) -> str or None:
+    """Returns serialized get_question_markup or None for a question with manual input"""
+    if current_question.is_manual_input:
+        return None
+    return markups.get(
+        ('question', current_question.quiz_id, current_question.quest_id),
+        quiz_definition.version,
+        lambda: get_question_markup(current_question.answers)
+    )
+
+
+def get_rewrite_menu(quiz_definition) -> str:
+    """Returns serialized get_rewrite_inline_markup"""
+    return markups.get(
+        ('rewrite', quiz_definition.quiz_id),
+        quiz_definition.version,
+        lambda: get_rewrite_inline_markup(quiz_definition)
+    )
+
+
+def get_rewrite_inline_markup(quiz_definition) -> InlineKeyboardMarkup:
+    """Create inline menu with questions of quiz (quiz_cache.QuizDefinition) for rewriting"""
+    quiz_r_menu = InlineKeyboardMarkup()
+    for _ in quiz_definition.questions:
+        if conditions := quiz_definition.plan.get_conditions(_.quest_id):
+            quiz_r_menu.add(
+                InlineKeyboardButton(
+                    text=f'Если {" и ".join(i.describe() for i in conditions)}: {_.quest_text}',
+                    callback_data=f'quiz_rewrite {_.quiz_id} {_.quest_id}'
+                )
+            )
+        else:
+            quiz_r_menu.add(
+                InlineKeyboardButton(
+                    text=f'{_.quest_text}',
+                    callback_data=f'quiz_rewrite {_.quiz_id} {_.quest_id}'
+                )
+            )
+    return quiz_r_menu
+
+
 @functools.cache
 def get_welcome_markup():
     """Create welcome greet menu"""
@@ -304,28 +508,91 @@ def get_help_inline_markup():
     return help_menu
 
 
-def quiz_list_prepare(message_tuple):
-    """Returns string with quizzes info"""
-    if len(message_tuple) == 2:
-        quiz_l = db_handler.get_quiz_list()
-        proc_quiz_l = ['Последние 10 опросов:\n']
+def get_quiz_page_inline_markup(page, visible: bool) -> InlineKeyboardMarkup or None:
+    """Create inline menu with buttons to newer and older pages of the catalog"""
+    catalog_name = 'visible' if visible else 'all'
+    buttons = []
+    if page.has_newer:
+        buttons.append(InlineKeyboardButton(
+            text='< Новее',
+            callback_data=f'quiz_page {catalog_name} after {page.first_id}'
+        ))
+    if page.has_older:
+        buttons.append(InlineKeyboardButton(
+            text='Старее >',
+            callback_data=f'quiz_page {catalog_name} before {page.last_id}'
+        ))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup().row(*buttons)
+
+
+def quiz_list_prepare(visible: bool = False, before_id: int = None, after_id: int = None) -> tuple:
+    """Returns string with quizzes info and inline menu to other pages (or None)
+
+    :param visible: only visible quizzes
+    :param before_id: page with quizzes older than this one, the newest quizzes if None
+    :param after_id: page with quizzes newer than this one
+    :return: (text, InlineKeyboardMarkup or None)
+    """
+    page = db_handler.catalog.get_page(visible, before_id, after_id)
+    if visible:
+        proc_quiz_l = ['Видимые опросы:\n']
     else:
-        quiz_l = db_handler.get_quiz_list(True)
-        proc_quiz_l = ['Последние 10 видимых опросов:\n']
-    for quiz in quiz_l:
+        proc_quiz_l = ['Опросы:\n']
+    for quiz in page.quizzes:
         proc_quiz_l.append(f'Имя: {quiz[0]}\nID: {quiz[1]}\nВидимость: {quiz[2]}\n')
+    if not page.quizzes:
+        proc_quiz_l.append('Опросов нет')
 
-    return '\n'.join(proc_quiz_l)
+    return '\n'.join(proc_quiz_l), get_quiz_page_inline_markup(page, visible)
 
 
-def auto_unban():
-    """Separate thread for automated user unbanning"""
-    while True:
-        active_ban_list = db_handler.get_active_ban_list()
-        for ban in active_ban_list:
-            if ban.unban_time <= datetime.datetime.now():
-                db_handler.unban_user(0, ban.tg_id)
-        time.sleep(30)
+def schedule_unban(ban_id, unban_time: datetime.datetime):
+    """Schedules automated closing of ban (in cluster mode the leader loads it from the DB)"""
+    if is_leader:
+        timer_scheduler.schedule(unban_time, ('unban', ban_id), db_handler.expire_ban, ban_id)
+
+
+def load_unban_schedule():
+    """Schedules all active bans (jobs of already scheduled bans are replaced)"""
+    for ban in db_handler.get_active_ban_list():
+        schedule_unban(ban.internal_ban_id, ban.unban_time)
+
+
+def reload_singleton_jobs():
+    """Picks up bans and mailings created by other processes, ends expired quiz sessions"""
+    load_unban_schedule()
+    broadcast_engine.resume()
+    db_handler.expire_quiz_sessions()
+
+
+def start_log_maintenance():
+    """Prepares log partitions and applies retention in a separate thread (archiving is slow)"""
+    threading.Thread(target=log_partitions.maintain, name='log_maintenance', daemon=True).start()
+
+
+def start_singleton_jobs():
+    """Called when this process becomes the leader"""
+    global is_leader
+    is_leader = True
+    broadcast_engine.run_jobs = True
+    reload_singleton_jobs()
+    timer_scheduler.schedule_every(datetime.timedelta(minutes=1), 'singleton_jobs',
+                                   reload_singleton_jobs)
+    start_log_maintenance()
+    timer_scheduler.schedule_every(datetime.timedelta(hours=1), 'log_maintenance',
+                                   start_log_maintenance)
+
+
+def stop_singleton_jobs():
+    """Called when this process loses the leader lease"""
+    global is_leader
+    is_leader = False
+    broadcast_engine.run_jobs = False
+    timer_scheduler.cancel('singleton_jobs')
+    timer_scheduler.cancel('log_maintenance')
+    timer_scheduler.cancel_all('unban')
 
 
 def check_term(term: str):
@@ -335,6 +602,35 @@ def check_term(term: str):
     return term_unit in ('s', 'm', 'h', 'd') and term_numeric.isdigit()
 
 
+def report_delivery(chat_id, error: Exception or None):
+    """Tells chat {chat_id} whether the message of /message {id} is sent (error is None)"""
+    if error is None:
+        simple_send_message(chat_id, 'Сообщение отправлено!')
+    else:
+        simple_send_message(chat_id, f'Сообщение не отправлено!\n{type(error)}\n{error}')
+
+
+def send_documents(chat_id, documents: list or tuple):
+    """Sends documents from memory (they are queued after the messages, see simple_send_message)
+
+    :param chat_id: target chat id
+    :param documents: list of tuples (file name, bytes)
+    :return: None
+    """
+    for file_name, file_content in documents:
+        outbound_messages.put_document(chat_id, file_name, file_content)
+
+
+quiz_reports = report_jobs.ReportJobs(send_documents, simple_send_message)
+broadcast_engine = broadcast.BroadcastEngine(
+    tg_bot,
+    get_welcome_markup(),
+    rate=outbound_messages.rate  # replies and mailings share the global limit
+)
+timer_scheduler = scheduler.Scheduler()  # auto-unban and other timed jobs
+markups = markup_cache.MarkupCache(int(os.environ.get('markup_cache_size', 10000)))
+
+
 def mailing(users_id: tuple or list, msg_text):
     """Auto-mailing
 
@@ -352,29 +648,43 @@ def mailing(users_id: tuple or list, msg_text):
 # region message handlers
 # region commands
 @tg_bot.message_handler(commands=['start'])
-# Decorator cannot be used because the user must be added first
+@metrics_wrapper
+# rule_wrapper and message_wrapper cannot be used because the user must be added first
 def welcome_handler(message: telebot.types.Message):
     """Simple welcome-message handler
 
     Adds a new user if it doesn't already exist
     """
     db_handler.add_user(message.from_user.id, message.id, message.text, float(message.date))
-    msg = f'Привет! Я автоматизированная система, созданная для проведения опросов среди' \
-          f' пользователей Telegram ©.\n\n' \
-          f'Правила пользования следующие:\n' \
-          f'1. Будьте вежливы и не пытайтесь меня сломать — у меня тоже есть чувства.\n' \
-          f'2. Внимательно читайте вопросы и ответы, ведь исправить их можно только в последнем' \
-          f' пройденном опросе!\n' \
-          f'3. Я всё ещё нахожусь в состоянии разработки. Если вы нашли баг, пожалуйста, введите' \
-          f' команду /help и воспользуйтесь соответствующим пунктом меню.\n' \
-          f'4. Если Вы начали проходить опрос, то его необходимо закончить, прежде чем перейти к' \
-          f' другому функционалу.\n' \
-          f'5. Не отправляйте сообщения чаще, чем раз в {min_time_delta} секунд.\n\n' \
-          f'Особенное правило - в любой непонятной ситуации пишите /help'
-    simple_send_message(message.chat.id, msg, get_welcome_markup())
+    simple_send_message(message.chat.id, get_welcome_text(), get_welcome_markup())
+
+
+@tg_bot.message_handler(commands=['stop', 'resume'])
+@metrics_wrapper
+@rule_wrapper(('user', 'editor', 'admin', 'm_admin'))
+# message_wrapper isn't used: during the quiz it would take the command for an answer
+def quiz_session_handler(message: telebot.types.Message):
+    """/stop (abandon the quiz) and /resume (send the current question again) handler"""
+    is_allowed = flood_limiter.hit(message.from_user.id, get_message_kind(message))
+    log_writer.message_log_writer.put(
+        message.from_user.id,
+        message.id,
+        message.text,
+        float(message.date)
+    )
+    if not is_allowed:
+        simple_send_message(message.chat.id, 'Вы отправляете сообщения слишком часто!', None)
+    elif db_handler.get_quiz_session(message.from_user.id) is None:
+        simple_send_message(message.chat.id, 'Вы сейчас не проходите опрос', get_welcome_markup())
+    elif get_message_kind(message) == 'stop':
+        db_handler.finish_quiz_session(message.from_user.id, 'abandoned')
+        simple_send_message(message.chat.id, 'Опрос прерван', get_welcome_markup())
+    else:
+        send_question(message.from_user.id, message.chat.id)
 
 
 @tg_bot.message_handler(commands=['help', 'h'])
+@metrics_wrapper
 @message_wrapper
 def help_handler(message: telebot.types.Message):
     """/help handler"""
@@ -382,6 +692,7 @@ def help_handler(message: telebot.types.Message):
 
 
 @tg_bot.message_handler(commands=['role'])
+@metrics_wrapper
 @rule_wrapper(('admin', 'm_admin'))
 @message_wrapper
 def set_role_handler(message: telebot.types.Message):
@@ -397,20 +708,7 @@ def set_role_handler(message: telebot.types.Message):
         target_user_id = int(command_seq[1])
         if len(command_seq) == 2:
             target_user = db_handler.get_user_info(target_user_id)
-            group_dict = {
-                'ban': 'забанен',
-                'user': 'пользователь',
-                'editor': 'редактор',
-                'admin': 'администратор',
-                'm_admin': 'главный администратор'
-            }
-            simple_send_message(
-                message.chat.id,
-                f'ID: {target_user.tg_user_id}\n'
-                f'Внутренний ID: {target_user.internal_user_id}\n'
-                f'Роль: {group_dict[target_user.group]}\n'
-                f'Рассылка: {"включена" if target_user.mailing else "отключена"}'
-            )
+            simple_send_message(message.chat.id, get_user_info_text(target_user))
         elif command_seq[2] in ('user', 'editor', 'admin'):
             target_user = db_handler.get_user_info(target_user_id)
             if target_user.group not in ('m_admin', 'ban'):
@@ -436,6 +734,7 @@ def set_role_handler(message: telebot.types.Message):
 
 
 @tg_bot.message_handler(commands=['ban'])
+@metrics_wrapper
 @rule_wrapper(('admin', 'm_admin'))
 @message_wrapper
 def ban_handler(message: telebot.types.Message):
@@ -455,7 +754,9 @@ def ban_handler(message: telebot.types.Message):
                 ban_reason = ' '.join(command_seq[3:])
                 try:
                     if db_handler.get_user_info(target_id).group != 'm_admin':
-                        db_handler.ban_user(message.from_user.id, target_id, ban_reason, ban_term)
+                        schedule_unban(*db_handler.ban_user(
+                            message.from_user.id, target_id, ban_reason, ban_term
+                        ))
                         simple_send_message(
                             message.chat.id,
                             f'Пользователь с ID {target_id} забанен на {ban_term} по причине'
@@ -480,6 +781,7 @@ def ban_handler(message: telebot.types.Message):
 
 
 @tg_bot.message_handler(commands=['unban'])
+@metrics_wrapper
 @rule_wrapper(('admin', 'm_admin'))
 @message_wrapper
 def unban_handler(message: telebot.types.Message):
@@ -495,16 +797,18 @@ def unban_handler(message: telebot.types.Message):
             reason = None
             if len(command_seq) >= 3:
                 reason = ' '.join(command_seq[3:])
-            db_handler.unban_user(message.from_user.id, int(command_seq[1]), reason)
+            for ban_id in db_handler.unban_user(message.from_user.id, int(command_seq[1]), reason):
+                timer_scheduler.cancel(('unban', ban_id))
             simple_send_message(message.chat.id, 'Пользователь успешно разбанен!')
         else:
             simple_send_message(message.chat.id, 'ID должен состоять только из цифр')
 
 
 @tg_bot.message_handler(commands=['message'])
+@metrics_wrapper
 @rule_wrapper(('admin', 'm_admin'))
 @message_wrapper
-def unban_handler(message: telebot.types.Message):
+def message_handler(message: telebot.types.Message):
     """"/message handler"""
     command_seq = message.text.split()
     if len(command_seq) <= 2:
@@ -515,25 +819,25 @@ def unban_handler(message: telebot.types.Message):
         simple_send_message(message.chat.id, msg_text)
     else:
         if command_seq[1].isdigit():
-            try:
-                simple_send_message(int(command_seq[1]), ' '.join(command_seq[2:]))
-                simple_send_message(message.chat.id, 'Сообщение отправлено!')
-            except KeyboardInterrupt:
-                exit('Interrupted')
-            except Exception as exc:
-                simple_send_message(message.chat.id, f'Exception!\n{type(exc)}\n{exc}')
+            outbound_messages.put(
+                int(command_seq[1]),
+                ' '.join(command_seq[2:]),
+                on_done=functools.partial(report_delivery, message.chat.id)
+            )
         elif command_seq[1] in ('user', 'editor', 'm_admin', 'admin'):
-            if command_seq[1] == 'user':
-                target_ids = db_handler.get_users_id('user', True)
-            else:
-                target_ids = db_handler.get_users_id(command_seq[1])
-            mailing(target_ids, ' '.join(command_seq[2:]))
-            simple_send_message(message.chat.id, 'Рассылка завершена!')
+            job_id = broadcast_engine.start(
+                message.from_user.id,
+                command_seq[1],
+                ' '.join(command_seq[2:]),
+                command_seq[1] == 'user'
+            )
+            simple_send_message(message.chat.id, f'Рассылка №{job_id} запущена!')
         else:
             simple_send_message(message.chat.id, 'Некорректная группа или ID!')
 
 
 @tg_bot.message_handler(commands=['quiz', 'editor'])
+@metrics_wrapper
 @rule_wrapper(('editor', 'admin', 'm_admin'))
 @message_wrapper
 def editor_handler(message: telebot.types.Message):
@@ -542,12 +846,14 @@ def editor_handler(message: telebot.types.Message):
     if len(message_tuple) == 1:
         msg_text = '/quiz - отправляет меню редактора\n' \
                    '/quiz {id} - отправляет результаты опроса\n' \
-                   '/quiz list - отправляет список 10 последних добавленных опросов\n' \
-                   '/quiz vis {id} {status} - установить {status} видимости для опроса с {id}'
+                   '/quiz list [vis] - отправляет список последних [видимых] опросов\n' \
+                   '/quiz vis {id} {status} - установить {status} видимости для опроса с {id}\n' \
+                   '/quiz check {id или all} - сверить счётчики ответов с ответами\n' \
+                   '/quiz rebuild {id или all} - пересчитать счётчики ответов'
         simple_send_message(message.chat.id, msg_text, get_editor_inline_markup())
     elif message_tuple[1] in ('list', ):
-        ans = quiz_list_prepare(message_tuple)
-        simple_send_message(message.chat.id, ans, get_welcome_markup())
+        ans, page_menu = quiz_list_prepare(len(message_tuple) > 2)
+        simple_send_message(message.chat.id, ans, page_menu or get_welcome_markup())
     elif message_tuple[1] in ('vis', ):
         if message_tuple[2].isdigit():
             if message_tuple[3] in ('True', 'False'):
@@ -561,40 +867,51 @@ def editor_handler(message: telebot.types.Message):
         else:
             ans = 'ID должен быть числом!'
         simple_send_message(message.chat.id, ans)
+    elif message_tuple[1] in ('check', 'rebuild'):
+        if len(message_tuple) == 3 and (message_tuple[2].isdigit() or message_tuple[2] == 'all'):
+            target_quiz_id = int(message_tuple[2]) if message_tuple[2].isdigit() else None
+            if message_tuple[1] == 'check':
+                mismatches = db_handler.get_answer_counters_mismatches(target_quiz_id)
+                ans = '\n'.join(
+                    [f'Расхождений в счётчиках: {len(mismatches)}'] +
+                    [f'Опрос {_[0]}, вопрос {_[1]}, ответ "{_[2]}": {_[3]} вместо {_[4]}'
+                     for _ in mismatches[:20]]
+                )
+            else:
+                counters_count = db_handler.rebuild_answer_counters(
+                    message.from_user.id,
+                    target_quiz_id
+                )
+                ans = f'Счётчики ответов пересчитаны: {counters_count}'
+        else:
+            ans = 'ID должен быть числом или all!'
+        simple_send_message(message.chat.id, ans)
     elif message_tuple[1].isdigit():
-        # analytical message
-        analytical_message = db_handler.get_analytical_message(int(message_tuple[1]))
-        file_name_a = 'temp_analytic.txt'
-        with open(file_name_a, 'w', encoding='utf-8') as opened_file:
-            opened_file.write(analytical_message)
-        tg_bot.send_document(message.chat.id, open(file_name_a, 'rb'))
-        # json
-        quiz_json = json.dumps(
-            db_handler.get_quiz_answers(int(message_tuple[1])), ensure_ascii=False
-        )
-        file_name_j = 'temp_json.json'
-        with open(file_name_j, 'w', encoding='utf-8') as opened_file:
-            opened_file.write(quiz_json)
-        tg_bot.send_document(message.chat.id, open(file_name_j, 'rb'))
-        # xlsx-table
-        json_to_write = pandas.read_json(quiz_json)
-        file_name_t = 'temp_table.xlsx'
-        json_to_write.to_excel(file_name_t)
-        tg_bot.send_document(message.chat.id, open(file_name_t, 'rb'))
+        if quiz_reports.submit(int(message_tuple[1]), message.chat.id):
+            simple_send_message(message.chat.id, 'Готовлю отчёт, пришлю его, когда он будет готов')
+        else:
+            simple_send_message(message.chat.id, 'Отчёт по этому опросу уже готовится!')
 # endregion
 
 
 # region types
 @tg_bot.message_handler(content_types='text')
+@metrics_wrapper
 @rule_wrapper(('user', 'editor', 'admin', 'm_admin'))
 @message_wrapper
 def main_message_handler(message: telebot.types.Message):
     """Message handler for all users"""
     if message.text in ('Пройти опрос', 'пройти опрос', 'Ghjqnb jghjc', 'ghjqnb jghjc'):
-        available_quiz_list = db_handler.get_quiz_list(visible=True)
-        completed_quizzes_id = db_handler.get_completed_quizzes_id(message.from_user.id)
-        quizzes_menu = get_available_quiz_inline_markup(available_quiz_list, completed_quizzes_id)
-        if quizzes_menu.keyboard:
+        generation = db_handler.catalog.generation
+        available_quiz_list = db_handler.catalog.get_visible()
+        quiz_progress = db_handler.get_quiz_progress(message.from_user.id)
+        quizzes_menu = get_available_quiz_menu(
+            available_quiz_list,
+            quiz_progress,
+            generation,
+            db_handler.catalog.page_size
+        )
+        if quizzes_menu is not None:
             text_to_send = 'Вам доступны следующие опросы:'
             menu_to_send = quizzes_menu
         else:
@@ -610,29 +927,15 @@ def main_message_handler(message: telebot.types.Message):
         completed_quizzes_id = db_handler.get_completed_quizzes_id(message.from_user.id)
         if completed_quizzes_id:
             last_quiz_id = max(completed_quizzes_id)
-            quiz_r_menu = InlineKeyboardMarkup()
-            answers = db_handler.get_list_of_questions_in_quiz(last_quiz_id)
-            for _ in answers:
-                if _.quest_relation:
-                    quiz_r_menu.add(
-                        InlineKeyboardButton(
-                            text=f'Если на вопрос {_.quest_relation.split(" -> ")[0]} ответ'
-                                 f' "{_.quest_relation.split(" -> ")[1]}": {_.quest_text}',
-                            callback_data=f'quiz_rewrite {_.quiz_id} {_.quest_id}'
-                        )
-                    )
-                else:
-                    quiz_r_menu.add(
-                        InlineKeyboardButton(
-                            text=f'{_.quest_text}',
-                            callback_data=f'quiz_rewrite {_.quiz_id} {_.quest_id}'
-                        )
-                    )
+            quiz_definition = db_handler.get_quiz_definition(last_quiz_id)
+            if quiz_definition is None:
+                simple_send_message(message.chat.id, 'Этот опрос больше недоступен!')
+                return
             simple_send_message(
                 message.chat.id,
                 'Выберите вопрос, ответ на который вы хотели бы изменить\n\nИзменять ответы на'
                 ' вопросы, зависящие от других вопросов, нужно в ручном режиме',
-                quiz_r_menu
+                get_rewrite_menu(quiz_definition)
             )
         else:
             simple_send_message(message.chat.id, 'У Вас ещё нет пройденных опросов!')
@@ -651,33 +954,26 @@ def main_message_handler(message: telebot.types.Message):
         )
     elif message.text == 'Мой статус':
         user = db_handler.get_user_info(message.from_user.id)
-        group_dict = {
-            'ban': 'забанен',
-            'user': 'пользователь',
-            'editor': 'редактор',
-            'admin': 'администратор',
-            'm_admin': 'главный администратор'
-        }
-        simple_send_message(
-            message.chat.id,
-            f'ID: {user.tg_user_id}\n'
-            f'Внутренний ID: {user.internal_user_id}\n'
-            f'Роль: {group_dict[user.group]}\n'
-            f'Рассылка: {"включена" if user.mailing else "отключена"}'
-        )
+        simple_send_message(message.chat.id, get_user_info_text(user))
 
 
 @tg_bot.callback_query_handler(func=lambda call: True)
+@metrics_wrapper
 @callback_wrapper
 def callback_inline(call: telebot.types.CallbackQuery):
     """Callback-data handler"""
 
-    if call.data == 'list':
-        ans = quiz_list_prepare((0, 0))
-        simple_send_message(call.message.chat.id, ans, None)
-    elif call.data == 'visible_list':
-        ans = quiz_list_prepare((0, 0, 0))
-        simple_send_message(call.message.chat.id, ans, None)
+    if call.data in ('list', 'visible_list'):
+        ans, page_menu = quiz_list_prepare(call.data == 'visible_list')
+        simple_send_message(call.message.chat.id, ans, page_menu)
+    elif call.data.split()[0] == 'quiz_page':
+        _, catalog_name, direction, quiz_id = call.data.split()
+        ans, page_menu = quiz_list_prepare(
+            catalog_name == 'visible',
+            int(quiz_id) if direction == 'before' else None,
+            int(quiz_id) if direction == 'after' else None
+        )
+        simple_send_message(call.message.chat.id, ans, page_menu)
     elif call.data == 'get_a_project':
         simple_send_message(call.message.chat.id, 'Вы можете связаться с моим создателем через'
                                                   ' его e-mail: vladchesyan@gmail.com\n\n'
@@ -693,12 +989,19 @@ def callback_inline(call: telebot.types.CallbackQuery):
         mailing(admins_ids, msg_txt)
         simple_send_message(call.message.chat.id, 'Передал администраторам. С Вами скоро свяжутся!')
     elif call.data.split()[0] == 'start_quiz':
-        db_handler.update_user_quiz_status(call.from_user.id, f'{call.data.split()[1]} 1')
+        quiz_id = int(call.data.split()[1])
+        db_handler.start_quiz_session(
+            call.from_user.id,
+            quiz_id,
+            db_handler.get_resume_quest_id(call.from_user.id, quiz_id)
+        )
         send_question(call.from_user.id, call.message.chat.id)
     elif call.data.split()[0] == 'quiz_rewrite':
-        db_handler.update_user_quiz_status(
+        db_handler.start_quiz_session(
             call.from_user.id,
-            f'{call.data.split()[1]} {call.data.split()[2]} r'
+            int(call.data.split()[1]),
+            int(call.data.split()[2]),
+            'rewrite'
         )
         send_question(call.from_user.id, call.message.chat.id)
     elif call.data.split()[0] == 'mailing':
@@ -711,28 +1014,124 @@ def callback_inline(call: telebot.types.CallbackQuery):
 
 
 @tg_bot.message_handler(content_types=['document'])
+@metrics_wrapper
 @document_wrapper
 @rule_wrapper(('editor', 'admin', 'm_admin'))
 def document_handler(message: telebot.types.Message):
     """Document handler (only for add-quiz functions)"""
 
-    file_extension = message.document.file_name.split('.')[-1]
+    file_extension = message.document.file_name.split('.')[-1].lower()
 
-    if file_extension == 'txt':
-        file_name = message.document.file_name
+    if file_extension in ('txt', 'zip'):
+        if message.document.file_size and message.document.file_size > quiz_handler.max_file_size:
+            simple_send_message(
+                message.chat.id,
+                'Файл больше %s КБ' % (quiz_handler.max_file_size // 1024),
+                None
+            )
+            return
         file_id = tg_bot.get_file(message.document.file_id)
-        quiz_handler.dir_check()
-        answer = quiz_handler.download_new_raw_quiz(tg_bot, file_name, file_id)
-        simple_send_message(message.chat.id, answer[0], None)
-        if answer[1]:
-            answer_msg = quiz_handler.new_quiz_handler(file_name, message.from_user.id)
-            simple_send_message(message.chat.id, answer_msg, None)
+        answer_msg = quiz_handler.import_quizzes(
+            message.document.file_name,
+            tg_bot.download_file(file_id.file_path),
+            message.from_user.id
+        )
+        simple_send_message(message.chat.id, answer_msg, None)
 # endregion
 # endregion
 
 
+def log_dispatcher_stats():
+    """Writes queue depth and lag of dispatcher shards and outbound stats to the log"""
+    for index, stats in enumerate(update_dispatcher.get_stats()):
+        init_logger.info('Dispatcher shard %s: %s' % (index, stats))
+    init_logger.info('Outbound messages: %s' % outbound_messages.get_stats())
+
+
+def start_metrics(port: int):
+    """Adds stats of the bot parts to the metrics and starts the endpoint (if port isn't 0)"""
+    for name, get_stats in (
+        ('dispatcher', update_dispatcher.get_stats),
+        ('webhook', lambda: webhook_server.get_stats() if webhook_server else {}),
+        ('outbound', outbound_messages.get_stats),
+        ('message_log_writer', log_writer.message_log_writer.get_stats),
+        ('flood_limiter', flood_limiter.get_stats),
+        ('quiz_definitions', db_handler.quiz_definitions.get_stats),
+        ('quiz_sessions', db_handler.active_sessions.get_stats),
+        ('quiz_catalog', db_handler.catalog.get_stats),
+        ('markups', markups.get_stats),
+        ('quiz_reports', quiz_reports.get_stats),
+        ('log_partitions', log_partitions.get_stats)
+    ):
+        metrics.register_stats(name, get_stats)
+    if port:
+        metrics.MetricsServer(metrics_host, port).start()
+
+
+def process_update_json(update_json: dict):
+    """Hands update from webhook to the handlers"""
+    tg_bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+
+
+def check_webhook_settings():
+    """Stops the bot if webhook_url or webhook_secret isn't set (it would get no updates)"""
+    if not webhook_url or not webhook_secret:
+        exit('Webhook mode needs webhook_url and webhook_secret in vars.env')
+
+
+def get_webhook_path() -> str:
+    """Returns path of webhook_url (the webhook server accepts updates only there)"""
+    return urllib.parse.urlparse(webhook_url).path or '/'
+
+
+def start_webhook():
+    """Starts webhook server and registers webhook_url in Telegram"""
+    global webhook_server
+    check_webhook_settings()
+    webhook_server = webhook.WebhookServer(
+        process_update_json,
+        webhook_secret,
+        webhook_host,
+        webhook_port,
+        get_webhook_path()
+    )
+    webhook_server.start()
+    tg_bot.remove_webhook()
+    tg_bot.set_webhook(url=webhook_url, secret_token=webhook_secret)
+    init_logger.info('Webhook is set to %s' % webhook_url)
+
+
+def start_cluster_worker(index: int = 0):
+    """Starts services of a cluster worker, singleton jobs wait for the leader lease
+
+    :param index: number of the worker, its metrics endpoint is on {metrics_port} + 1 + {index}
+    :return: None
+    """
+    global leader_lease
+    stop_singleton_jobs()
+    db_handler.warm_quiz_cache()
+    log_writer.message_log_writer.start()
+    outbound_messages.start()
+    update_dispatcher.start()
+    start_metrics(metrics_port + 1 + index if metrics_port else 0)
+    timer_scheduler.schedule_every(datetime.timedelta(minutes=5), 'dispatcher_stats',
+                                   log_dispatcher_stats)
+    timer_scheduler.start()
+    leader_lease = cluster.LeaderLease(
+        db_handler.engine,
+        cluster_lock_id,
+        start_singleton_jobs,
+        stop_singleton_jobs
+    )
+    leader_lease.start()
+
+
 def main():
     """Main loop"""
+    if run_mode == 'webhook':
+        start_webhook()
+        return
+    tg_bot.remove_webhook()  # polling doesn't work while webhook is set
     if is_looped:
         while True:
             try:
@@ -749,8 +1148,17 @@ def main():
 
 
 if __name__ == '__main__':
-    unban_thread = threading.Thread(target=auto_unban, daemon=True)
-    unban_thread.start()
+    migrations.upgrade()
+    receiver_lock = cluster.take_receiver_lock(db_handler.engine)
+    db_handler.warm_quiz_cache()
+    log_writer.message_log_writer.start()
+    outbound_messages.start()
+    update_dispatcher.start()
+    start_metrics(metrics_port)
+    start_singleton_jobs()
+    timer_scheduler.schedule_every(datetime.timedelta(minutes=5), 'dispatcher_stats',
+                                   log_dispatcher_stats)
+    timer_scheduler.start()
     bot_thread = threading.Thread(target=main, daemon=True)
     bot_thread.start()
     while True:
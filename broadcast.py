@@ -0,0 +1,276 @@
+"""
+Concurrent mailings (/message {group}) within Telegram limits.
+
+Job state is kept in 'mailing_job' and 'mailing_recipient', so a restarted bot continues
+unfinished mailings with the recipients who haven't got the message yet.
+"""
+
+
+import datetime
+import queue
+import threading
+import time
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+import db_handler
+import rate_limiter
+from bot_init import init_logger
+
+
+class AdaptiveRate:
+    """Global pacing of sent messages
+
+    Starts with {rate} messages per second. A 429 response pauses everybody for retry_after
+    seconds and halves the rate, every {recovery} successful messages add one message per second
+    back (but no more than {max_rate}).
+    """
+
+    def __init__(self, rate: float = 25, max_rate: float = 28, min_rate: float = 1,
+                 recovery: int = 100):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.successes = 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Waits for the next free slot"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + 1 / self.rate
+        time.sleep(max(0.0, slot - now))
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.recovery:
+                self.successes = 0
+                self.rate = min(self.max_rate, self.rate + 1)
+
+    def on_too_many_requests(self, retry_after: float):
+        with self.lock:
+            self.successes = 0
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.next_time = max(self.next_time, time.monotonic() + retry_after)
+
+
+class BroadcastEngine:
+    """Sends mailings with several threads
+
+    Call this with the bot (telebot.TeleBot) and markup for mailing messages. The initiator gets a
+    progress message which is edited every {progress_interval} seconds. Messages are paced by
+    {rate} (a new AdaptiveRate if it's None).
+
+    Jobs are run only while run_jobs is True: in cluster mode it's switched by the leader lease,
+    stopped jobs stay active in the DB and are continued by resume() of the next leader.
+    Recipients are taken from the DB by batches of {batch_size} (see
+    db_handler.claim_mailing_recipients), so a new leader doesn't send to the recipients which the
+    old one is still sending to. Recipients taken by a process which has died are taken again after
+    {claim_timeout}.
+    """
+
+    def __init__(self, bot, reply_markup=None, workers: int = 8, max_attempts: int = 5,
+                 per_chat_period: float = 1.0, progress_interval: float = 5.0,
+                 rate: AdaptiveRate = None, batch_size: int = 500,
+                 claim_timeout: datetime.timedelta = datetime.timedelta(minutes=15)):
+        self.bot = bot
+        self.reply_markup = reply_markup
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.per_chat_period = per_chat_period
+        self.progress_interval = progress_interval
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self.rate = rate or AdaptiveRate()
+        self.chat_limiter = rate_limiter.LocalBackend()
+        self.running_jobs = set()
+        self.run_jobs = True
+        self.lock = threading.Lock()
+
+    def start(self, initiator_tg_id, group: str, msg_text: str, mailing: bool = False) -> int:
+        """Creates and starts a new mailing job
+
+        :param initiator_tg_id: admin id, progress messages go to this chat
+        :param group: target group of users (see db_handler.get_users_id)
+        :param msg_text: message for users
+        :param mailing: whether users with disabled mailing will be skipped
+        :return: job id
+        """
+        job_id = db_handler.add_mailing_job(initiator_tg_id, group, msg_text, mailing)
+        if self.run_jobs:
+            self.run_in_thread(job_id, initiator_tg_id, msg_text, None)
+        return job_id
+
+    def resume(self):
+        """Starts unfinished jobs which aren't running in this process (it's called periodically)"""
+        for job in db_handler.get_active_mailing_jobs():
+            self.run_in_thread(job.job_id, job.initiator_tg_id, job.msg_text, job.progress_msg_id)
+
+    def run_in_thread(self, job_id, initiator_tg_id, msg_text, progress_msg_id):
+        with self.lock:
+            if job_id in self.running_jobs:
+                return
+            self.running_jobs.add(job_id)
+        threading.Thread(
+            target=self.run,
+            args=(job_id, initiator_tg_id, msg_text, progress_msg_id),
+            name=f'mailing_{job_id}',
+            daemon=True
+        ).start()
+
+    def run(self, job_id, initiator_tg_id, msg_text, progress_msg_id):
+        try:
+            self.run_job(job_id, initiator_tg_id, msg_text, progress_msg_id)
+        except Exception as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+        finally:
+            with self.lock:
+                self.running_jobs.discard(job_id)
+
+    def run_job(self, job_id, initiator_tg_id, msg_text, progress_msg_id):
+        counts = db_handler.get_mailing_job_counts(job_id)
+        pending = queue.Queue()
+        results = queue.Queue()
+        finished = threading.Event()
+        workers = [
+            threading.Thread(
+                target=self.send_worker,
+                args=(pending, results, msg_text, finished),
+                daemon=True
+            ) for _ in range(self.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            self.process_recipients(
+                job_id, initiator_tg_id, progress_msg_id, counts, pending, results, workers
+            )
+        finally:
+            finished.set()
+
+    def process_recipients(self, job_id, initiator_tg_id, progress_msg_id, counts, pending,
+                           results, workers):
+        """Takes recipients from the DB for the workers and saves results of sending"""
+        started = time.monotonic()
+        processed_now = 0
+        last_progress = 0
+        statuses = {'sent': [], 'failed': []}
+        taken = 0  # recipients taken from the DB and not reported by the workers yet
+        is_exhausted = False
+        while True:
+            if self.run_jobs and not is_exhausted and pending.qsize() < self.batch_size // 2:
+                batch = db_handler.claim_mailing_recipients(
+                    job_id, self.batch_size, self.claim_timeout
+                )
+                is_exhausted = len(batch) < self.batch_size
+                for tg_user_id in batch:
+                    pending.put((tg_user_id, 0))
+                taken += len(batch)
+            if not self.run_jobs:
+                # recipients which aren't being sent go back to the DB for the next leader
+                released = []
+                while not pending.empty():
+                    released.append(pending.get_nowait()[0])
+                taken -= len(released)
+                db_handler.update_mailing_recipients(job_id, {'pending': released})
+            if taken == 0 and (is_exhausted or not self.run_jobs):
+                break
+            if not any(worker.is_alive() for worker in workers) and results.empty() and \
+                    pending.empty():
+                break
+            try:
+                tg_user_id, send_status = results.get(timeout=1)
+                statuses[send_status].append(tg_user_id)
+                taken -= 1
+            except queue.Empty:
+                pass
+            if sum(len(i) for i in statuses.values()) >= 500 or \
+                    time.monotonic() - last_progress >= self.progress_interval:
+                for send_status, users_id in statuses.items():
+                    counts[send_status] += len(users_id)
+                    counts['pending'] -= len(users_id)
+                    processed_now += len(users_id)
+                db_handler.update_mailing_recipients(job_id, statuses)
+                statuses = {'sent': [], 'failed': []}
+            if time.monotonic() - last_progress >= self.progress_interval:
+                last_progress = time.monotonic()
+                speed = processed_now / max(last_progress - started, 0.001)
+                progress_msg_id = self.report(
+                    initiator_tg_id, progress_msg_id, job_id, counts, speed, False
+                )
+
+        for send_status, users_id in statuses.items():
+            counts[send_status] += len(users_id)
+            counts['pending'] -= len(users_id)
+            processed_now += len(users_id)
+        db_handler.update_mailing_recipients(job_id, statuses)
+        if not self.run_jobs:
+            init_logger.info('Mailing %s is stopped: %s' % (job_id, counts))
+            return
+        counts = db_handler.get_mailing_job_counts(job_id)
+        if counts['pending']:
+            # the job stays active, resume() continues it
+            init_logger.error('Mailing %s has unsent recipients: %s' % (job_id, counts))
+            return
+        db_handler.update_mailing_job(job_id, job_status='done')
+        speed = processed_now / max(time.monotonic() - started, 0.001)
+        self.report(initiator_tg_id, progress_msg_id, job_id, counts, speed, True)
+        init_logger.info('Mailing %s is finished: %s' % (job_id, counts))
+
+    def send_worker(self, pending: queue.Queue, results: queue.Queue, msg_text: str,
+                    finished: threading.Event):
+        while self.run_jobs and not finished.is_set():
+            try:
+                tg_user_id, attempt = pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not self.chat_limiter.consume(str(tg_user_id), 1, self.per_chat_period):
+                pending.put((tg_user_id, attempt))
+                time.sleep(self.per_chat_period / 10)
+                continue
+            self.rate.wait()
+            try:
+                self.bot.send_message(tg_user_id, msg_text, reply_markup=self.reply_markup)
+                self.rate.on_success()
+                results.put((tg_user_id, 'sent'))
+            except ApiTelegramException as exc:
+                if exc.error_code == 429 and attempt < self.max_attempts:
+                    retry_after = exc.result_json.get('parameters', {}).get('retry_after', 1)
+                    self.rate.on_too_many_requests(retry_after)
+                    pending.put((tg_user_id, attempt + 1))
+                else:
+                    # blocked bot, deleted account and so on
+                    results.put((tg_user_id, 'failed'))
+            except requests.exceptions.RequestException:
+                if attempt < self.max_attempts:
+                    time.sleep(min(30, 2 ** attempt))
+                    pending.put((tg_user_id, attempt + 1))
+                else:
+                    results.put((tg_user_id, 'failed'))
+            except Exception as exc:
+                # the recipient is already taken from the queue, the worker must report it
+                init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+                results.put((tg_user_id, 'failed'))
+
+    def report(self, initiator_tg_id, progress_msg_id, job_id, counts, speed, is_finished):
+        """Sends or edits progress message, returns its id"""
+        total = sum(counts.values())
+        msg_text = f'{"Рассылка завершена" if is_finished else "Рассылка"} №{job_id}\n' \
+                   f'Отправлено: {counts["sent"]} из {total}\n' \
+                   f'Ошибок: {counts["failed"]}\n' \
+                   f'Скорость: {speed:.1f} сообщ./с\n' \
+                   f'Обновлено: {datetime.datetime.now().strftime("%H:%M:%S")}'
+        try:
+            if progress_msg_id is None:
+                progress_msg_id = self.bot.send_message(initiator_tg_id, msg_text).message_id
+                db_handler.update_mailing_job(job_id, progress_msg_id=progress_msg_id)
+            else:
+                self.bot.edit_message_text(msg_text, initiator_tg_id, progress_msg_id)
+        except (ApiTelegramException, requests.exceptions.RequestException) as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+        return progress_msg_id
@@ -0,0 +1,180 @@
+"""
+Cluster mode: python cluster.py [workers] instead of python bot_body.py.
+
+The main process receives updates through the webhook and routes them to worker processes by tg
+user id (so updates of one user are handled in order by one process). Singleton jobs (unbans and
+mailings) run only in the process which holds the leader lease - PostgreSQL advisory lock, so an
+old cluster which is still stopping never runs them together with the new one.
+
+Quiz sessions, quiz definitions and the quiz catalog are cached in every worker and stay right
+only while all updates of the bot come to one main process, so it holds the receiver lock (see
+take_receiver_lock): a second cluster, on this host or another one, doesn't start.
+"""
+
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+import sqlalchemy
+import telebot
+
+import bot_init
+import dispatcher
+import webhook
+from bot_init import init_logger
+from env_vars import load_vars
+
+
+class LeaderLease:
+    """Leader election with PostgreSQL session-level advisory lock
+
+    Call this with engine (sqlalchemy.engine.Engine), lock id (the same in all processes) and
+    callbacks. Every {interval} seconds a follower tries to take the lock and the leader checks its
+    connection. The lock belongs to the connection, so if the leader process dies or loses the
+    database, PostgreSQL releases it and another process becomes the leader.
+    """
+
+    def __init__(self, engine, lock_id: int, on_elected, on_revoked, interval: float = 10):
+        self.engine = engine
+        self.lock_id = lock_id
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.interval = interval
+        self.connection = None
+        self.is_leader = False
+
+    def start(self):
+        threading.Thread(target=self.run, name='leader_lease', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                if self.is_leader:
+                    self.connection.execute(sqlalchemy.text('SELECT 1'))
+                else:
+                    self.try_acquire()
+            except Exception as exc:
+                init_logger.error('Leader lease exception: %s\n%s' % (type(exc), exc))
+                self.release()
+            time.sleep(self.interval)
+
+    def try_acquire(self):
+        if self.connection is None:
+            self.connection = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        statement = sqlalchemy.text('SELECT pg_try_advisory_lock(:lock_id)')
+        if self.connection.execute(statement, {'lock_id': self.lock_id}).scalar():
+            self.is_leader = True
+            init_logger.info('Process %s is the leader now' % os.getpid())
+            self.on_elected()
+
+    def release(self):
+        """Closes the lease connection (the lock is released with it)"""
+        if self.is_leader:
+            self.is_leader = False
+            init_logger.info('Process %s is not the leader anymore' % os.getpid())
+            self.on_revoked()
+        if self.connection is not None:
+            try:
+                self.connection.invalidate()
+            except Exception as exc:
+                init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+            self.connection = None
+
+
+def take_receiver_lock(engine):
+    """Takes the advisory lock of the process which receives updates of the bot
+
+    bot_body.py, async_bot.py and cluster.py take it at start, so the bot has one receiver and
+    the caches of its processes are never outdated by updates handled somewhere else. Returns the
+    connection which holds the lock (keep it open) or exits if another process holds it.
+    """
+    lock_id = int(os.environ.get('receiver_lock_id', 7318003))
+    connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    statement = sqlalchemy.text('SELECT pg_try_advisory_lock(:lock_id)')
+    if not connection.execute(statement, {'lock_id': lock_id}).scalar():
+        connection.close()
+        exit('Another bot process already receives updates (advisory lock %s)' % lock_id)
+    return connection
+
+
+def run_worker(index: int, updates_queue):
+    """Worker process: handles updates from {updates_queue}"""
+    import bot_body
+
+    bot_body.start_cluster_worker(index)
+    init_logger.info('Cluster worker %s is started (pid %s)' % (index, os.getpid()))
+    while True:
+        update_json = updates_queue.get()
+        try:
+            bot_body.process_update_json(update_json)
+        except Exception as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+
+
+def start_worker(context, index: int, updates_queue):
+    process = context.Process(
+        target=run_worker,
+        args=(index, updates_queue),
+        name=f'cluster_worker_{index}',
+        daemon=True
+    )
+    process.start()
+    return process
+
+
+def main():
+    """Migrates the database, starts workers and the webhook server, restarts dead workers"""
+    import db_handler
+    import migrations
+
+    load_vars()
+    workers_count = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    queue_size = int(os.environ.get('dispatcher_queue_size', 100))
+    webhook_url = os.environ.get('webhook_url')
+    webhook_secret = os.environ.get('webhook_secret')
+    if not webhook_url or not webhook_secret:
+        exit('Cluster mode needs webhook_url and webhook_secret in vars.env')
+
+    migrations.upgrade()
+    receiver_lock = take_receiver_lock(db_handler.engine)
+    context = multiprocessing.get_context('spawn')
+    updates_queues = [context.Queue(queue_size) for _ in range(workers_count)]
+    processes = [
+        start_worker(context, index, updates_queue)
+        for index, updates_queue in enumerate(updates_queues)
+    ]
+
+    def route_update(update_json: dict):
+        # blocks while the queue is full, then the webhook answers 503
+        user_id = dispatcher.get_update_json_user_id(update_json)
+        updates_queues[user_id % workers_count].put(update_json)
+
+    webhook_server = webhook.WebhookServer(
+        route_update,
+        webhook_secret,
+        os.environ.get('webhook_host', '0.0.0.0'),
+        int(os.environ.get('webhook_port', 8080)),
+        urllib.parse.urlparse(webhook_url).path or '/',
+        queue_size
+    )
+    webhook_server.start()
+    tg_bot = telebot.TeleBot(bot_init.get_bot_api_token())
+    tg_bot.remove_webhook()
+    tg_bot.set_webhook(url=webhook_url, secret_token=webhook_secret)
+    init_logger.info('Webhook is set to %s, workers: %s' % (webhook_url, workers_count))
+
+    while receiver_lock is not None:  # the connection keeps the lock while the cluster works
+        time.sleep(5)
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                init_logger.error('Cluster worker %s has died (exit code %s), restarting'
+                                  % (index, process.exitcode))
+                processes[index] = start_worker(context, index, updates_queues[index])
+
+
+if __name__ == '__main__':
+    main()
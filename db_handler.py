@@ -1,6 +1,5 @@
 import datetime
 import os
-import time
 
 import sqlalchemy
 from sqlalchemy import BOOLEAN
@@ -10,11 +9,15 @@ from sqlalchemy import INTEGER
 from sqlalchemy import TEXT
 from sqlalchemy import TIMESTAMP
 from sqlalchemy import VARCHAR
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.sql import insert
 from sqlalchemy.sql import select
 
-import quiz_handler
+import quiz_cache
+import quiz_catalog
+import quiz_sessions
 from bot_init import init_logger
 from env_vars import load_vars
 
@@ -47,7 +50,7 @@ class User(Base):
     __tablename__ = 'user'
     internal_user_id = Column(INTEGER, primary_key=True)  # only internal user_id
     tg_user_id = Column(INTEGER, unique=True)  # tg id
-    quiz_status = Column(VARCHAR(12), nullable=True)  # current quiz id (0 - no current quiz)
+    quiz_status = Column(VARCHAR(12), nullable=True)  # old format of quiz session (see QuizSession)
     is_ban = Column(BOOLEAN, default=0)  # ban status where 0 - unbanned and 1 - banned
     group = Column(VARCHAR(30), default='user')  # group in (m_admin, admin, editor or user)
     mailing = Column(BOOLEAN, default=1)  # mailing status where 0 - disable and 1 - enable
@@ -63,13 +66,21 @@ class User(Base):
 
 
 class MessageLog(Base):
-    """Create table 'message_log'"""
+    """Create table 'message_log'
+
+    Partitioned by month of msg_timestamp (see log_partitions), so the timestamp is a part of the
+    primary key. There is no foreign key: old partitions are dropped regardless of users.
+    """
     __tablename__ = 'message_log'
-    internal_msg_id = Column(INTEGER, primary_key=True)  # only internal msg_id
-    tg_user_id = Column(INTEGER, ForeignKey('user.tg_user_id'))  # tg sender id
+    __table_args__ = (
+        sqlalchemy.Index('ix_message_log_tg_user_id', 'tg_user_id', 'msg_timestamp'),
+        {'postgresql_partition_by': 'RANGE (msg_timestamp)'}
+    )
+    internal_msg_id = Column(INTEGER, primary_key=True, autoincrement=True)  # internal msg_id
+    tg_user_id = Column(INTEGER)  # tg sender id
     msg_tg_id = Column(INTEGER)  # message id in chat
     msg_text = Column(TEXT)  # text from message
-    msg_timestamp = Column(TIMESTAMP)  # seconds since the epoch
+    msg_timestamp = Column(TIMESTAMP, primary_key=True)  # seconds since the epoch
 
     def get_short_dict(self):
         return {
@@ -136,13 +147,37 @@ class QuestionsAnswers(Base):
         }
 
 
+class AnswerCounters(Base):
+    """Create table 'answer_counters'
+
+    Number of each answer to each question, changes in the same transaction as answers
+    """
+    __tablename__ = 'answer_counters'
+    quiz_id = Column(INTEGER, ForeignKey('quiz_list.quiz_id'), primary_key=True)  # quiz_id
+    quest_id = Column(INTEGER, primary_key=True)  # quest_id
+    answer = Column(TEXT, primary_key=True)  # text of answer
+    answer_count = Column(INTEGER, default=0)  # number of such answers
+
+    def get_short_dict(self):
+        return {
+            'quiz_id': self.quiz_id,
+            'quest_id': self.quest_id,
+            'answer': self.answer,
+            'answer_count': self.answer_count
+        }
+
+
 class Logs(Base):
-    """Create table 'logs'"""
+    """Create table 'logs'
+
+    Partitioned by month of event_timestamp (see log_partitions)
+    """
     __tablename__ = 'logs'
-    event_id = Column(INTEGER, primary_key=True)  # internal event id
+    __table_args__ = {'postgresql_partition_by': 'RANGE (event_timestamp)'}
+    event_id = Column(INTEGER, primary_key=True, autoincrement=True)  # internal event id
     event_msg = Column(TEXT)  # info-message such as "added new user with {params}"
     event_initiator = Column(VARCHAR(20))  # initiator such as {internal_user_id} or 'system'
-    event_timestamp = Column(TIMESTAMP)  # seconds since the epoch
+    event_timestamp = Column(TIMESTAMP, primary_key=True)  # seconds since the epoch
 
     def get_short_dict(self):
         return {
@@ -173,7 +208,91 @@ class BanList(Base):
         }
 
 
-Base.metadata.create_all(engine)
+class MailingJob(Base):
+    """Create table 'mailing_job'"""
+    __tablename__ = 'mailing_job'
+    job_id = Column(INTEGER, primary_key=True)  # internal job id
+    initiator_tg_id = Column(INTEGER, ForeignKey('user.tg_user_id'))  # user-initiator id
+    target_group = Column(VARCHAR(30))  # group of recipients
+    msg_text = Column(TEXT)  # message for users
+    job_status = Column(VARCHAR(12), default='active')  # 'active' or 'done'
+    created_time = Column(TIMESTAMP)  # creation time
+    progress_msg_id = Column(INTEGER, nullable=True)  # id of progress message in initiator chat
+
+    def get_short_dict(self):
+        return {
+            'job_id': self.job_id,
+            'initiator_tg_id': self.initiator_tg_id,
+            'target_group': self.target_group,
+            'job_status': self.job_status
+        }
+
+
+class MailingRecipient(Base):
+    """Create table 'mailing_recipient'"""
+    __tablename__ = 'mailing_recipient'
+    job_id = Column(INTEGER, ForeignKey('mailing_job.job_id'), primary_key=True)  # job id
+    tg_user_id = Column(INTEGER, primary_key=True)  # recipient tg id
+    send_status = Column(VARCHAR(12), default='pending')  # 'pending', 'sending', 'sent' or 'failed'
+    claimed_at = Column(TIMESTAMP)  # when a process took the recipient for sending
+
+
+class QuizSession(Base):
+    """Create table 'quiz_session'"""
+    __tablename__ = 'quiz_session'
+    tg_user_id = Column(INTEGER, ForeignKey('user.tg_user_id'), primary_key=True)  # user tg id
+    quiz_id = Column(INTEGER, ForeignKey('quiz_list.quiz_id'))  # current quiz
+    quest_id = Column(INTEGER)  # current question
+    mode = Column(VARCHAR(10), default='answer')  # 'answer' or 'rewrite'
+    started_at = Column(TIMESTAMP)  # start of the session
+    last_activity = Column(TIMESTAMP, index=True)  # last answer (for timeouts)
+
+    def get_short_dict(self):
+        return {
+            'tg_user_id': self.tg_user_id,
+            'quiz_id': self.quiz_id,
+            'quest_id': self.quest_id,
+            'mode': self.mode
+        }
+
+
+class QuizCompletion(Base):
+    """Create table 'quiz_completion'
+
+    Quizzes started by users, completed_at is NULL while the quiz is answered partially
+    """
+    __tablename__ = 'quiz_completion'
+    internal_user_id = Column(INTEGER, ForeignKey('user.internal_user_id'), primary_key=True)
+    quiz_id = Column(INTEGER, ForeignKey('quiz_list.quiz_id'), primary_key=True)  # quiz_id
+    completed_at = Column(TIMESTAMP, nullable=True)  # time of the last answer
+
+    def get_short_dict(self):
+        return {
+            'internal_user_id': self.internal_user_id,
+            'quiz_id': self.quiz_id,
+            'completed_at': self.completed_at
+        }
+
+
+class QuizUpload(Base):
+    """Create table 'quiz_upload'
+
+    Imported quiz files by content hash, the same file isn't imported twice
+    """
+    __tablename__ = 'quiz_upload'
+    content_hash = Column(VARCHAR(64), primary_key=True)  # sha256 of the file
+    file_name = Column(VARCHAR(256))  # name of the uploaded file
+    initiator_tg_id = Column(INTEGER)  # user-initiator id
+    quizzes_count = Column(INTEGER)  # number of added quizzes
+    uploaded_at = Column(TIMESTAMP)
+
+    def get_short_dict(self):
+        return {
+            'content_hash': self.content_hash,
+            'file_name': self.file_name,
+            'quizzes_count': self.quizzes_count
+        }
+
 
 
 # service functions
@@ -209,69 +328,182 @@ def convert_to_timedelta(term: str) -> datetime.timedelta:
     return time_delta
 
 
-def dict_analytic(input_dict: dict, questions_info: list[QuizQuestions]):
-    """Prepare analytical message"""
-    general_answers_seq = []
-    for answers_dict in input_dict.values():
-        answer_seq = []
-        for answer in answers_dict.values():
-            answer_seq.append(answer)
-        while len(answer_seq) < len(questions_info):
-            answer_seq.append(None)
-        general_answers_seq.append(answer_seq)
-    analytical_list = seq_analytic(general_answers_seq)
-    info_analytical_list = []
-    for index in range(len(analytical_list)):
-        info_string = f'{questions_info[index].quest_text}\nСамый популярный ответ' \
-                      f' ({analytical_list[index][1]}%): {analytical_list[index][0]}'
-        info_analytical_list.append(info_string)
-    return '\n'.join(info_analytical_list)
-
-
-def seq_analytic(input_seq: list[list], output_seq: list or None = None) -> list:
-    """Recursive sequence traversal"""
-    if output_seq is None:
-        output_seq = list()
-    temp_dict = dict()
-    second_seq = list()
-    for user_answers in input_seq:
-        if user_answers[0] not in temp_dict:
-            temp_dict[user_answers[0]] = 1
-        else:
-            temp_dict[user_answers[0]] += 1
+def get_internal_user_id_subquery(tg_id):
+    """Returns scalar subquery with internal user id, so it doesn't need a separate request"""
+    return select(User.internal_user_id).where(User.tg_user_id == tg_id).scalar_subquery()
 
-    frequent_answer = max(temp_dict, key=temp_dict.get)
-    output_seq.append((frequent_answer,
-                       round(temp_dict[frequent_answer] / len(input_seq) * 100, 2)))
 
-    for user_answers in input_seq:
-        if len(user_answers) > 0 and user_answers[0] == frequent_answer:
-            second_seq.append(user_answers[1:])
+def get_answer_counters_statement(quiz_id, changes: dict):
+    """Returns upsert-statement for 'answer_counters' or None if there is nothing to change
 
-    if len(second_seq[0]) > 0:
-        seq = seq_analytic(second_seq, output_seq)
-    else:
-        seq = output_seq
+    :param quiz_id: quiz id
+    :param changes: {(quest_id, answer_text): delta}
+    """
+    changes = {key: delta for key, delta in changes.items() if delta and key[1] is not None}
+    if not changes:
+        return None
+    statement = postgresql.insert(AnswerCounters).values([
+        {'quiz_id': quiz_id, 'quest_id': quest_id, 'answer': answer, 'answer_count': delta}
+        # the same order in every transaction, so concurrent answers can't deadlock
+        for (quest_id, answer), delta in sorted(changes.items(), key=lambda i: str(i[0]))
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[AnswerCounters.quiz_id, AnswerCounters.quest_id, AnswerCounters.answer],
+        set_={'answer_count': AnswerCounters.answer_count + statement.excluded.answer_count}
+    )
+    return statement
 
-    return seq
 
+def get_answers_lock_statement(quiz_id):
+    """Returns select-statement which locks row of the quiz in 'quiz_list' FOR KEY SHARE
+
+    Inserting an answer takes the same lock (foreign key check), so rewritten answers wait for
+    rebuild_answer_counters of their quiz too.
+    """
+    return select(QuizList.quiz_id).where(QuizList.quiz_id == quiz_id).\
+        with_for_update(read=True, key_share=True)
 
-# requests
-# get-requests
-def get_last_timestamp(tg_id) -> datetime.datetime:
-    """Return time of last message
 
-    Can't use with REALLY new user!
+def change_answer_counters(session: Session, quiz_id, changes: dict):
+    """Changes 'answer_counters' within the session transaction
 
-    :param tg_id: telegram user id
-    :return: time of last message
+    :param session: current session
+    :param quiz_id: quiz id
+    :param changes: {(quest_id, answer_text): delta}
+    :return: None
+    """
+    statement = get_answer_counters_statement(quiz_id, changes)
+    if statement is not None:
+        session.execute(statement)
+
+
+# quiz definitions cache
+def load_quiz_definitions(quiz_ids: list or tuple) -> dict:
+    """Loads quizzes with their questions for quiz_cache.QuizCache
+
+    :param quiz_ids: target quiz ids
+    :return: {quiz_id: (quiz_name, gratitude, tuple of quiz_cache.CachedQuestion)}
     """
-    with Session(engine) as timestamp_session:
-        statement = (select(MessageLog.msg_timestamp).where(MessageLog.tg_user_id == tg_id))
-        res = timestamp_session.scalars(statement).all()
-        return res[-1]
+    with Session(engine) as quiz_definitions_session:
+        statement = select(QuizList).where(QuizList.quiz_id.in_(quiz_ids))
+        quizzes = quiz_definitions_session.scalars(statement).all()
+        statement = select(QuizQuestions).where(QuizQuestions.quiz_id.in_(quiz_ids)).\
+            order_by(QuizQuestions.quiz_id, QuizQuestions.quest_id)
+        questions = dict()
+        for question in quiz_definitions_session.scalars(statement).all():
+            questions.setdefault(question.quiz_id, []).append(quiz_cache.CachedQuestion(
+                question.quiz_id,
+                question.quest_id,
+                question.quest_relation,
+                question.quest_text,
+                question.quest_ans,
+                tuple(question.quest_ans.split(' || '))
+            ))
+        return {
+            quiz.quiz_id: (
+                quiz.quiz_name,
+                quiz.quiz_gratitude,
+                tuple(questions.get(quiz.quiz_id, ()))
+            ) for quiz in quizzes
+        }
+
 
+def log_plan_errors(quiz_id: int, errors: list):
+    """Logs relations of quiz {quiz_id} which can't be compiled (such questions are always asked)"""
+    init_logger.error('Broken relations in quiz %s: %s' % (quiz_id, '; '.join(errors)))
 
+
+quiz_definitions = quiz_cache.QuizCache(load_quiz_definitions, log_plan_errors)
+
+
+def warm_quiz_cache():
+    """Loads definitions of all visible quizzes into the cache"""
+    with Session(engine) as warm_cache_session:
+        statement = select(QuizList.quiz_id).where(QuizList.quiz_status == True)
+        quiz_ids = warm_cache_session.scalars(statement).all()
+    quiz_definitions.warm(quiz_ids)
+    init_logger.info('Quiz cache is warmed up with %s quizzes' % len(quiz_ids))
+
+
+def get_quiz_definition(quiz_id) -> quiz_cache.QuizDefinition or None:
+    """Return cached quiz definition (quiz_cache.QuizDefinition) or None if there is no such one"""
+    return quiz_definitions.get(int(quiz_id))
+
+
+# quiz sessions cache
+quiz_session_timeout = datetime.timedelta(hours=int(os.environ.get('quiz_session_timeout', 24)))
+active_sessions = quiz_sessions.ActiveSessions(
+    quiz_session_timeout,
+    int(os.environ.get('quiz_session_cache_size', 100000))
+)
+
+
+def get_session_state(quiz_session: QuizSession or None) -> quiz_sessions.SessionState or None:
+    """Converts db_handler.QuizSession into quiz_sessions.SessionState"""
+    if quiz_session is None:
+        return None
+    return quiz_sessions.SessionState(
+        quiz_session.quiz_id,
+        quiz_session.quest_id,
+        quiz_session.mode,
+        quiz_session.started_at,
+        quiz_session.last_activity
+    )
+
+
+def get_session_upsert_statement(tg_id, state: quiz_sessions.SessionState):
+    """Returns statement which creates or replaces quiz session of user"""
+    statement = postgresql.insert(QuizSession).values(tg_user_id=tg_id, **state._asdict())
+    return statement.on_conflict_do_update(
+        index_elements=[QuizSession.tg_user_id],
+        set_=state._asdict()
+    )
+
+
+def get_session_step_statement(tg_id, quiz_id, next_quest_id: int or None):
+    """Returns statement which moves user to the next question or ends the session (if None)"""
+    if next_quest_id is None:
+        return sqlalchemy.delete(QuizSession).where(QuizSession.tg_user_id == tg_id)
+    return sqlalchemy.update(QuizSession).where(
+        QuizSession.tg_user_id == tg_id,
+        QuizSession.quiz_id == quiz_id
+    ).values(quest_id=next_quest_id, last_activity=datetime.datetime.now())
+
+
+def get_quiz_start_statement(tg_id, quiz_id):
+    """Returns statement which marks quiz as started by user (if it isn't marked yet)"""
+    return postgresql.insert(QuizCompletion).values(
+        internal_user_id=get_internal_user_id_subquery(tg_id),
+        quiz_id=quiz_id
+    ).on_conflict_do_nothing()
+
+
+def get_quiz_completion_statement(tg_id, quiz_id):
+    """Returns statement which marks quiz as completed by user (the first completion is kept)"""
+    statement = postgresql.insert(QuizCompletion).values(
+        internal_user_id=get_internal_user_id_subquery(tg_id),
+        quiz_id=quiz_id,
+        completed_at=datetime.datetime.now()
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[QuizCompletion.internal_user_id, QuizCompletion.quiz_id],
+        set_={'completed_at': sqlalchemy.func.coalesce(
+            QuizCompletion.completed_at,
+            statement.excluded.completed_at
+        )}
+    )
+
+
+def get_next_session_state(state: quiz_sessions.SessionState or None,
+                           next_quest_id: int or None) -> quiz_sessions.SessionState or None:
+    """Returns session state after get_session_step_statement"""
+    if state is None or next_quest_id is None:
+        return None
+    return state._replace(quest_id=next_quest_id, last_activity=datetime.datetime.now())
+
+
+# requests
+# get-requests
 def get_user_info(tg_id) -> User:
     """Return db_handler.User"""
     with Session(engine) as user_info_session:
@@ -280,73 +512,128 @@ def get_user_info(tg_id) -> User:
         return res_instance
 
 
-def get_last_quiz_id(_quiz_name: str) -> int:
-    """Returns last id from 'quiz_list' whit _quiz_name
+def is_quiz_upload_known(content_hash: str) -> bool:
+    """Checks if a file with this content hash has already been imported"""
+    with Session(engine) as quiz_upload_session:
+        return quiz_upload_session.get(QuizUpload, content_hash) is not None
 
-    :param _quiz_name: quiz name to search
-    :return: None
-    """
-    with Session(engine) as quiz_id_session:
-        statement = (select(QuizList.quiz_id).where(QuizList.quiz_name == _quiz_name))
-        res_instance = quiz_id_session.scalars(statement).all()[-1]
-        return res_instance
 
+def get_existing_quiz_names(quiz_names: list or tuple) -> set:
+    """Returns names from {quiz_names} which are already used by quizzes"""
+    if not quiz_names:
+        return set()
+    with Session(engine) as quiz_names_session:
+        statement = select(QuizList.quiz_name).where(QuizList.quiz_name.in_(quiz_names))
+        return set(quiz_names_session.scalars(statement).all())
 
-def get_quiz_list(visible: bool = False) -> list:
-    """Prepares a list containing tuples with information about polls
 
-    [[quiz_name, quiz_id, quiz_status], ...]
+def get_quiz_page_statement(visible: bool, before_id: int = None, after_id: int = None,
+                             limit: int = None):
+    """Returns select-statement with (quiz_name, quiz_id, quiz_status) for quiz_catalog.QuizCatalog
 
-    :param visible: visible status, bool
-    :return: list with last 10 tuples
+    Quizzes with quiz_id < before_id ordered by quiz_id DESC or, if after_id is set, quizzes with
+    quiz_id > after_id ordered by quiz_id ASC
     """
-    with Session(engine) as quiz_list_session:
-        if visible:
-            statement = (
-                select(QuizList).where(QuizList.quiz_status == True)
-            )
-        else:
-            statement = (
-                select(QuizList)
-            )
-        result_list = [(_.quiz_name, _.quiz_id, _.quiz_status)
-                       for _ in quiz_list_session.scalars(statement).all()]
+    statement = select(QuizList.quiz_name, QuizList.quiz_id, QuizList.quiz_status)
+    if visible:
+        statement = statement.where(QuizList.quiz_status == True)
+    if after_id is not None:
+        statement = statement.where(QuizList.quiz_id > after_id).order_by(QuizList.quiz_id)
+    else:
+        if before_id is not None:
+            statement = statement.where(QuizList.quiz_id < before_id)
+        statement = statement.order_by(QuizList.quiz_id.desc())
+    return statement.limit(limit)
+
+
+def get_quiz_page(visible: bool, before_id: int = None, after_id: int = None,
+                  limit: int = None) -> list:
+    """Returns [(quiz_name, quiz_id, quiz_status), ...] by quiz_id DESC (quiz_catalog loader)"""
+    with Session(engine) as quiz_page_session:
+        statement = get_quiz_page_statement(visible, before_id, after_id, limit)
+        result_list = [tuple(_) for _ in quiz_page_session.execute(statement).all()]
+    if after_id is not None:
+        result_list.reverse()
+    return result_list
+
+
+catalog = quiz_catalog.QuizCatalog(
+    get_quiz_page,
+    int(os.environ.get('quiz_catalog_page_size', 10)),
+    int(os.environ.get('quiz_catalog_ttl', 60))
+)
 
-        return result_list[-10:]
 
+def get_quiz_session(tg_id: int) -> quiz_sessions.SessionState or None:
+    """Return active quiz session of user (quiz_sessions.SessionState) or None"""
+    is_cached, state = active_sessions.get(tg_id)
+    if is_cached:
+        return state
+    with Session(engine) as quiz_session_session:
+        state = get_session_state(quiz_session_session.get(QuizSession, tg_id))
+    active_sessions.set(tg_id, state)
+    if state is not None and active_sessions.is_expired(state):
+        return None
+    return state
 
-def get_quiz_status(tg_id: int) -> str or None:
-    """Return user quiz status"""
-    with Session(engine) as user_quiz_status_session:
-        statement = select(User.quiz_status).where(User.tg_user_id == tg_id)
-        result = user_quiz_status_session.scalars(statement).first()
-        return result
+
+def get_list_of_questions_in_quiz(quiz_id) -> list[quiz_cache.CachedQuestion]:
+    """Return list with questions (quiz_cache.CachedQuestion, like db_handler.QuizQuestions)"""
+    definition = get_quiz_definition(quiz_id)
+    return list(definition.questions) if definition is not None else []
 
 
-def get_list_of_questions_in_quiz(quiz_id) -> list[QuizQuestions]:
-    """Return list with questions (db_handler.QuizQuestions)"""
-    with Session(engine) as list_of_questions_session:
-        statement = select(QuizQuestions).where(QuizQuestions.quiz_id == quiz_id)
-        result_list = list_of_questions_session.scalars(statement).all()
-        return result_list
+default_end_message = 'Спасибо за участие в опросе!'
 
 
 def get_end_message(quiz_id) -> str:
-    """Return and-message of quiz"""
-    with Session(engine) as quiz_end_message_session:
-        statement = select(QuizList.quiz_gratitude).where(QuizList.quiz_id == quiz_id)
-        result = quiz_end_message_session.scalars(statement).all()[0]
-        return result
+    """Return and-message of quiz (a default one if the quiz isn't found, e.g. it's deleted)"""
+    quiz_definition = get_quiz_definition(quiz_id)
+    if quiz_definition is None:
+        return default_end_message
+    return quiz_definition.gratitude
+
+
+def get_quiz_progress_statement(tg_id):
+    """Returns select-statement with (quiz_id, completed_at) of quizzes started by user"""
+    return select(QuizCompletion.quiz_id, QuizCompletion.completed_at).\
+        where(QuizCompletion.internal_user_id == get_internal_user_id_subquery(tg_id))
+
+
+def get_quiz_progress(tg_id) -> dict:
+    """Return quizzes started by user like {quiz_id: completed_at or None if it isn't finished}"""
+    with Session(engine) as quiz_progress_session:
+        return dict(quiz_progress_session.execute(get_quiz_progress_statement(tg_id)).all())
 
 
 def get_completed_quizzes_id(tg_id) -> set[int]:
     """Return a set with completed user quizzes"""
-    user = get_user_info(tg_id)
-    with Session(engine) as completed_quizzes_id_session:
-        statement = select(QuestionsAnswers.quiz_id).\
-            where(QuestionsAnswers.internal_user_id == user.internal_user_id)
-        result = set(completed_quizzes_id_session.scalars(statement).all())
-        return result
+    return {quiz_id for quiz_id, completed_at in get_quiz_progress(tg_id).items() if completed_at}
+
+
+def get_resume_quest_id_statement(tg_id, quiz_id):
+    """Returns select-statement with the question after the last answered one"""
+    return select(sqlalchemy.func.coalesce(sqlalchemy.func.max(QuestionsAnswers.quest_id), 0) + 1).\
+        where(
+            QuestionsAnswers.quiz_id == quiz_id,
+            QuestionsAnswers.internal_user_id == get_internal_user_id_subquery(tg_id)
+        )
+
+
+def get_resume_quest_id(tg_id, quiz_id) -> int:
+    """Return the question to continue partially answered quiz from (1 for a new quiz)"""
+    with Session(engine) as resume_quest_id_session:
+        return resume_quest_id_session.scalars(get_resume_quest_id_statement(tg_id, quiz_id)).one()
+
+
+def get_user_quiz_answers(tg_id, quiz_id) -> dict:
+    """Return user answers in quiz like {quest_id: answer_text}"""
+    with Session(engine) as user_quiz_answers_session:
+        statement = select(QuestionsAnswers.quest_id, QuestionsAnswers.answer).where(
+            QuestionsAnswers.quiz_id == quiz_id,
+            QuestionsAnswers.internal_user_id == get_internal_user_id_subquery(tg_id)
+        )
+        return dict(user_quiz_answers_session.execute(statement).all())
 
 
 def get_current_mailing_status(tg_id) -> bool:
@@ -365,22 +652,19 @@ def get_active_ban_list() -> list[BanList]:
         return result
 
 
-def get_answers(quiz_id, quest_id) -> list[QuestionsAnswers]:
-    """Return list with answers text
-
-    Contains ONLY the text of the answers!!!
-
-    :param quiz_id: target quiz id
-    :param quest_id: target quest id
-    :return: list with answers text
-    """
-    with Session(engine) as answers_session:
-        statement = select(QuestionsAnswers).where(
-            QuestionsAnswers.quiz_id == quiz_id,
-            QuestionsAnswers.quest_id == quest_id
+def get_users_id_statement(group: str, mailing: bool = False):
+    """Returns select-statement with tg ids of users for distribution (see get_users_id)"""
+    without_session = ~sqlalchemy.exists().where(QuizSession.tg_user_id == User.tg_user_id)
+    if mailing:
+        return select(User.tg_user_id).where(
+            User.group == group,
+            without_session,
+            User.mailing == True
         )
-        result = answers_session.scalars(statement).all()
-        return result
+    return select(User.tg_user_id).where(
+        User.group == group,
+        without_session
+    )
 
 
 def get_users_id(group: str, mailing: bool = False) -> tuple:
@@ -392,64 +676,168 @@ def get_users_id(group: str, mailing: bool = False) -> tuple:
     :return: tuple with ids
     """
     with Session(engine) as users_id_session:
-        if mailing:
-            statement = select(User.tg_user_id).where(
-                User.group == group,
-                User.quiz_status == None,
-                User.mailing == True
-            )
-        else:
-            statement = select(User.tg_user_id).where(
-                User.group == group,
-                User.quiz_status == None
-            )
-        result_list = users_id_session.scalars(statement).all()
+        result_list = users_id_session.scalars(get_users_id_statement(group, mailing)).all()
         return tuple(result_list)
 
 
-def get_quiz_answers(quiz_id):
-    """Prepares a dictionary with quiz answers
+def get_active_mailing_jobs() -> list[MailingJob]:
+    """Return list with unfinished db_handler.MailingJob-objects"""
+    with Session(engine) as mailing_jobs_session:
+        statement = select(MailingJob).where(MailingJob.job_status == 'active').\
+            order_by(MailingJob.job_id)
+        return mailing_jobs_session.scalars(statement).all()
 
-    It should be in pattern {question_1_text: {answer_1_text: count, ...}, ...}
+
+def claim_mailing_recipients(job_id, limit: int, claim_timeout: datetime.timedelta) -> list[int]:
+    """Takes up to {limit} recipients who haven't got the mailing yet
+
+    Recipients are marked 'sending' in one statement, locked rows are skipped - so two processes
+    (like an old and a new leader) never take the same recipient. Recipients taken more than
+    {claim_timeout} ago (by a process which has died) are taken again.
+
+    :return: tg ids of the taken recipients
     """
-    with Session(engine) as quiz_answers_session:
-        statement = select(QuestionsAnswers.quest_id).where(QuestionsAnswers.quiz_id == quiz_id)
-        quests_id = frozenset(quiz_answers_session.scalars(statement).all())
-    questions_info: list[QuizQuestions] = get_list_of_questions_in_quiz(quiz_id)
-    info_dict = dict()
-    for quest_id in quests_id:
-        try:
-            if questions_info[quest_id - 1].quest_text not in info_dict.keys():
-                info_dict[questions_info[quest_id - 1].quest_text] = dict()
-            answers = get_answers(quiz_id, quest_id)
-            answers_text = [i.answer for i in answers]
-            for answer in answers_text:
-                if answer not in info_dict[questions_info[quest_id - 1].quest_text]:
-                    info_dict[questions_info[quest_id - 1].quest_text][answer] = 0
-                info_dict[questions_info[quest_id - 1].quest_text][answer] += 1
-        except IndexError:
-            pass
-
-    return info_dict
-
-
-def get_analytical_message(quiz_id):
-    with Session(engine) as quiz_answers_session:
-        statement = select(QuestionsAnswers.quest_id).where(QuestionsAnswers.quiz_id == quiz_id)
-        quests_id = frozenset(quiz_answers_session.scalars(statement).all())
-    questions_info: list[QuizQuestions] = get_list_of_questions_in_quiz(quiz_id)
-    analytical_dict = dict()
-
-    for quest_id in quests_id:
-        try:
-            answers = get_answers(quiz_id, quest_id)
-            for answer in answers:
-                if answer.internal_user_id not in analytical_dict:
-                    analytical_dict[answer.internal_user_id] = dict()
-                analytical_dict[answer.internal_user_id][answer.quest_id] = answer.answer
-        except IndexError:
-            pass
-    return dict_analytic(analytical_dict, questions_info)
+    now = datetime.datetime.now()
+    with Session(engine) as claim_recipients_session:
+        candidates = select(MailingRecipient.tg_user_id).where(
+            MailingRecipient.job_id == job_id,
+            sqlalchemy.or_(
+                MailingRecipient.send_status == 'pending',
+                sqlalchemy.and_(
+                    MailingRecipient.send_status == 'sending',
+                    MailingRecipient.claimed_at < now - claim_timeout
+                )
+            )
+        ).order_by(MailingRecipient.tg_user_id).limit(limit).with_for_update(skip_locked=True)
+        statement = sqlalchemy.update(MailingRecipient).where(
+            MailingRecipient.job_id == job_id,
+            MailingRecipient.tg_user_id.in_(candidates.scalar_subquery())
+        ).values(send_status='sending', claimed_at=now).returning(MailingRecipient.tg_user_id).\
+            execution_options(synchronize_session=False)
+        users_id = claim_recipients_session.scalars(statement).all()
+        claim_recipients_session.commit()
+        return users_id
+
+
+def get_mailing_job_counts(job_id) -> dict:
+    """Return numbers of recipients like {'pending': 10, 'sent': 5, 'failed': 1}
+
+    Recipients who are being sent ('sending') are counted as pending.
+    """
+    with Session(engine) as job_counts_session:
+        statement = select(MailingRecipient.send_status, sqlalchemy.func.count()).where(
+            MailingRecipient.job_id == job_id
+        ).group_by(MailingRecipient.send_status)
+        result = {'pending': 0, 'sent': 0, 'failed': 0}
+        result.update(dict(job_counts_session.execute(statement).all()))
+        result['pending'] += result.pop('sending', 0)
+        return result
+
+
+def get_quiz_answer_counts(quiz_id) -> dict:
+    """Return numbers of answers to each question of quiz from 'answer_counters'
+
+    Answers to questions which aren't in the quiz definition are ignored.
+
+    :param quiz_id: target quiz id
+    :return: column arrays like {'quest_id': [...], 'quest_text': [...], 'answer': [...],
+        'count': [...]} ordered by quest_id
+    """
+    questions_info = get_list_of_questions_in_quiz(quiz_id)
+    with Session(engine) as answer_counts_session:
+        statement = select(
+            AnswerCounters.quest_id,
+            AnswerCounters.answer,
+            AnswerCounters.answer_count
+        ).where(
+            AnswerCounters.quiz_id == quiz_id,
+            AnswerCounters.answer_count > 0
+        ).order_by(
+            AnswerCounters.quest_id
+        )
+        rows = answer_counts_session.execute(statement).all()
+    columns = {'quest_id': [], 'quest_text': [], 'answer': [], 'count': []}
+    for quest_id, answer, count in rows:
+        if 1 <= quest_id <= len(questions_info):
+            columns['quest_id'].append(quest_id)
+            columns['quest_text'].append(questions_info[quest_id - 1].quest_text)
+            columns['answer'].append(answer)
+            columns['count'].append(count)
+    return columns
+
+
+def get_answer_counters_mismatches(quiz_id=None) -> list:
+    """Compares 'answer_counters' with real numbers of answers
+
+    :param quiz_id: target quiz id or None for all quizzes
+    :return: list of tuples (quiz_id, quest_id, answer, stored count, real count)
+    """
+    real_counts = select(
+        QuestionsAnswers.quiz_id,
+        QuestionsAnswers.quest_id,
+        QuestionsAnswers.answer,
+        sqlalchemy.func.count().label('real_count')
+    ).where(
+        QuestionsAnswers.answer != None  # skipped questions aren't counted (see rebuild)
+    ).group_by(
+        QuestionsAnswers.quiz_id,
+        QuestionsAnswers.quest_id,
+        QuestionsAnswers.answer
+    )
+    stored_counts = select(AnswerCounters).where(AnswerCounters.answer_count != 0)
+    if quiz_id is not None:
+        real_counts = real_counts.where(QuestionsAnswers.quiz_id == quiz_id)
+        stored_counts = stored_counts.where(AnswerCounters.quiz_id == quiz_id)
+    real_counts = real_counts.subquery()
+    stored_counts = stored_counts.subquery()
+    statement = select(
+        sqlalchemy.func.coalesce(real_counts.c.quiz_id, stored_counts.c.quiz_id),
+        sqlalchemy.func.coalesce(real_counts.c.quest_id, stored_counts.c.quest_id),
+        sqlalchemy.func.coalesce(real_counts.c.answer, stored_counts.c.answer),
+        sqlalchemy.func.coalesce(stored_counts.c.answer_count, 0),
+        sqlalchemy.func.coalesce(real_counts.c.real_count, 0)
+    ).select_from(
+        real_counts.outerjoin(
+            stored_counts,
+            sqlalchemy.and_(
+                real_counts.c.quiz_id == stored_counts.c.quiz_id,
+                real_counts.c.quest_id == stored_counts.c.quest_id,
+                real_counts.c.answer == stored_counts.c.answer
+            ),
+            full=True
+        )
+    ).where(
+        sqlalchemy.func.coalesce(stored_counts.c.answer_count, 0) !=
+        sqlalchemy.func.coalesce(real_counts.c.real_count, 0)
+    )
+    with Session(engine) as counters_check_session:
+        return [tuple(row) for row in counters_check_session.execute(statement).all()]
+
+
+def get_quiz_answer_rows(quiz_id) -> dict:
+    """Return all answers of quiz as column arrays
+
+    :param quiz_id: target quiz id
+    :return: {'internal_user_id': [...], 'quest_id': [...], 'answer': [...]}
+    """
+    with Session(engine) as quiz_answer_rows_session:
+        statement = select(
+            QuestionsAnswers.internal_user_id,
+            QuestionsAnswers.quest_id,
+            QuestionsAnswers.answer
+        ).where(
+            QuestionsAnswers.quiz_id == quiz_id
+        ).order_by(
+            QuestionsAnswers.quest_id,
+            QuestionsAnswers.internal_ans_id
+        )
+        rows = quiz_answer_rows_session.execute(statement).all()
+    columns = tuple(zip(*rows)) or ((), (), ())
+    return {
+        'internal_user_id': list(columns[0]),
+        'quest_id': list(columns[1]),
+        'answer': list(columns[2])
+    }
 
 
 # add-requests
@@ -515,71 +903,73 @@ def add_user(tg_id, msg_id, msg_txt, msg_t_stamp):
         add_message_in_log(tg_id, msg_id, msg_txt, msg_t_stamp)
 
 
-def add_new_quiz(input_instance: quiz_handler.PreparedQuiz, tg_id: int) -> str:
-    """Insert new quiz into the 'quiz_list' table and questions into the 'quiz_questions' table
+def add_new_quizzes(input_instances: list or tuple, tg_id: int, content_hash: str = None,
+                    file_name: str = None) -> list or None:
+    """Inserts quizzes and their questions with bulk inserts in one transaction
 
-    !!!Keep in mind that input_instance can be only quiz_handler.PreparedQuiz!!!
-
-    :param input_instance: quiz instance, quiz_handler.PreparedQuiz
+    :param input_instances: quiz_handler.PreparedQuiz instances with unique names
     :param tg_id: initiator id, int
-    :return: info-message
+    :param content_hash: hash of the uploaded file (recorded in 'quiz_upload') or None
+    :param file_name: name of the uploaded file
+    :return: ids of added quizzes in the same order or None if nothing is added
     """
     try:
-        with Session(engine) as add_quiz_session:
-
-            new_quiz = QuizList(
-                quiz_name=input_instance.name,
-                quiz_title=input_instance.title,
-                quiz_gratitude=input_instance.gratitude
-            )
-            add_quiz_session.add(new_quiz)
-            add_quiz_session.flush()
-            quiz_id = new_quiz.quiz_id
-            add_event_in_log(
-                'Added new quiz %s' % input_instance.name,
-                tg_id,
-                datetime.datetime.now(),
-                add_quiz_session,
-                'New quiz with name %s from user %s' % (input_instance.name, tg_id)
-            )
-            add_quiz_session.commit()
-    except KeyboardInterrupt:
-        exit('Interrupted')
-    except Exception as exc:
-        init_logger.error('Exception: %s\n%s' % (type(exc), exc))
-        return 'Не получилось добавить опрос %s' % input_instance.name
-
-    try:
-        with Session(engine) as add_questions_session:
-            for question in input_instance.questions:
-                new_question = QuizQuestions(
-                    quiz_id=quiz_id,
-                    quest_id=question.text.split('.')[0],
-                    quest_relation=question.relation,
-                    quest_text=question.text[question.text.index(' '):].strip(),
-                    quest_ans=' || '.join(question.answers)
+        with Session(engine) as add_quizzes_session:
+            if content_hash is not None:
+                # concurrent import of the same file fails here on the primary key
+                add_quizzes_session.execute(insert(QuizUpload).values(
+                    content_hash=content_hash,
+                    file_name=file_name[:256],
+                    initiator_tg_id=tg_id,
+                    quizzes_count=len(input_instances),
+                    uploaded_at=datetime.datetime.now()
+                ))
+            statement = insert(QuizList).values([
+                {
+                    'quiz_name': quiz.name,
+                    'quiz_title': quiz.title,
+                    'quiz_gratitude': quiz.gratitude,
+                    'quiz_status': False
+                } for quiz in input_instances
+            ]).returning(QuizList.quiz_name, QuizList.quiz_id)
+            quiz_ids_by_name = dict(add_quizzes_session.execute(statement).all())
+            quiz_ids = [quiz_ids_by_name[quiz.name] for quiz in input_instances]
+            add_quizzes_session.execute(insert(QuizQuestions), [
+                {
+                    'quiz_id': quiz_id,
+                    'quest_id': question.text.split('.')[0],
+                    'quest_relation': question.relation,
+                    'quest_text': question.text[question.text.index(' '):].strip(),
+                    'quest_ans': ' || '.join(question.answers)
+                } for quiz, quiz_id in zip(input_instances, quiz_ids) for question in quiz.questions
+            ])
+            for quiz, quiz_id in zip(input_instances, quiz_ids):
+                add_event_in_log(
+                    'Added new quiz %s with %s questions' % (quiz.name, len(quiz.questions)),
+                    tg_id,
+                    datetime.datetime.now(),
+                    add_quizzes_session,
+                    'New quiz with name %s (id %s) from user %s' % (quiz.name, quiz_id, tg_id)
                 )
-                add_questions_session.add(new_question)
-            add_event_in_log(
-                'Added questions for quiz %s' % input_instance.name,
-                tg_id,
-                datetime.datetime.now(),
-                add_questions_session,
-                'Questions for quiz %s from user %s' % (input_instance.name, tg_id)
-            )
-            add_questions_session.commit()
+            add_quizzes_session.commit()
     except KeyboardInterrupt:
         exit('Interrupted')
     except Exception as exc:
         init_logger.error('Exception: %s\n%s' % (type(exc), exc))
-        msg = 'Не получилось добавить вопросы к опросу "%s", id %s' % (input_instance.name, quiz_id)
-        return msg
+        return None
+
+    for quiz_id in quiz_ids:
+        quiz_definitions.invalidate(quiz_id)
+    catalog.invalidate()
+    return quiz_ids
+
 
-    return 'Успешно добавлен опрос "%s" с id "%s"' % (input_instance.name, quiz_id)
+submit_attempts = 2  # a serialization failure or a lost race is retried once
 
 
-def add_new_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
-    """Insert new answer in db
+def submit_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str) -> \
+        quiz_cache.CachedQuestion or None or bool:
+    """Insert new answer, move user to the next question and return it - all in one transaction
 
     Don't use that for rewrite answer!!!
 
@@ -587,33 +977,185 @@ def add_new_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
     :param quiz_id: quiz id
     :param quest_id: quest id
     :param answer_text: answer text
-    :return:
+    :return: next question (quiz_cache.CachedQuestion) or None if it was the last one (the quiz
+        session is already finished then), False if the answer isn't saved (the user should send
+        it again)
     """
-    user = get_user_info(tg_id)
-    with Session(engine) as answer_session:
-        new_answer = QuestionsAnswers(
-            quiz_id=quiz_id,
-            quest_id=quest_id,
-            internal_user_id=user.internal_user_id,
-            answer=answer_text
+    definition = get_quiz_definition(quiz_id)
+    next_question = definition.get_question(quest_id + 1) if definition is not None else None
+    next_quest_id = None if next_question is None else quest_id + 1
+    state = get_quiz_session(tg_id)
+    for attempt in range(1, submit_attempts + 1):
+        try:
+            with Session(engine) as submit_session:
+                submit_session.execute(
+                    insert(QuestionsAnswers).values(
+                        quiz_id=quiz_id,
+                        quest_id=quest_id,
+                        internal_user_id=get_internal_user_id_subquery(tg_id),
+                        answer=answer_text
+                    )
+                )
+                change_answer_counters(submit_session, quiz_id, {(quest_id, answer_text): 1})
+                submit_session.execute(get_session_step_statement(tg_id, quiz_id, next_quest_id))
+                if next_quest_id is None:
+                    submit_session.execute(get_quiz_completion_statement(tg_id, quiz_id))
+                add_event_in_log(
+                    msg := 'Answer from user %s for quiz %s, question %s: %s' %
+                           (tg_id, quiz_id, quest_id, answer_text),
+                    tg_id,
+                    datetime.datetime.now(),
+                    submit_session,
+                    msg
+                )
+                submit_session.commit()
+            break
+        except sqlalchemy.exc.SQLAlchemyError as exc:  # the session is rolled back when closed
+            init_logger.error('Answer of user %s is not saved (attempt %s): %s\n%s' % (
+                tg_id, attempt, type(exc), exc
+            ))
+    else:
+        active_sessions.drop([tg_id])  # the next message reads the session from the database
+        return False
+    active_sessions.set(tg_id, get_next_session_state(state, next_quest_id))
+    return next_question
+
+
+def skip_questions(tg_id: int, quiz_id: int, quests_id: list or tuple,
+                   next_quest_id: int or None):
+    """Insert 'None' answers for skipped questions and move the quiz session in one transaction
+
+    :param tg_id: user id
+    :param quiz_id: quiz id
+    :param quests_id: ids of skipped questions
+    :param next_quest_id: next question or None if the quiz is over
+    :return: None
+    """
+    internal_user_id = get_internal_user_id_subquery(tg_id)
+    state = get_quiz_session(tg_id)
+    with Session(engine) as skip_session:
+        skip_session.execute(
+            insert(QuestionsAnswers).values([
+                {
+                    'quiz_id': quiz_id,
+                    'quest_id': quest_id,
+                    'internal_user_id': internal_user_id,
+                    'answer': 'None'
+                } for quest_id in quests_id
+            ])
         )
-        answer_session.add(new_answer)
+        change_answer_counters(
+            skip_session,
+            quiz_id,
+            {(quest_id, 'None'): 1 for quest_id in quests_id}
+        )
+        skip_session.execute(get_session_step_statement(tg_id, quiz_id, next_quest_id))
+        if next_quest_id is None:
+            skip_session.execute(get_quiz_completion_statement(tg_id, quiz_id))
         add_event_in_log(
-            msg := 'Answer from user %s for quiz %s, question %s: %s' %
-                   (tg_id, quiz_id, quest_id, answer_text),
+            msg := 'User %s skipped questions %s in quiz %s' % (tg_id, list(quests_id), quiz_id),
             tg_id,
             datetime.datetime.now(),
-            answer_session,
+            skip_session,
             msg
         )
-        answer_session.flush()
-        time.sleep(0.1)
-        answer_session.commit()
+        skip_session.commit()
+    active_sessions.set(tg_id, get_next_session_state(state, next_quest_id))
+
+
+def add_mailing_job(initiator_tg_id, group: str, msg_text: str, mailing: bool = False) -> int:
+    """Creates mailing job with all its recipients (see get_users_id) in one transaction
+
+    :param initiator_tg_id: user-initiator id
+    :param group: target group of users
+    :param msg_text: message for users
+    :param mailing: whether users with disabled mailing will be skipped
+    :return: job id
+    """
+    with Session(engine) as mailing_job_session:
+        new_job = MailingJob(
+            initiator_tg_id=initiator_tg_id,
+            target_group=group,
+            msg_text=msg_text,
+            created_time=datetime.datetime.now()
+        )
+        mailing_job_session.add(new_job)
+        mailing_job_session.flush()
+        job_id = new_job.job_id
+        users_id = get_users_id_statement(group, mailing).subquery()
+        mailing_job_session.execute(
+            insert(MailingRecipient).from_select(
+                ['job_id', 'tg_user_id'],
+                select(sqlalchemy.literal(job_id), users_id.c.tg_user_id)
+            )
+        )
+        add_event_in_log(
+            msg := 'New mailing job %s for group %s' % (job_id, group),
+            initiator_tg_id,
+            datetime.datetime.now(),
+            mailing_job_session,
+            msg
+        )
+        mailing_job_session.commit()
+        return job_id
+
+
+def rebuild_answer_counters(tg_id, quiz_id=None) -> int:
+    """Recounts 'answer_counters' from 'questions_answers'
+
+    Only answers to the recounted quiz wait until it's finished: its row in 'quiz_list' is locked
+    FOR UPDATE, which conflicts with the lock of the foreign key check of a new answer (and with
+    get_answers_lock_statement of a rewritten one).
+
+    :param tg_id: initiator id
+    :param quiz_id: target quiz id or None for all quizzes
+    :return: number of counters
+    """
+    with Session(engine) as rebuild_counters_session:
+        quiz_rows = select(QuizList.quiz_id).with_for_update()
+        if quiz_id is not None:
+            quiz_rows = quiz_rows.where(QuizList.quiz_id == quiz_id)
+        rebuild_counters_session.execute(quiz_rows)
+        delete_statement = sqlalchemy.delete(AnswerCounters)
+        real_counts = select(
+            QuestionsAnswers.quiz_id,
+            QuestionsAnswers.quest_id,
+            QuestionsAnswers.answer,
+            sqlalchemy.func.count()
+        ).where(
+            QuestionsAnswers.answer != None
+        ).group_by(
+            QuestionsAnswers.quiz_id,
+            QuestionsAnswers.quest_id,
+            QuestionsAnswers.answer
+        )
+        if quiz_id is not None:
+            delete_statement = delete_statement.where(AnswerCounters.quiz_id == quiz_id)
+            real_counts = real_counts.where(QuestionsAnswers.quiz_id == quiz_id)
+        rebuild_counters_session.execute(delete_statement)
+        result = rebuild_counters_session.execute(
+            insert(AnswerCounters).from_select(
+                ['quiz_id', 'quest_id', 'answer', 'answer_count'],
+                real_counts
+            )
+        )
+        add_event_in_log(
+            msg := 'Rebuild answer counters for quiz %s' % ('all' if quiz_id is None else quiz_id),
+            tg_id,
+            datetime.datetime.now(),
+            rebuild_counters_session,
+            msg
+        )
+        rebuild_counters_session.commit()
+        return result.rowcount
 
 
 # ban & unban
-def ban_user(initiator_tg_id, target_tg_id, reason, term):
-    """Ban user"""
+def ban_user(initiator_tg_id, target_tg_id, reason, term) -> tuple:
+    """Ban user
+
+    :return: (ban id, unban time)
+    """
     time_delta = convert_to_timedelta(term)
 
     ban_time = datetime.datetime.now()
@@ -628,6 +1170,8 @@ def ban_user(initiator_tg_id, target_tg_id, reason, term):
             unban_time=unban_time
         )
         ban_user_session.add(new_ban)
+        ban_user_session.flush()
+        ban_id = new_ban.internal_ban_id
         ban_user_session.query(User).filter(User.tg_user_id == target_tg_id).\
             update({'is_ban': True, 'group': 'user'})
         initiator_tg_id = initiator_tg_id if initiator_tg_id != 0 else 'system'
@@ -639,10 +1183,14 @@ def ban_user(initiator_tg_id, target_tg_id, reason, term):
             'Ban %s for %s by %s with reason %s' % (target_tg_id, term, initiator_tg_id, reason)
         )
         ban_user_session.commit()
+        return ban_id, unban_time
+
 
+def unban_user(initiator_tg_id, target_tg_id, reason=None) -> list[int]:
+    """Unban user
 
-def unban_user(initiator_tg_id, target_tg_id, reason=None):
-    """Unban user"""
+    :return: ids of closed bans
+    """
     if reason is None:
         if initiator_tg_id == 0:
             reason = 'time has come'
@@ -652,8 +1200,11 @@ def unban_user(initiator_tg_id, target_tg_id, reason=None):
     with Session(engine) as unban_user_session:
         unban_user_session.query(User).filter(User.tg_user_id == target_tg_id).\
             update({'is_ban': False})
-        unban_user_session.query(BanList).filter(BanList.tg_id == target_tg_id).\
-            update({'current_status': False})
+        statement = sqlalchemy.update(BanList).where(
+            BanList.tg_id == target_tg_id,
+            BanList.current_status == True
+        ).values(current_status=False).returning(BanList.internal_ban_id)
+        bans_id = unban_user_session.scalars(statement).all()
         initiator_tg_id = initiator_tg_id if initiator_tg_id != 0 else 'system'
         add_event_in_log(
             msg := 'Unban user with tg_id %s with reason "%s"' % (target_tg_id, reason),
@@ -663,6 +1214,36 @@ def unban_user(initiator_tg_id, target_tg_id, reason=None):
             msg
         )
         unban_user_session.commit()
+        return bans_id
+
+
+def expire_ban(ban_id):
+    """Closes ban {ban_id} by time, the user is unbanned if there are no other active bans"""
+    with Session(engine) as expire_ban_session:
+        statement = sqlalchemy.update(BanList).where(
+            BanList.internal_ban_id == ban_id,
+            BanList.current_status == True
+        ).values(current_status=False).returning(BanList.tg_id)
+        target_tg_id = expire_ban_session.scalars(statement).first()
+        if target_tg_id is None:
+            return
+        statement = select(BanList.internal_ban_id).where(
+            BanList.tg_id == target_tg_id,
+            BanList.current_status == True
+        )
+        if expire_ban_session.scalars(statement).first() is None:
+            expire_ban_session.query(User).filter(User.tg_user_id == target_tg_id).\
+                update({'is_ban': False})
+        add_event_in_log(
+            msg := 'Unban user with tg_id %s with reason "time has come" (ban %s)' % (
+                target_tg_id, ban_id
+            ),
+            'system',
+            datetime.datetime.now(),
+            expire_ban_session,
+            msg
+        )
+        expire_ban_session.commit()
 
 
 # update-requests
@@ -680,12 +1261,25 @@ def rewrite_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
     user = get_user_info(tg_id)
     try:
         with Session(engine) as user_answer_update_session:
+            user_answer_update_session.execute(get_answers_lock_statement(quiz_id))
+            statement = select(QuestionsAnswers.answer).where(
+                QuestionsAnswers.quiz_id == quiz_id,
+                QuestionsAnswers.quest_id == quest_id,
+                QuestionsAnswers.internal_user_id == user.internal_user_id
+            ).with_for_update()
+            old_answers = user_answer_update_session.scalars(statement).all()
             user_answer_update_session.query(QuestionsAnswers).filter(
                 QuestionsAnswers.quiz_id == quiz_id,
                 QuestionsAnswers.quest_id == quest_id,
                 QuestionsAnswers.internal_user_id == user.internal_user_id
             ).\
                 update({'answer': answer_text})
+            counters_changes = {(quest_id, answer_text): len(old_answers)}
+            for old_answer in old_answers:
+                counters_changes[(quest_id, old_answer)] = \
+                    counters_changes.get((quest_id, old_answer), 0) - 1
+            change_answer_counters(user_answer_update_session, quiz_id, counters_changes)
+            user_answer_update_session.execute(get_session_step_statement(tg_id, quiz_id, None))
             add_event_in_log(
                 msg := 'Rewrite answer from user %s for quiz %s, question %s' % (
                     tg_id, quiz_id, quest_id
@@ -696,7 +1290,7 @@ def rewrite_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
                 msg
             )
             user_answer_update_session.commit()
-        update_user_quiz_status(tg_id, None)
+        active_sessions.set(tg_id, None)
         return True
     except KeyboardInterrupt:
         exit('Interrupted')
@@ -705,21 +1299,150 @@ def rewrite_answer(tg_id: int, quiz_id: int, quest_id: int, answer_text: str):
         return False
 
 
-def update_user_quiz_status(tg_id: int, new_status: str or None):
-    """Update user quiz status in pattern like [quiz id] [quest id] or None"""
-    with Session(engine) as user_quiz_status_update_session:
-        user_quiz_status_update_session.query(User).filter(
-            User.tg_user_id == tg_id
-        ).\
-            update({'quiz_status': new_status})
+def start_quiz_session(tg_id: int, quiz_id: int, quest_id: int = 1, mode: str = 'answer'):
+    """Starts (or replaces) quiz session of user
+
+    :param tg_id: user id
+    :param quiz_id: quiz id
+    :param quest_id: current question
+    :param mode: 'answer' - passing the quiz, 'rewrite' - rewriting the answer to {quest_id}
+    :return: None
+    """
+    now = datetime.datetime.now()
+    state = quiz_sessions.SessionState(quiz_id, quest_id, mode, now, now)
+    with Session(engine) as start_session_session:
+        start_session_session.execute(get_session_upsert_statement(tg_id, state))
+        if mode == 'answer':
+            start_session_session.execute(get_quiz_start_statement(tg_id, quiz_id))
         add_event_in_log(
-            'Update status for user %s' % tg_id,
+            msg := 'Start quiz %s (%s from question %s) for user %s' % (
+                quiz_id, mode, quest_id, tg_id
+            ),
             tg_id,
-            datetime.datetime.now(),
-            user_quiz_status_update_session,
-            'Status "%s" for user with tg_id: %s' % (new_status, tg_id)
+            now,
+            start_session_session,
+            msg
         )
-        user_quiz_status_update_session.commit()
+        start_session_session.commit()
+    active_sessions.set(tg_id, state)
+
+
+def finish_quiz_session(tg_id: int, reason: str = 'finished'):
+    """Ends quiz session of user (if there is one)
+
+    :param tg_id: user id
+    :param reason: 'finished' (the quiz is marked as completed) or 'abandoned'
+    :return: None
+    """
+    with Session(engine) as finish_session_session:
+        statement = sqlalchemy.delete(QuizSession).where(QuizSession.tg_user_id == tg_id).\
+            returning(QuizSession.quiz_id, QuizSession.mode)
+        quiz_id, mode = finish_session_session.execute(statement).first() or (None, None)
+        if quiz_id is not None:
+            if reason == 'finished' and mode == 'answer':
+                finish_session_session.execute(get_quiz_completion_statement(tg_id, quiz_id))
+            add_event_in_log(
+                msg := 'Quiz %s is %s by user %s' % (quiz_id, reason, tg_id),
+                tg_id,
+                datetime.datetime.now(),
+                finish_session_session,
+                msg
+            )
+        finish_session_session.commit()
+    active_sessions.set(tg_id, None)
+
+
+def expire_quiz_sessions() -> int:
+    """Ends all sessions without activity for quiz_session_timeout with one request
+
+    :return: number of expired sessions
+    """
+    now = datetime.datetime.now()
+    with Session(engine) as expire_sessions_session:
+        statement = sqlalchemy.delete(QuizSession).where(
+            QuizSession.last_activity < now - quiz_session_timeout
+        ).returning(QuizSession.tg_user_id, QuizSession.quiz_id)
+        expired = expire_sessions_session.execute(statement).all()
+        if expired:
+            expire_sessions_session.execute(insert(Logs).values([
+                {
+                    'event_msg': 'Quiz %s of user %s is abandoned by timeout' % (quiz_id, tg_id),
+                    'event_initiator': 'system',
+                    'event_timestamp': now
+                } for tg_id, quiz_id in expired
+            ]))
+        expire_sessions_session.commit()
+    active_sessions.drop([tg_id for tg_id, _ in expired])
+    if expired:
+        init_logger.info('Expired quiz sessions: %s' % len(expired))
+    return len(expired)
+
+
+def fill_quiz_completions() -> int:
+    """Fills empty 'quiz_completion' from answers given before it existed
+
+    A quiz is completed if the user has answers to all its questions (skipped ones are answered
+    with 'None').
+
+    :return: number of added rows
+    """
+    with Session(engine) as fill_completions_session:
+        if fill_completions_session.scalars(select(QuizCompletion.quiz_id).limit(1)).first():
+            return 0
+        answered = select(
+            QuestionsAnswers.internal_user_id,
+            QuestionsAnswers.quiz_id,
+            sqlalchemy.func.count(sqlalchemy.distinct(QuestionsAnswers.quest_id)).label('count')
+        ).group_by(QuestionsAnswers.internal_user_id, QuestionsAnswers.quiz_id).subquery()
+        questions = select(
+            QuizQuestions.quiz_id,
+            sqlalchemy.func.count().label('count')
+        ).group_by(QuizQuestions.quiz_id).subquery()
+        statement = postgresql.insert(QuizCompletion).from_select(
+            ['internal_user_id', 'quiz_id', 'completed_at'],
+            select(
+                answered.c.internal_user_id,
+                answered.c.quiz_id,
+                sqlalchemy.case(
+                    (answered.c.count >= questions.c.count, datetime.datetime.now()),
+                    else_=sqlalchemy.null()
+                )
+            ).join(questions, questions.c.quiz_id == answered.c.quiz_id).
+            where(answered.c.internal_user_id != None)
+        ).on_conflict_do_nothing()
+        added = fill_completions_session.execute(statement).rowcount
+        fill_completions_session.commit()
+    if added:
+        init_logger.info('Filled quiz completions: %s' % added)
+    return added
+
+
+def convert_quiz_statuses() -> int:
+    """Moves quiz statuses of the old format ('12 3' or '12 3 r' in 'user') to 'quiz_session'
+
+    :return: number of converted statuses
+    """
+    now = datetime.datetime.now()
+    with Session(engine) as convert_session:
+        statement = postgresql.insert(QuizSession).from_select(
+            ['tg_user_id', 'quiz_id', 'quest_id', 'mode', 'started_at', 'last_activity'],
+            select(
+                User.tg_user_id,
+                sqlalchemy.cast(sqlalchemy.func.split_part(User.quiz_status, ' ', 1), INTEGER),
+                sqlalchemy.cast(sqlalchemy.func.split_part(User.quiz_status, ' ', 2), INTEGER),
+                sqlalchemy.case((User.quiz_status.like('% r'), 'rewrite'), else_='answer'),
+                sqlalchemy.literal(now),
+                sqlalchemy.literal(now)
+            ).where(User.quiz_status != None)
+        ).on_conflict_do_nothing()
+        convert_session.execute(statement)
+        statement = sqlalchemy.update(User).where(User.quiz_status != None).\
+            values(quiz_status=None)
+        converted = convert_session.execute(statement).rowcount
+        convert_session.commit()
+    if converted:
+        init_logger.info('Converted quiz statuses: %s' % converted)
+    return converted
 
 
 def update_quiz_status(quiz_id, tg_id, new_status):
@@ -735,6 +1458,8 @@ def update_quiz_status(quiz_id, tg_id, new_status):
             'Update status for quiz %s from user %s: %s' % (quiz_id, tg_id, new_status)
         )
         quiz_status_session.commit()
+    quiz_definitions.invalidate(int(quiz_id))
+    catalog.invalidate()
 
     return 'Новый статус "%s" для опроса с ID "%s" успешно установлен!' % (new_status, quiz_id)
 
@@ -754,6 +1479,31 @@ def update_mailing_status(tg_id: int, new_status: bool):
         update_mailing_status_session.commit()
 
 
+def update_mailing_recipients(job_id, statuses: dict):
+    """Saves results of mailing
+
+    :param job_id: job id
+    :param statuses: {send_status: [tg_user_id, ...]}
+    :return: None
+    """
+    with Session(engine) as mailing_recipients_session:
+        for send_status, users_id in statuses.items():
+            if users_id:
+                mailing_recipients_session.query(MailingRecipient).filter(
+                    MailingRecipient.job_id == job_id,
+                    MailingRecipient.tg_user_id.in_(users_id)
+                ).\
+                    update({'send_status': send_status}, synchronize_session=False)
+        mailing_recipients_session.commit()
+
+
+def update_mailing_job(job_id, **values):
+    """Updates mailing job fields like job_status or progress_msg_id"""
+    with Session(engine) as mailing_job_session:
+        mailing_job_session.query(MailingJob).filter(MailingJob.job_id == job_id).update(values)
+        mailing_job_session.commit()
+
+
 def update_user_group(initiator_tg_id, target_tg_id, new_group):
     """Updates group of user"""
     with Session(engine) as update_group_session:
@@ -767,17 +1517,3 @@ def update_user_group(initiator_tg_id, target_tg_id, new_group):
             'Update group "%s" for user %s from %s' % (new_group, target_tg_id, initiator_tg_id)
         )
         update_group_session.commit()
-
-
-# check-requests
-def check_quest_relation(tg_id, quiz_id, check_quest_id, check_value) -> bool:
-    """If check_value matches the writen earlier return True, another - False"""
-    user = get_user_info(tg_id)
-    with Session(engine) as check_relation_session:
-        statement = select(QuestionsAnswers.answer).where(
-            QuestionsAnswers.quiz_id == quiz_id,
-            QuestionsAnswers.quest_id == check_quest_id,
-            QuestionsAnswers.internal_user_id == user.internal_user_id
-        )
-        result_value = check_relation_session.scalars(statement).all()[0]
-        return result_value == check_value
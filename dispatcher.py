@@ -0,0 +1,132 @@
+"""
+Update dispatcher: updates of one user are handled in order, different users - in parallel.
+"""
+
+
+import queue
+import threading
+import time
+
+from bot_init import init_logger
+
+
+# update fields with the user who sent the update
+user_fields = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request'
+)
+
+
+def get_update_user_id(update) -> int:
+    """Returns tg id of the user who sent the update (update_id for updates without user)"""
+    for field in user_fields:
+        content = getattr(update, field, None)
+        if content is None:
+            continue
+        user = getattr(content, 'from_user', None) or getattr(content, 'user', None)
+        if user is not None:
+            return user.id
+    return update.update_id
+
+
+def get_update_json_user_id(update_json: dict) -> int:
+    """Same as get_update_user_id, but for update as it comes from Telegram (dict)"""
+    for field in user_fields:
+        content = update_json.get(field)
+        if content is None:
+            continue
+        user = content.get('from') or content.get('user')
+        if user is not None:
+            return user['id']
+    return update_json['update_id']
+
+
+class Shard:
+    """Bounded queue of updates with one worker thread
+
+    Counters are changed by the worker and read by get_stats() from other threads under self.lock.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue = queue.Queue(queue_size)
+        self.processed = 0
+        self.last_lag = 0.0  # seconds between dispatching and handling of the last update
+        self.max_lag = 0.0
+        self.lock = threading.Lock()
+
+    def get_lag(self) -> float:
+        """Returns age of the oldest waiting update in seconds"""
+        with self.queue.mutex:
+            if not self.queue.queue:
+                return 0.0
+            return time.monotonic() - self.queue.queue[0][0]
+
+
+class UpdateDispatcher:
+    """Shards updates by tg user id
+
+    Call this with process_updates(updates list) - usually the original TeleBot.process_new_updates.
+    Each of {shards} workers handles its own queue one update after another, so the handlers of
+    one user never run at the same time. dispatch() blocks while the shard queue is full: polling
+    waits and webhook answers 503 when its ingress queue overflows.
+
+    on_dispatched(update) is called before the update is queued - polling must move its offset
+    there, otherwise the next getUpdates returns the updates which are still waiting in the queues.
+    Workers are started by start().
+    """
+
+    def __init__(self, process_updates, shards: int = 4, queue_size: int = 100,
+                 on_dispatched=None):
+        self.process_updates = process_updates
+        self.on_dispatched = on_dispatched
+        self.shards = [Shard(queue_size) for _ in range(shards)]
+        self.is_started = False
+
+    def start(self):
+        """Starts worker threads (once)"""
+        if self.is_started:
+            return
+        self.is_started = True
+        for index, shard in enumerate(self.shards):
+            threading.Thread(
+                target=self.work,
+                args=(shard,),
+                name=f'dispatcher_shard_{index}',
+                daemon=True
+            ).start()
+
+    def dispatch(self, updates: list):
+        """Puts updates into the queues of their shards"""
+        for update in updates:
+            if self.on_dispatched is not None:
+                self.on_dispatched(update)
+            shard = self.shards[get_update_user_id(update) % len(self.shards)]
+            shard.queue.put((time.monotonic(), update))
+
+    def work(self, shard: Shard):
+        while True:
+            dispatched_time, update = shard.queue.get()
+            with shard.lock:
+                shard.last_lag = time.monotonic() - dispatched_time
+                shard.max_lag = max(shard.max_lag, shard.last_lag)
+            try:
+                self.process_updates([update])
+            except Exception as exc:
+                init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+            with shard.lock:
+                shard.processed += 1
+
+    def get_stats(self) -> list[dict]:
+        """Returns queue depth, lag and number of processed updates for each shard"""
+        stats = []
+        for shard in self.shards:
+            with shard.lock:
+                stats.append({
+                    'depth': shard.queue.qsize(),
+                    'lag': round(shard.get_lag(), 3),
+                    'last_lag': round(shard.last_lag, 3),
+                    'max_lag': round(shard.max_lag, 3),
+                    'processed': shard.processed
+                })
+        return stats
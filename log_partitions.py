@@ -0,0 +1,257 @@
+"""
+Monthly range partitions of the 'message_log' and 'logs' tables, retention and archiving.
+
+Each table is partitioned by its timestamp: {table}_pYYYYMM for each month, {table}_legacy with
+rows written before partitioning and {table}_default for rows out of the prepared months.
+maintain() prepares partitions for the next months and removes the ones which are older than
+the retention period of the table - archives them to {log_archive_dir}/{partition}.jsonl.zst
+(.jsonl.gz if the "zstandard" package isn't installed) and drops, drops or only detaches them.
+"""
+
+
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import typing
+
+import sqlalchemy
+
+import db_handler
+from bot_init import init_logger
+
+
+class RetentionPolicy(typing.NamedTuple):
+    """How long partitions of {table} are kept and what is done with them after that"""
+    table: str
+    id_column: str
+    timestamp_column: str
+    retention_months: int  # 0 - keep forever
+    action: str  # 'archive' - save to a file and drop, 'drop' or 'detach' (keep as a table)
+    indexes: tuple  # indexes of the table created before partitioning (they are reused)
+
+
+policies = (
+    RetentionPolicy(
+        'message_log',
+        'internal_msg_id',
+        'msg_timestamp',
+        int(os.environ.get('message_log_retention_months', 12)),
+        os.environ.get('message_log_retention_action', 'archive'),
+        ('ix_message_log_tg_user_id', )
+    ),
+    RetentionPolicy(
+        'logs',
+        'event_id',
+        'event_timestamp',
+        int(os.environ.get('logs_retention_months', 24)),
+        os.environ.get('logs_retention_action', 'archive'),
+        ()
+    )
+)
+premake_months = 3  # partitions are created in advance for the current and the next months
+archive_dir = os.environ.get('log_archive_dir', 'archive')
+maintain_lock = threading.Lock()
+
+
+def get_month_start(moment: datetime.datetime, shift: int = 0) -> datetime.datetime:
+    """Returns the start of the month {shift} months after the month of {moment}"""
+    months = moment.year * 12 + moment.month - 1 + shift
+    return datetime.datetime(months // 12, months % 12 + 1, 1)
+
+
+def get_partitions(connection, table: str) -> dict:
+    """Returns {partition name: upper bound (None for the default partition)}"""
+    statement = sqlalchemy.text(
+        'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)'
+    )
+    partitions = dict()
+    for name, bound in connection.execute(statement, {'table': table}).all():
+        upper_bound = re.search(r"TO \('([^']+)'\)", bound)
+        partitions[name] = \
+            datetime.datetime.fromisoformat(upper_bound.group(1)) if upper_bound else None
+    return partitions
+
+
+def is_partitioned(connection, table: str) -> bool:
+    statement = sqlalchemy.text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)')
+    return connection.execute(statement, {'table': table}).scalar() == 'p'
+
+
+def ensure_partitions(connection, policy: RetentionPolicy):
+    """Creates partitions for the current month and {premake_months} months after it"""
+    upper_bounds = [i for i in get_partitions(connection, policy.table).values() if i is not None]
+    now = datetime.datetime.now()
+    for shift in range(premake_months + 1):
+        month_start = get_month_start(now, shift)
+        if upper_bounds and month_start < max(upper_bounds):
+            continue  # already covered (by the legacy partition too)
+        connection.execute(sqlalchemy.text(
+            f'CREATE TABLE IF NOT EXISTS {policy.table}_p{month_start:%Y%m} '
+            f'PARTITION OF {policy.table} '
+            f"FOR VALUES FROM ('{month_start}') TO ('{get_month_start(month_start, 1)}')"
+        ))
+    connection.execute(sqlalchemy.text(
+        f'CREATE TABLE IF NOT EXISTS {policy.table}_default PARTITION OF {policy.table} DEFAULT'
+    ))
+
+
+def partition_table(connection, policy: RetentionPolicy):
+    """Turns {policy.table} into a partitioned table, existing rows become the legacy partition
+
+    Long steps (validation of the bound, the unique index) don't block writes, the table is
+    swapped in one short transaction which gives up after lock_timeout instead of queueing the
+    writers behind it.
+
+    :param connection: connection in AUTOCOMMIT mode
+    :param policy: RetentionPolicy of the table
+    :return: None
+    """
+    if is_partitioned(connection, policy.table):
+        ensure_partitions(connection, policy)
+        return
+
+    table, id_column, timestamp_column = policy.table, policy.id_column, policy.timestamp_column
+    cutover = get_month_start(datetime.datetime.now(), 2)
+    init_logger.info('Partitioning %s, rows before %s become %s_legacy' % (table, cutover, table))
+    connection.execute(sqlalchemy.text(
+        f"UPDATE {table} SET {timestamp_column} = '1970-01-01' WHERE {timestamp_column} IS NULL"
+    ))
+    connection.execute(sqlalchemy.text(
+        f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_legacy_bound'
+    ))
+    connection.execute(sqlalchemy.text(
+        f'ALTER TABLE {table} ADD CONSTRAINT {table}_legacy_bound CHECK ({timestamp_column} IS NOT '
+        f"NULL AND {timestamp_column} < '{cutover}') NOT VALID"
+    ))
+    connection.execute(sqlalchemy.text(
+        f'ALTER TABLE {table} VALIDATE CONSTRAINT {table}_legacy_bound'
+    ))
+    connection.execute(sqlalchemy.text(f'DROP INDEX CONCURRENTLY IF EXISTS {table}_legacy_pkey'))
+    connection.execute(sqlalchemy.text(
+        f'CREATE UNIQUE INDEX CONCURRENTLY {table}_legacy_pkey '
+        f'ON {table} ({id_column}, {timestamp_column})'
+    ))
+    statement = sqlalchemy.text('SELECT pg_get_serial_sequence(:table, :column)')
+    sequence = connection.execute(statement, {'table': table, 'column': id_column}).scalar()
+
+    with db_handler.engine.begin() as swap_connection:
+        swap_connection.execute(sqlalchemy.text("SET LOCAL lock_timeout = '10s'"))
+        swap_connection.execute(sqlalchemy.text(
+            f'ALTER TABLE {table} ALTER COLUMN {timestamp_column} SET NOT NULL'
+        ))
+        swap_connection.execute(sqlalchemy.text(f'ALTER TABLE {table} RENAME TO {table}_legacy'))
+        swap_connection.execute(sqlalchemy.text(
+            f'ALTER INDEX IF EXISTS {table}_pkey RENAME TO {table}_legacy_id_pkey'
+        ))
+        swap_connection.execute(sqlalchemy.text(
+            f'CREATE TABLE {table} (LIKE {table}_legacy INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ({timestamp_column})'
+        ))
+        swap_connection.execute(sqlalchemy.text(
+            f'ALTER TABLE {table} ADD PRIMARY KEY ({id_column}, {timestamp_column})'
+        ))
+        # the sequence would be dropped with the legacy partition
+        swap_connection.execute(sqlalchemy.text(
+            f'ALTER SEQUENCE {sequence} OWNED BY {table}.{id_column}'
+        ))
+        swap_connection.execute(sqlalchemy.text(
+            f'ALTER TABLE {table} ATTACH PARTITION {table}_legacy '
+            f"FOR VALUES FROM (MINVALUE) TO ('{cutover}')"
+        ))
+        for index_name in policy.indexes:
+            statement = sqlalchemy.text('SELECT pg_get_indexdef(to_regclass(:index_name))')
+            definition = swap_connection.execute(statement, {'index_name': index_name}).scalar()
+            if definition is None:
+                continue
+            legacy_index_name = f'{index_name}_legacy'
+            swap_connection.execute(sqlalchemy.text(
+                f'ALTER INDEX {index_name} RENAME TO {legacy_index_name}'
+            ))
+            index_method = definition[definition.index(' USING '):]  # like ' USING btree (...)'
+            swap_connection.execute(sqlalchemy.text(
+                f'CREATE INDEX {index_name} ON ONLY {table}{index_method}'
+            ))
+            swap_connection.execute(sqlalchemy.text(
+                f'ALTER INDEX {index_name} ATTACH PARTITION {legacy_index_name}'
+            ))
+    ensure_partitions(connection, policy)
+
+
+def archive_partition(partition: str) -> str:
+    """Writes rows of {partition} to a compressed JSON Lines file, returns the file path"""
+    try:
+        import zstandard  # optional dependency, gzip is used without it
+    except ImportError:
+        zstandard = None
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, partition + ('.jsonl.zst' if zstandard else '.jsonl.gz'))
+    if zstandard:
+        archive_file = io.TextIOWrapper(
+            zstandard.ZstdCompressor().stream_writer(open(path + '.part', 'wb')),
+            encoding='utf-8'
+        )
+    else:
+        archive_file = gzip.open(path + '.part', 'wt', encoding='utf-8')
+    rows_count = 0
+    with archive_file, db_handler.engine.connect() as connection:
+        # server-side cursor: the partition isn't loaded into memory
+        result = connection.execution_options(stream_results=True).\
+            execute(sqlalchemy.text(f'SELECT * FROM {partition}'))
+        for row in result:
+            archive_file.write(json.dumps(dict(row._mapping), default=str, ensure_ascii=False))
+            archive_file.write('\n')
+            rows_count += 1
+    os.replace(path + '.part', path)
+    init_logger.info('Archived %s rows of %s to %s' % (rows_count, partition, path))
+    return path
+
+
+def apply_retention(connection, policy: RetentionPolicy) -> list:
+    """Removes partitions which ended before the retention period, returns their names"""
+    if not policy.retention_months:
+        return []
+    cutoff = get_month_start(datetime.datetime.now(), -policy.retention_months)
+    removed = []
+    for partition, upper_bound in sorted(get_partitions(connection, policy.table).items()):
+        if upper_bound is None or upper_bound > cutoff:
+            continue
+        if policy.action == 'archive':
+            archive_partition(partition)
+        connection.execute(sqlalchemy.text(
+            f'ALTER TABLE {policy.table} DETACH PARTITION {partition}'
+        ))
+        if policy.action in ('archive', 'drop'):
+            connection.execute(sqlalchemy.text(f'DROP TABLE {partition}'))
+        init_logger.info('Partition %s is removed from %s (%s)' % (
+            partition, policy.table, policy.action
+        ))
+        removed.append(partition)
+    return removed
+
+
+def maintain():
+    """Prepares partitions and applies retention policies (skipped if it's already running)"""
+    if not maintain_lock.acquire(blocking=False):
+        return
+    try:
+        with db_handler.engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            for policy in policies:
+                try:
+                    ensure_partitions(connection, policy)
+                    apply_retention(connection, policy)
+                except Exception as exc:
+                    init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+    finally:
+        maintain_lock.release()
+
+
+def get_stats() -> dict:
+    """Returns {table: number of partitions}"""
+    with db_handler.engine.connect() as connection:
+        return {policy.table: len(get_partitions(connection, policy.table)) for policy in policies}
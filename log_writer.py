@@ -0,0 +1,127 @@
+"""
+Write-behind buffer for the 'message_log' table.
+"""
+
+
+import atexit
+import queue
+import threading
+import time
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import db_handler
+from bot_init import init_logger
+
+
+class MessageLogWriter:
+    """Buffers 'message_log' rows and inserts them in bulk from a separate thread
+
+    A batch is written when {batch_size} rows are collected or {flush_interval} seconds have passed
+    (psycopg2 turns it into a multi-row INSERT). If the buffer is full, put() waits up to
+    {put_timeout} seconds (the row is counted as delayed) and then drops the row (counted as
+    dropped), so a slow database can't stall the handlers.
+    """
+
+    def __init__(self, max_size=10000, batch_size=500, flush_interval=1.0, put_timeout=0.5):
+        self.buffer = queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.counters = {'written': 0, 'delayed': 0, 'dropped': 0, 'failed': 0}
+        self.counters_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Starts the flushing thread, remaining rows are flushed at exit"""
+        self.thread = threading.Thread(target=self.run, name='message_log_writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the flushing thread and writes everything that is left in the buffer"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        while batch := self.collect(0):
+            self.flush(batch)
+
+    def count(self, counter: str, value: int = 1):
+        with self.counters_lock:
+            self.counters[counter] += value
+
+    def put(self, tg_id, msg_id, msg_txt, msg_t_stamp):
+        """Queues message with message-info for table 'message_log'
+
+        Same params as db_handler.add_message_in_log, which is used if the writer isn't started
+        """
+        if self.thread is None:
+            db_handler.add_message_in_log(tg_id, msg_id, msg_txt, msg_t_stamp)
+            return
+        row = {
+            'tg_user_id': tg_id,
+            'msg_tg_id': msg_id,
+            'msg_text': '%s' % msg_txt,
+            'msg_timestamp': db_handler.get_normal_date_from_timestamp(msg_t_stamp)
+        }
+        try:
+            self.buffer.put_nowait(row)
+        except queue.Full:
+            self.count('delayed')
+            try:
+                self.buffer.put(row, timeout=self.put_timeout)
+            except queue.Full:
+                self.count('dropped')
+                init_logger.warning('Message log buffer is full, dropped message from %s' % tg_id)
+                return
+        init_logger.info('Message "%s" from user with id: %s' % (msg_txt, tg_id))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            batch = self.collect(self.flush_interval)
+            if batch:
+                self.flush(batch)
+
+    def collect(self, interval: float) -> list:
+        """Takes up to batch_size rows from the buffer, waits no longer than {interval} seconds"""
+        batch = []
+        deadline = time.monotonic() + interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.buffer.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch: list):
+        """Inserts batch in one transaction, falls back to row by row insert on error"""
+        try:
+            with db_handler.engine.begin() as connection:
+                connection.execute(insert(db_handler.MessageLog), batch)
+            self.count('written', len(batch))
+            return
+        except SQLAlchemyError as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+
+        # one bad row (like a message from unknown user) shouldn't cost the whole batch
+        for row in batch:
+            try:
+                with db_handler.engine.begin() as connection:
+                    connection.execute(insert(db_handler.MessageLog), row)
+                self.count('written')
+            except SQLAlchemyError:
+                self.count('failed')
+
+    def get_stats(self) -> dict:
+        """Returns counters and current buffer size"""
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats['queued'] = self.buffer.qsize()
+        return stats
+
+
+message_log_writer = MessageLogWriter()
@@ -0,0 +1,53 @@
+"""
+Cache of keyboards serialized to JSON (telebot sends a string reply_markup as it is).
+"""
+
+
+import collections
+import threading
+
+
+class MarkupCache:
+    """Serialized keyboards keyed by tuples like ('question', quiz_id, quest_id)
+
+    Each entry keeps the version it was built for - quiz definition version (quiz_cache) or
+    catalog generation (quiz_catalog). An entry of another version is built again and replaced,
+    so keyboards are invalidated together with quiz definitions and the catalog. Keeps at most
+    {max_size} entries, the least recently used one is evicted first.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # {key: (version, JSON string or None)}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple, version: int, build) -> str or None:
+        """Returns serialized keyboard, build() makes the keyboard (or None) if it isn't cached"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+        markup = build()
+        serialized = None if markup is None else markup.to_json()
+        with self.lock:
+            self.entries[key] = (version, serialized)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return serialized
+
+    def get_stats(self) -> dict:
+        """Returns hits, misses, hit rate and number of cached keyboards"""
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                'size': len(self.entries)
+            }
@@ -0,0 +1,265 @@
+"""
+Prometheus metrics: update counts, handler and query latency, stats of queues and caches.
+
+Counters and histograms are kept in memory, stats sources (get_stats() of the bot parts) are read
+when the endpoint is scraped. The embedded HTTP server answers GET /metrics in the Prometheus text
+format.
+"""
+
+
+import bisect
+import collections
+import contextlib
+import functools
+import http.server
+import inspect
+import threading
+import time
+
+from sqlalchemy import event
+
+from bot_init import init_logger
+
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+query_count_buckets = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+query_operations = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')  # the rest are 'OTHER'
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    """Returns labels like '{handler="start"}' ('' without labels)"""
+    if not label_names:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter:
+    """Counter with labels, call inc() with a tuple of label values"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = collections.defaultdict(float)  # {label values: value}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values: tuple = (), value: float = 1):
+        with self.lock:
+            self.values[label_values] += value
+
+    def collect(self) -> list:
+        """Returns lines of the text format"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    """Histogram with labels, call observe() with a tuple of label values"""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (),
+                 buckets: tuple = default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = dict()  # {label values: [counts of buckets, sum, count]}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def collect(self) -> list:
+        """Returns lines of the text format (cumulative buckets, _sum and _count)"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf', ), counts + [None]):
+                    cumulative = count if bucket_count is None else cumulative + bucket_count
+                    labels = format_labels(
+                        self.label_names + ('le', ),
+                        label_values + (bound, )
+                    )
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+updates = Counter(
+    'bot_updates_total',
+    'Updates handled by the handlers, status is ok or error',
+    ('handler', 'status')
+)
+handler_seconds = Histogram('bot_handler_seconds', 'Time of handling one update', ('handler', ))
+update_queries = Histogram(
+    'bot_update_db_queries',
+    'Database round-trips made while handling one update',
+    ('handler', ),
+    query_count_buckets
+)
+query_seconds = Histogram('bot_db_query_seconds', 'Time of database statements', ('operation', ))
+function_seconds = Histogram(
+    'bot_db_function_seconds',
+    'Time of db_handler functions (with their queries)',
+    ('function', )
+)
+collectors = [updates, handler_seconds, update_queries, query_seconds, function_seconds]
+stats_sources = dict()  # {name: get_stats}
+current_update = threading.local()  # round-trips of the update handled by this thread
+
+
+@contextlib.contextmanager
+def track_update(handler: str):
+    """Counts the update of {handler}, its time and database round-trips"""
+    current_update.queries = 0
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        handler_seconds.observe((handler, ), time.perf_counter() - started)
+        updates.inc((handler, status))
+        update_queries.observe((handler, ), current_update.queries)
+
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info['metrics_started'] = time.perf_counter()
+
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['metrics_started']
+    operation = statement.split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    if operation not in query_operations:
+        operation = 'OTHER'
+    query_seconds.observe((operation, ), elapsed)
+    current_update.queries = getattr(current_update, 'queries', 0) + 1
+
+
+def instrument_engine(engine):
+    """Measures statements of {engine} (sqlalchemy.engine.Engine)"""
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def timed(func, histogram: Histogram = function_seconds):
+    """Returns {func} which puts its time into {histogram} labeled with the function name"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe((func.__name__, ), time.perf_counter() - started)
+
+    return wrapper
+
+
+def instrument_module(module):
+    """Replaces public functions of {module} with timed ones
+
+    Statement builders (*_statement) and generator functions are left as they are. Callers get
+    timed functions only if they look them up in the module at call time (module.function()).
+    """
+    for name, value in list(vars(module).items()):
+        if not inspect.isfunction(value) or value.__module__ != module.__name__:
+            continue
+        if name.startswith('_') or name.endswith('_statement'):
+            continue
+        if inspect.isgeneratorfunction(value) or hasattr(value, '__wrapped__'):
+            continue
+        setattr(module, name, timed(value))
+
+
+def register_stats(name: str, get_stats):
+    """Adds get_stats() -> dict (or list of dicts, one for each shard) to the endpoint
+
+    Numbers of the dict become gauges bot_{name}_{key}, shards are labeled by their index.
+    """
+    stats_sources[name] = get_stats
+
+
+def collect_stats() -> list:
+    """Returns gauges of all stats sources in the text format"""
+    lines = []
+    for name, get_stats in stats_sources.items():
+        try:
+            stats = get_stats()
+        except Exception as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+            continue
+        samples = collections.defaultdict(list)  # {metric name: [line, ...]}
+        for index, shard_stats in enumerate(stats if isinstance(stats, list) else [stats]):
+            labels = format_labels(('shard', ), (index, )) if isinstance(stats, list) else ''
+            for key, value in shard_stats.items():
+                if isinstance(value, (int, float)):
+                    metric_name = f'bot_{name}_{key}'
+                    samples[metric_name].append(f'{metric_name}{labels} {float(value)}')
+        for metric_name, metric_lines in samples.items():
+            lines.append(f'# TYPE {metric_name} gauge')
+            lines.extend(metric_lines)
+    return lines
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text format"""
+    lines = []
+    for collector in collectors:
+        lines.extend(collector.collect())
+    lines.extend(collect_stats())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        init_logger.debug('Metrics: ' + format % args)
+
+
+class MetricsServer:
+    """HTTP server of the metrics endpoint (keep it local, there is no authentication)"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9464):
+        self.http_server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.http_server.serve_forever, name='metrics', daemon=True).start()
+        init_logger.info('Metrics are available on http://%s:%s/metrics'
+                         % self.http_server.server_address[:2])
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
@@ -0,0 +1,195 @@
+"""
+Versioned schema migrations: python migrations.py [status].
+
+Applied versions are recorded in the 'schema_version' table. upgrade() applies the missing ones
+in order, holding a PostgreSQL advisory lock, so several processes started at once migrate the
+database only once. Migrations run while the bot is working: indexes are built CONCURRENTLY
+(without blocking writes) and backfills are idempotent.
+"""
+
+
+import datetime
+import os
+import sys
+import time
+import typing
+
+import sqlalchemy
+from sqlalchemy import Column
+from sqlalchemy import INTEGER
+from sqlalchemy import TEXT
+from sqlalchemy import TIMESTAMP
+
+import db_handler
+import log_partitions
+from bot_init import init_logger
+
+
+migration_lock_id = int(os.environ.get('migration_lock_id', 7318002))
+
+schema_version = sqlalchemy.Table(
+    'schema_version',
+    sqlalchemy.MetaData(),
+    Column('version', INTEGER, primary_key=True),  # number of the applied migration
+    Column('description', TEXT),
+    Column('applied_at', TIMESTAMP)
+)
+
+
+class Migration(typing.NamedTuple):
+    """Schema change, upgrade(connection) gets a connection in AUTOCOMMIT mode"""
+    version: int
+    description: str
+    upgrade: typing.Callable
+
+
+def create_tables(connection):
+    """Creates missing tables (all of them in a new database)"""
+    db_handler.Base.metadata.create_all(connection)
+    for policy in log_partitions.policies:
+        # a new database gets partitioned tables at once
+        if log_partitions.is_partitioned(connection, policy.table):
+            log_partitions.ensure_partitions(connection, policy)
+
+
+def create_index_concurrently(connection, index_name: str, definition: str):
+    """Builds index without blocking writes
+
+    An interrupted CONCURRENTLY build leaves an invalid index, it's dropped and built again.
+
+    :param connection: connection in AUTOCOMMIT mode
+    :param index_name: name of the index
+    :param definition: the rest of CREATE INDEX after the name, like 'ON table (column)'
+    :return: None
+    """
+    statement = sqlalchemy.text(
+        'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = :index_name'
+    )
+    is_valid = connection.execute(statement, {'index_name': index_name}).scalar()
+    if is_valid:
+        return
+    if is_valid is False:
+        connection.execute(sqlalchemy.text(f'DROP INDEX CONCURRENTLY {index_name}'))
+    init_logger.info('Building index %s' % index_name)
+    connection.execute(sqlalchemy.text(f'CREATE INDEX CONCURRENTLY {index_name} {definition}'))
+
+
+def create_hot_query_indexes(connection):
+    """Indexes for the filters of db_handler queries"""
+    indexes = (
+        # message history of user
+        ('ix_message_log_tg_user_id', 'ON message_log (tg_user_id, msg_timestamp)'),
+        # answers of user in quiz: resume point, rewriting, completed quizzes
+        (
+            'ix_questions_answers_quiz_user',
+            'ON questions_answers (quiz_id, internal_user_id, quest_id)'
+        ),
+        # questions of quiz (quiz definitions)
+        ('ix_quiz_questions_quiz_id', 'ON quiz_questions (quiz_id, quest_id)'),
+        # active bans, closed ones aren't indexed
+        ('ix_ban_list_active', 'ON ban_list (tg_id) WHERE current_status = true')
+    )
+    for index_name, definition in indexes:
+        create_index_concurrently(connection, index_name, definition)
+
+
+def rebuild_answer_counters(connection):
+    """Counts answers given before 'answer_counters' existed"""
+    db_handler.rebuild_answer_counters('system')
+
+
+def convert_quiz_statuses(connection):
+    """Moves quiz statuses of the old format to 'quiz_session'"""
+    db_handler.convert_quiz_statuses()
+
+
+def fill_quiz_completions(connection):
+    """Fills 'quiz_completion' from answers given before it existed"""
+    db_handler.fill_quiz_completions()
+
+
+def partition_log_tables(connection):
+    """Monthly partitions of 'message_log' and 'logs' (see log_partitions)"""
+    for policy in log_partitions.policies:
+        log_partitions.partition_table(connection, policy)
+
+
+def create_quiz_upload(connection):
+    """Table of imported quiz files"""
+    db_handler.QuizUpload.__table__.create(connection, checkfirst=True)
+
+
+def add_mailing_claims(connection):
+    """Recipients of mailings are taken for sending by one process (see broadcast)"""
+    connection.execute(sqlalchemy.text(
+        'ALTER TABLE mailing_recipient ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP'
+    ))
+
+
+migrations = (
+    Migration(1, 'Tables', create_tables),
+    Migration(2, 'Indexes for the hot queries', create_hot_query_indexes),
+    Migration(3, 'Answer counters from answers', rebuild_answer_counters),
+    Migration(4, 'Quiz statuses from user to quiz_session', convert_quiz_statuses),
+    Migration(5, 'Quiz completions from answers', fill_quiz_completions),
+    Migration(6, 'Partitioned message_log and logs', partition_log_tables),
+    Migration(7, 'Quiz uploads by content hash', create_quiz_upload),
+    Migration(8, 'Claims of mailing recipients', add_mailing_claims)
+)
+
+
+def get_version(connection) -> int:
+    """Returns the last applied version (0 for a database without migrations)"""
+    statement = sqlalchemy.select(sqlalchemy.func.max(schema_version.c.version))
+    return connection.execute(statement).scalar() or 0
+
+
+def upgrade() -> int:
+    """Applies missing migrations
+
+    :return: schema version
+    """
+    with db_handler.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        # waiting with pg_advisory_lock would hold a snapshot, CREATE INDEX CONCURRENTLY in another
+        # process waits for older snapshots - so the lock is polled
+        lock_statement = sqlalchemy.text('SELECT pg_try_advisory_lock(:lock_id)')
+        while not connection.execute(lock_statement, {'lock_id': migration_lock_id}).scalar():
+            time.sleep(1)
+        try:
+            schema_version.create(connection, checkfirst=True)
+            version = get_version(connection)
+            for migration in migrations:
+                if migration.version <= version:
+                    continue
+                init_logger.info('Applying migration %s: %s' % (
+                    migration.version, migration.description
+                ))
+                migration.upgrade(connection)
+                connection.execute(schema_version.insert().values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.datetime.now()
+                ))
+                version = migration.version
+        finally:
+            unlock_statement = sqlalchemy.text('SELECT pg_advisory_unlock(:lock_id)')
+            connection.execute(unlock_statement, {'lock_id': migration_lock_id})
+    return version
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        with db_handler.engine.connect() as connection:
+            if not sqlalchemy.inspect(connection).has_table('schema_version'):
+                version = 0
+            else:
+                version = get_version(connection)
+        print(f'Schema version: {version}, latest: {migrations[-1].version}')
+    else:
+        print(f'Schema version: {upgrade()}')
+
+
+if __name__ == '__main__':
+    main()
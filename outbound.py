@@ -0,0 +1,318 @@
+"""
+Outbound message dispatcher: handlers queue replies, worker threads send them to Telegram.
+"""
+
+
+import atexit
+import collections
+import heapq
+import queue
+import threading
+import time
+
+import requests
+import requests.adapters
+from telebot.apihelper import ApiTelegramException
+
+import broadcast
+from bot_init import init_logger
+
+
+def get_session(pool_size: int) -> requests.Session:
+    """Returns HTTP session which keeps up to {pool_size} connections to the Bot API alive"""
+    session = requests.Session()
+    session.mount(
+        'https://',
+        requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    )
+    return session
+
+
+class OutboundMessage:
+    """Message waiting in the queue of its chat
+
+    A new message if message_id is None, otherwise a new keyboard (markup) of message {message_id};
+    a document (file name, bytes) is sent instead of the text if it's set. on_done(error) is called
+    when the message is sent (error is None) or dropped.
+    """
+
+    def __init__(self, chat_id, message_text: str or None, markup=None, message_id: int = None,
+                 document: tuple = None, on_done=None):
+        self.chat_id = chat_id
+        self.message_text = message_text
+        self.markup = markup
+        self.message_id = message_id
+        self.document = document
+        self.on_done = on_done
+        self.queued_at = time.monotonic()
+        self.attempt = 1
+
+
+class Shard:
+    """Incoming queue of one worker thread and queues of its chats
+
+    Everything except incoming is used only by the worker thread.
+    """
+
+    def __init__(self, queue_size: int, max_chats: int):
+        self.incoming = queue.Queue(queue_size)
+        self.chats = dict()  # {chat_id: deque of OutboundMessage}
+        self.schedule = []  # heap of (send time, chat_id), one entry for each chat in self.chats
+        self.buckets = collections.OrderedDict()  # {chat_id: (tokens, timestamp)}
+        self.max_chats = max_chats
+        self.pending = 0  # messages in self.chats
+        self.stopping = False
+
+    def add(self, message: OutboundMessage):
+        messages = self.chats.get(message.chat_id)
+        if messages is None:
+            messages = self.chats[message.chat_id] = collections.deque()
+            heapq.heappush(self.schedule, (time.monotonic(), message.chat_id))
+        messages.append(message)
+        self.pending += 1
+
+    def take_token(self, chat_id, burst: int, rate: float) -> float:
+        """Takes a token of chat {chat_id}, returns 0 or seconds to wait for the next token"""
+        now = time.monotonic()
+        tokens, stamp = self.buckets.pop(chat_id, (burst, now))
+        tokens = min(burst, tokens + (now - stamp) * rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait_time = 0.0
+        else:
+            wait_time = (1 - tokens) / rate
+        self.buckets[chat_id] = (tokens, now)
+        while len(self.buckets) > self.max_chats:
+            self.buckets.popitem(last=False)  # an evicted chat simply gets a full bucket again
+        return wait_time
+
+
+class OutboundDispatcher:
+    """Sends messages from worker threads, so handlers don't wait for the Bot API
+
+    Call this with the bot (telebot.TeleBot). Messages are sharded by chat id: each of {workers}
+    threads sends messages of its chats in the order they were queued. A chat gets up to
+    {chat_burst} messages at once and then {chat_rate} messages per second (keyboard edits count
+    too), all chats together are paced by the AdaptiveRate {rate} (share it with the mailings).
+    A 429 response delays the chat for retry_after seconds, network errors and 5xx responses - for
+    1, 2, 4... seconds; the message is dropped after {max_attempts} attempts or any other error
+    (blocked bot and so on).
+
+    put(), put_document() and put_markup_edit() block while the queue of the shard is full (a
+    message queued by on_done of the same shard is added at once). Until start() is called the
+    requests are made by them directly.
+    """
+
+    def __init__(self, bot, workers: int = 8, queue_size: int = 1000, chat_burst: int = 3,
+                 chat_rate: float = 1.0, max_attempts: int = 5, max_chats: int = 10000,
+                 rate: broadcast.AdaptiveRate = None):
+        self.bot = bot
+        self.shards = [Shard(queue_size, max_chats) for _ in range(workers)]
+        self.chat_burst = chat_burst
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self.rate = rate or broadcast.AdaptiveRate()
+        self.counters = {'sent': 0, 'retried': 0, 'failed': 0}
+        self.send_time = {'last': 0.0, 'max': 0.0, 'total': 0.0}  # seconds of Bot API requests
+        self.latency = {'last': 0.0, 'max': 0.0, 'total': 0.0}  # seconds from put() to delivery
+        self.counters_lock = threading.Lock()
+        self.threads = []
+        self.worker = threading.local()  # shard of the current worker thread
+
+    def start(self):
+        """Starts worker threads, queued messages are sent at exit"""
+        for index, shard in enumerate(self.shards):
+            thread = threading.Thread(
+                target=self.work,
+                args=(shard,),
+                name=f'outbound_shard_{index}',
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float = 10):
+        """Stops worker threads after they send queued messages (waits up to {timeout} seconds)"""
+        threads, self.threads = self.threads, []
+        for shard in self.shards:
+            shard.incoming.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def put(self, chat_id, message_text: str, markup=None, on_done=None):
+        """Queues message for chat {chat_id}, markup is a keyboard or its JSON string
+
+        on_done(error) is called from the worker thread when the message is sent (error is None) or
+        dropped, keep it short.
+        """
+        self.queue_message(OutboundMessage(chat_id, message_text, markup, on_done=on_done))
+
+    def put_document(self, chat_id, file_name: str, file_content: bytes):
+        """Queues document for chat {chat_id}, it's sent after the messages queued before it"""
+        self.queue_message(OutboundMessage(chat_id, None, document=(file_name, file_content)))
+
+    def put_markup_edit(self, chat_id, message_id: int, markup=None):
+        """Queues replacement of the keyboard of message {message_id} (None removes it)"""
+        self.queue_message(OutboundMessage(chat_id, None, markup, message_id))
+
+    def queue_message(self, message: OutboundMessage):
+        if not self.threads:
+            try:
+                self.deliver(message)
+            except Exception as exc:
+                if message.on_done is None:
+                    raise
+                self.finish(message, exc)
+            else:
+                self.finish(message, None)
+            return
+        shard = self.shards[hash(message.chat_id) % len(self.shards)]
+        if getattr(self.worker, 'shard', None) is shard:
+            shard.add(message)  # on_done of this shard, its own queue may be full
+        else:
+            shard.incoming.put(message)
+
+    def finish(self, message: OutboundMessage, error: Exception or None):
+        """Calls on_done of {message}"""
+        if message.on_done is None:
+            return
+        try:
+            message.on_done(error)
+        except Exception as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+
+    def deliver(self, message: OutboundMessage):
+        """Makes the Bot API request of {message}"""
+        if message.document is not None:
+            file_name, file_content = message.document
+            self.bot.send_document(message.chat_id, file_content, visible_file_name=file_name)
+            init_logger.info('Document "%s" to user with id: %s' % (file_name, message.chat_id))
+        elif message.message_id is None:
+            self.bot.send_message(
+                message.chat_id,
+                message.message_text,
+                reply_markup=message.markup
+            )
+            init_logger.info('Message "%s" to user with id: %s' % (
+                message.message_text, message.chat_id
+            ))
+        else:
+            self.bot.edit_message_reply_markup(
+                message.chat_id,
+                message.message_id,
+                reply_markup=message.markup
+            )
+
+    def work(self, shard: Shard):
+        self.worker.shard = shard
+        while not shard.stopping or shard.chats:
+            timeout = None
+            if shard.schedule:
+                timeout = max(0.0, shard.schedule[0][0] - time.monotonic())
+            elif shard.stopping:
+                break
+            try:
+                message = shard.incoming.get(timeout=timeout)
+                while True:
+                    if message is None:
+                        shard.stopping = True
+                    else:
+                        shard.add(message)
+                    message = shard.incoming.get_nowait()
+            except queue.Empty:
+                pass
+            while shard.schedule and shard.schedule[0][0] <= time.monotonic():
+                _, chat_id = heapq.heappop(shard.schedule)
+                try:
+                    self.send_next(shard, chat_id)
+                except Exception as exc:
+                    init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+                    self.count('failed')
+                    self.finish(self.pop(shard, chat_id), exc)
+
+    def send_next(self, shard: Shard, chat_id):
+        """Sends the first message of chat {chat_id} and schedules the chat again"""
+        wait_time = shard.take_token(chat_id, self.chat_burst, self.chat_rate)
+        if wait_time:
+            heapq.heappush(shard.schedule, (time.monotonic() + wait_time, chat_id))
+            return
+        message = shard.chats[chat_id][0]
+        sent = False
+        retry_after = None  # seconds before the next attempt, None - the message can't be sent
+        self.rate.wait()
+        started = time.monotonic()
+        try:
+            self.deliver(message)
+            self.rate.on_success()
+            sent = True
+        except ApiTelegramException as exc:
+            if exc.error_code == 429:
+                retry_after = exc.result_json.get('parameters', {}).get('retry_after', 1)
+                self.rate.on_too_many_requests(retry_after)
+            elif exc.error_code >= 500:
+                retry_after = min(30, 2 ** (message.attempt - 1))
+            error = exc
+        except requests.exceptions.RequestException as exc:
+            retry_after = min(30, 2 ** (message.attempt - 1))
+            error = exc
+        finished = time.monotonic()
+        self.measure(self.send_time, finished - started)
+
+        if sent:
+            self.count('sent')
+            self.measure(self.latency, finished - message.queued_at)
+            error = None
+        elif retry_after is not None and message.attempt < self.max_attempts:
+            message.attempt += 1
+            self.count('retried')
+            heapq.heappush(shard.schedule, (finished + retry_after, chat_id))
+            return
+        else:
+            self.count('failed')
+            init_logger.error('Message to %s is dropped after %s attempts: %s' % (
+                chat_id, message.attempt, error
+            ))
+        self.pop(shard, chat_id)
+        self.finish(message, error)
+
+    def pop(self, shard: Shard, chat_id) -> OutboundMessage:
+        """Removes and returns the first message of chat {chat_id}
+
+        The chat is scheduled again if it has more messages.
+        """
+        messages = shard.chats[chat_id]
+        message = messages.popleft()
+        shard.pending -= 1
+        if messages:
+            heapq.heappush(shard.schedule, (time.monotonic(), chat_id))
+        else:
+            del shard.chats[chat_id]
+        return message
+
+    def count(self, counter: str, value: int = 1):
+        with self.counters_lock:
+            self.counters[counter] += value
+
+    def measure(self, timing: dict, seconds: float):
+        with self.counters_lock:
+            timing['last'] = seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['total'] += seconds
+
+    def get_stats(self) -> dict:
+        """Returns counters, queued messages and average/last/max send time and delivery latency"""
+        with self.counters_lock:
+            stats = dict(self.counters)
+            attempts = stats['sent'] + stats['retried'] + stats['failed']
+            for name, timing, count in (
+                ('send_time', self.send_time, attempts),
+                ('latency', self.latency, stats['sent'])
+            ):
+                stats[f'{name}_avg'] = round(timing['total'] / count, 3) if count else 0.0
+                stats[f'{name}_last'] = round(timing['last'], 3)
+                stats[f'{name}_max'] = round(timing['max'], 3)
+        stats['queued'] = sum(shard.incoming.qsize() + shard.pending for shard in self.shards)
+        stats['max_depth'] = max(shard.incoming.qsize() + shard.pending for shard in self.shards)
+        return stats
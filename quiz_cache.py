@@ -0,0 +1,129 @@
+"""
+In-process cache of quiz definitions (questions, answer options and gratitude).
+"""
+
+
+import threading
+import typing
+
+import quiz_plan
+
+
+class CachedQuestion(typing.NamedTuple):
+    """Immutable copy of db_handler.QuizQuestions with parsed answer options"""
+    quiz_id: int
+    quest_id: int
+    quest_relation: str or None
+    quest_text: str
+    quest_ans: str
+    answers: tuple
+
+    @property
+    def is_manual_input(self) -> bool:
+        return self.answers[0] == 'MANUAL_INPUT'
+
+
+class QuizDefinition(typing.NamedTuple):
+    """Immutable quiz definition, questions are ordered by quest_id"""
+    quiz_id: int
+    quiz_name: str
+    gratitude: str
+    questions: tuple
+    plan: quiz_plan.BranchPlan  # compiled question relations
+    version: int
+
+    def get_question(self, quest_id: int) -> CachedQuestion or None:
+        """Returns question by quest_id (starts from 1) or None if there is no such question"""
+        if 1 <= quest_id <= len(self.questions):
+            return self.questions[quest_id - 1]
+        return None
+
+
+class QuizCache:
+    """Cache of quiz definitions keyed by quiz_id
+
+    Call this with loader(quiz_ids) -> {quiz_id: (quiz_name, gratitude, tuple of CachedQuestion)}
+    and optional on_plan_errors(quiz_id, errors), which gets relations that can't be compiled
+    each time the quiz is loaded.
+
+    Each quiz has a version counter, invalidate() increases it. A definition loaded while the
+    quiz was invalidated is returned to the caller but isn't stored, so the cache never keeps
+    an outdated definition.
+    """
+
+    def __init__(self, loader, on_plan_errors=None):
+        self.loader = loader
+        self.on_plan_errors = on_plan_errors
+        self.definitions = dict()
+        self.versions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, quiz_id: int) -> QuizDefinition or None:
+        """Returns quiz definition or None if there is no such quiz"""
+        with self.lock:
+            definition = self.definitions.get(quiz_id)
+            if definition is not None:
+                self.hits += 1
+                return definition
+            self.misses += 1
+            versions = {quiz_id: self.versions.get(quiz_id, 0)}
+        return self.store(self.loader([quiz_id]), versions).get(quiz_id)
+
+    def peek(self, quiz_id: int) -> QuizDefinition or None:
+        """Returns quiz definition if it's cached (doesn't call the loader)"""
+        with self.lock:
+            definition = self.definitions.get(quiz_id)
+            if definition is not None:
+                self.hits += 1
+            return definition
+
+    def warm(self, quiz_ids: list or tuple):
+        """Loads definitions of {quiz_ids} with one loader call"""
+        with self.lock:
+            versions = {quiz_id: self.versions.get(quiz_id, 0) for quiz_id in quiz_ids}
+        if versions:
+            self.store(self.loader(list(versions)), versions)
+
+    def store(self, loaded: dict, versions: dict) -> dict:
+        result = dict()
+        with self.lock:
+            for quiz_id, (quiz_name, gratitude, questions) in loaded.items():
+                definition = QuizDefinition(
+                    quiz_id,
+                    quiz_name,
+                    gratitude,
+                    questions,
+                    quiz_plan.BranchPlan(questions),
+                    versions[quiz_id]
+                )
+                if self.versions.get(quiz_id, 0) == versions[quiz_id]:
+                    self.definitions[quiz_id] = definition
+                result[quiz_id] = definition
+        if self.on_plan_errors is not None:
+            for quiz_id, definition in result.items():
+                if definition.plan.errors:
+                    self.on_plan_errors(quiz_id, definition.plan.errors)
+        return result
+
+    def invalidate(self, quiz_id: int):
+        """Drops the definition and increases quiz version"""
+        with self.lock:
+            self.versions[quiz_id] = self.versions.get(quiz_id, 0) + 1
+            self.definitions.pop(quiz_id, None)
+
+    def get_version(self, quiz_id: int) -> int:
+        with self.lock:
+            return self.versions.get(quiz_id, 0)
+
+    def get_stats(self) -> dict:
+        """Returns hits, misses, hit rate and number of cached quizzes"""
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                'size': len(self.definitions)
+            }
@@ -0,0 +1,121 @@
+"""
+Quiz catalog: pages of the quiz list and cached snapshot of visible quizzes.
+"""
+
+
+import threading
+import time
+import typing
+
+
+class CatalogPage(typing.NamedTuple):
+    """One page of the catalog, quizzes are (quiz_name, quiz_id, quiz_status) from newer to older"""
+    quizzes: tuple
+    has_newer: bool
+    has_older: bool
+
+    @property
+    def first_id(self) -> int or None:
+        return self.quizzes[0][1] if self.quizzes else None
+
+    @property
+    def last_id(self) -> int or None:
+        return self.quizzes[-1][1] if self.quizzes else None
+
+
+class QuizCatalog:
+    """Keyset pagination over 'quiz_list' ordered by quiz_id DESC
+
+    Call this with loader(visible, before_id, after_id, limit) -> list of (quiz_name, quiz_id,
+    quiz_status) ordered by quiz_id DESC: quizzes with quiz_id < before_id (the newest ones if it's
+    None) or, if after_id is set, the oldest of quizzes with quiz_id > after_id.
+
+    Pages of the whole catalog are read from the DB with one indexed query. Visible quizzes are
+    kept in a snapshot which is dropped by invalidate() and after {ttl} seconds (changes made by
+    other processes). A snapshot loaded while the catalog was invalidated isn't stored.
+    """
+
+    def __init__(self, loader, page_size: int = 10, ttl: float = 60):
+        self.loader = loader
+        self.page_size = page_size
+        self.ttl = ttl
+        self.snapshot = None
+        self.loaded_at = 0.0
+        self.version = 0
+        self.generation = 0  # changes with every new snapshot (keys of cached menus)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_visible(self) -> tuple:
+        """Returns all visible quizzes (snapshot)"""
+        with self.lock:
+            if self.snapshot is not None and time.monotonic() - self.loaded_at < self.ttl:
+                self.hits += 1
+                return self.snapshot
+            self.misses += 1
+            version = self.version
+        snapshot = tuple(self.loader(True, None, None, None))
+        with self.lock:
+            if self.version == version:
+                self.snapshot = snapshot
+                self.loaded_at = time.monotonic()
+                self.generation += 1
+        return snapshot
+
+    def peek_visible(self) -> tuple or None:
+        """Returns the snapshot of visible quizzes if it's loaded (doesn't call the loader)"""
+        with self.lock:
+            if self.snapshot is not None and time.monotonic() - self.loaded_at < self.ttl:
+                self.hits += 1
+                return self.snapshot
+            return None
+
+    def get_page(self, visible: bool, before_id: int = None, after_id: int = None) -> CatalogPage:
+        """Returns page of quizzes older than {before_id} or newer than {after_id}"""
+        if visible:
+            quizzes = self.get_visible()
+            if after_id is not None:
+                newer = [quiz for quiz in quizzes if quiz[1] > after_id]
+                return CatalogPage(
+                    tuple(newer[-self.page_size:]),
+                    len(newer) > self.page_size,
+                    len(newer) < len(quizzes)
+                )
+            older = [quiz for quiz in quizzes if before_id is None or quiz[1] < before_id]
+            return CatalogPage(
+                tuple(older[:self.page_size]),
+                len(older) < len(quizzes),
+                len(older) > self.page_size
+            )
+
+        quizzes = self.loader(False, before_id, after_id, self.page_size + 1)
+        if after_id is not None:
+            return CatalogPage(
+                tuple(quizzes[-self.page_size:]),
+                len(quizzes) > self.page_size,
+                True
+            )
+        return CatalogPage(
+            tuple(quizzes[:self.page_size]),
+            before_id is not None,
+            len(quizzes) > self.page_size
+        )
+
+    def invalidate(self):
+        """Drops the snapshot of visible quizzes"""
+        with self.lock:
+            self.version += 1
+            self.generation += 1
+            self.snapshot = None
+
+    def get_stats(self) -> dict:
+        """Returns hits, misses, hit rate and number of visible quizzes in the snapshot"""
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                'size': len(self.snapshot) if self.snapshot is not None else 0
+            }
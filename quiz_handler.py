@@ -1,6 +1,16 @@
-import db_handler
-from bot_init import path
+import hashlib
+import io
 import os
+import zipfile
+
+import db_handler
+import quiz_plan
+
+
+quiz_separator = '==='  # line between quizzes in a multi-quiz file
+max_report_errors = 30
+max_file_size = int(os.environ.get('max_quiz_file_size', 1048576))  # bytes, unpacked for zip
+raw_quiz_archive = os.environ.get('raw_quiz_archive')  # content-addressed store of uploaded files
 
 
 class PreparedQuiz:
@@ -19,71 +29,205 @@ class PreparedQuiz:
 class Question:
     """Class to describe each question
 
-    Call this with (question text, answers, relation)
+    Call this with (question text, answers, relation[, line number in the file])
 
     Keep in mind patterns of relation: QUESTION_NUM -> DESIRED_ANSWER like '2 -> Yes'
     """
 
-    def __init__(self, text: str, answers: list or tuple, relation: str):
+    def __init__(self, text: str, answers: list or tuple, relation: str, line_number: int = None):
         self.text = text
         self.answers = answers
         self.relation = relation
+        self.line_number = line_number
 
 
-def dir_check():
-    """checks for the existence of a "raw_quizzes" directory and, if necessary, creates it"""
-    if 'raw_quizzes' not in os.listdir(path):
-        os.mkdir('raw_quizzes')
-
-
-def download_new_raw_quiz(bot, file_name, file_id):
-    """Downloads the file if it doesn't already exist and returns a tuple with a message and status
-
-    :param bot: current bot, telebot.TeleBot
-    :param file_name: filename, str
-    :param file_id: file id, int
-    :return: (message, status) where status - bool
-    """
-    if file_name not in os.listdir(f'{path}\\raw_quizzes'):
-
-        with open(f'raw_quizzes/{file_name}', 'w', encoding='utf-8', errors='ignore') \
-                as new_raw_quiz:
-            file_for_download = bot.download_file(file_id.file_path)
-            text_to_write = file_for_download.decode()
-            text_to_write = text_to_write.replace('\r', '')
-            new_raw_quiz.write(text_to_write)
-            return 'Первичный файл успешно загружен! Начинаем обработку!', True
-
-    else:
-        return 'Пожалуйста, переименуйте файл!', False
-
+def get_content_hash(file_content: bytes) -> str:
+    return hashlib.sha256(file_content).hexdigest()
 
-def new_quiz_handler(file_name, tg_id):
-    """Simple handler for adding a quiz"""
 
-    with open(f'raw_quizzes/{file_name}', 'r', encoding='utf-8') as opened_file:
-        file_content = [i[:-1] for i in opened_file.readlines()]
-    questions = get_questions_list(file_content[2:-1])
-    new_quiz = PreparedQuiz(file_content[0], file_content[1], questions, file_content[-1])
-    info_message = db_handler.add_new_quiz(new_quiz, tg_id)
-    return info_message
+def archive_raw_file(content_hash: str, file_name: str, file_content: bytes):
+    """Saves uploaded file to {raw_quiz_archive}/{hash[:2]}/{hash}.{extension} (if it's set)"""
+    if not raw_quiz_archive:
+        return
+    directory = os.path.join(raw_quiz_archive, content_hash[:2])
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, f'{content_hash}.{file_name.split(".")[-1].lower()}')
+    if os.path.exists(file_path):
+        return
+    with open(file_path + '.part', 'wb') as raw_file:
+        raw_file.write(file_content)
+    os.replace(file_path + '.part', file_path)
 
 
-def get_questions_list(input_list: list or tuple) -> list:
-    """Prepares data for insert into table
+def get_quiz_files(file_name: str, file_content: bytes) -> list:
+    """Returns [(source name, bytes), ...] - the file itself or .txt files of a zip archive
 
-    :param input_list: raw list or tuple with quest-info
-    :return: list containing instances of quiz_handler.Questions
+    :raise ValueError: if the archive is broken or unpacked files are bigger than max_file_size
+    """
+    if not file_name.lower().endswith('.zip'):
+        return [(file_name, file_content)]
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as archive:
+            members = sorted(
+                (
+                    info for info in archive.infolist()
+                    if not info.is_dir() and info.filename.lower().endswith('.txt')
+                ),
+                key=lambda i: i.filename
+            )
+            if sum(info.file_size for info in members) > max_file_size:
+                raise ValueError(f'файлы в архиве больше {max_file_size // 1024} КБ')
+            return [(info.filename, archive.read(info)) for info in members]
+    except zipfile.BadZipFile:
+        raise ValueError('не получилось открыть архив')
+
+
+def parse_question(line_number: int, question_string: str) -> Question:
+    """Parses question line like '[{1 -> Yes}]2. Text//\\\\Answer/\\Answer'
+
+    :raise ValueError: if there isn't exactly one question-answers separator
+    """
+    if question_string.count('//\\\\') != 1:
+        raise ValueError(f'строка {line_number}: нужен один разделитель //\\\\ вопроса и ответов')
+    question, answers = question_string.split('//\\\\')
+    relation = None
+    if question.startswith('[{'):
+        if '}]' not in question:
+            raise ValueError(f'строка {line_number}: условие должно заканчиваться на }}]')
+        char_num = question.index('}]') + 2
+        relation = question[:char_num][2:-2]
+        question = question[char_num:]
+    return Question(question, answers.split('/\\'), relation, line_number)
+
+
+def prepare_quiz(lines: list or tuple) -> PreparedQuiz:
+    """Makes PreparedQuiz from numbered lines [(line number, text), ...]: name, title, questions
+    and gratitude
+
+    :raise ValueError: if lines don't match the quiz file structure
+    """
+    if len(lines) < 4:
+        raise ValueError(
+            f'строка {lines[0][0]}: нужны название, заголовок, хотя бы один вопрос и благодарность'
+        )
+    questions = [parse_question(line_number, line) for line_number, line in lines[2:-1]]
+    return PreparedQuiz(lines[0][1], lines[1][1], questions, lines[-1][1])
+
+
+def validate_quiz(quiz: PreparedQuiz) -> list:
+    """Returns a list of errors which would break the insert or the quiz itself"""
+    errors = []
+    if not quiz.name.strip() or len(quiz.name) > 128:
+        errors.append('название должно быть непустым и не длиннее 128 символов')
+    if len(quiz.gratitude) > 512:
+        errors.append('благодарность должна быть не длиннее 512 символов')
+    for number, question in enumerate(quiz.questions, 1):
+        line = f'строка {question.line_number}: ' if question.line_number else ''
+        if question.text.split('.')[0] != str(number) or ' ' not in question.text:
+            errors.append(f'{line}вопрос {number} должен начинаться с "{number}. "')
+        if not all(answer.strip() for answer in question.answers):
+            errors.append(f'{line}у вопроса {number} есть пустой вариант ответа')
+        if question.relation and len(question.relation) > 50:
+            errors.append(f'{line}условие вопроса {number} длиннее 50 символов')
+        try:
+            quiz_plan.compile_relation(question.relation, number)
+        except ValueError as exc:
+            errors.append(f'{line}{exc}')
+    return errors
+
+
+def parse_quizzes(source: str, file_content: bytes) -> tuple:
+    """Parses quizzes of one file in a single pass over its lines
+
+    :param source: file name for error messages
+    :param file_content: file content (UTF-8 text, quizzes are separated by {quiz_separator})
+    :return: ([PreparedQuiz, ...], [error, ...])
+    """
+    quizzes = []
+    errors = []
+    lines = []  # (line number, text) of the current quiz
+
+    def finish_quiz():
+        while lines and not lines[-1][1].strip():
+            lines.pop()
+        first_line = 0
+        while first_line < len(lines) and not lines[first_line][1].strip():
+            first_line += 1
+        if first_line == len(lines):
+            return
+        label = f'{source}, опрос {len(quizzes) + 1}'
+        try:
+            quiz = prepare_quiz(lines[first_line:])
+        except ValueError as exc:
+            errors.append(f'{label}: {exc}')
+            quizzes.append(None)
+            return
+        errors.extend(f'{label} "{quiz.name}": {error}' for error in validate_quiz(quiz))
+        quizzes.append(quiz)
+
+    for line_number, raw_line in enumerate(io.BytesIO(file_content), 1):
+        try:
+            line = raw_line.decode('utf-8')
+        except UnicodeDecodeError:
+            errors.append(f'{source}, строка {line_number}: текст не в кодировке UTF-8')
+            line = raw_line.decode('utf-8', errors='replace')
+        line = line.rstrip('\r\n')
+        if line.strip() == quiz_separator:
+            finish_quiz()
+            lines.clear()
+        else:
+            lines.append((line_number, line))
+    finish_quiz()
+    return [quiz for quiz in quizzes if quiz is not None], errors
+
+
+def import_quizzes(file_name: str, file_content: bytes, tg_id) -> str:
+    """Checks all quizzes of the file and adds them in one transaction
+
+    The file is handled in memory. Nothing is added if any quiz has errors or the same file
+    (by content hash) has already been imported.
+
+    :param file_name: name of .txt file (one or several quizzes) or .zip with such files
+    :param file_content: file content
+    :param tg_id: initiator id
+    :return: report for the editor
     """
-    return_list = []
-    for question_string in input_list:
-        question, answers = question_string.split('//\\\\')
-        answers = answers.split('/\\')
-        relation = None
-        if question.startswith('[{'):
-            char_num = question.index(']') + 1
-            relation = question[:char_num][2:-2]
-            question = question[char_num:]
-        return_list.append(Question(question, answers, relation))
-
-    return return_list
+    if len(file_content) > max_file_size:
+        return 'Файл больше %s КБ' % (max_file_size // 1024)
+    content_hash = get_content_hash(file_content)
+    if db_handler.is_quiz_upload_known(content_hash):
+        return 'Этот файл уже загружен'
+
+    quizzes = []
+    errors = []
+    try:
+        quiz_files = get_quiz_files(file_name, file_content)
+    except ValueError as exc:
+        return '%s: %s' % (file_name, exc)
+    for source, source_content in quiz_files:
+        source_quizzes, source_errors = parse_quizzes(source, source_content)
+        quizzes.extend(source_quizzes)
+        errors.extend(source_errors)
+
+    names = [quiz.name for quiz in quizzes]
+    for name in sorted({name for name in names if names.count(name) > 1}):
+        errors.append(f'Опрос "{name}" встречается в файле несколько раз')
+    for name in sorted(db_handler.get_existing_quiz_names(names)):
+        errors.append(f'Опрос "{name}" уже есть')
+    if errors:
+        report = ['Опросы не добавлены, исправьте ошибки:'] + errors[:max_report_errors]
+        if len(errors) > max_report_errors:
+            report.append(f'... и ещё {len(errors) - max_report_errors}')
+        return '\n'.join(report)
+    if not quizzes:
+        return 'В файле %s нет опросов' % file_name
+
+    archive_raw_file(content_hash, file_name, file_content)
+    quiz_ids = db_handler.add_new_quizzes(quizzes, tg_id, content_hash, file_name)
+    if quiz_ids is None:
+        return 'Не получилось добавить опросы из файла %s' % file_name
+    return '\n'.join(
+        'Успешно добавлен опрос "%s" с id "%s", вопросов: %s' % (
+            quiz.name, quiz_id, len(quiz.questions)
+        ) for quiz, quiz_id in zip(quizzes, quiz_ids)
+    )
@@ -0,0 +1,120 @@
+"""
+Compiles question relations of a quiz into a branching plan.
+
+Relation patterns (several conditions are joined by ' & ', all of them should be true):
+    2 -> Yes            answer to question 2 is "Yes"
+    2 -> Yes | Maybe    answer to question 2 is "Yes" or "Maybe" (or the answer "Yes | Maybe")
+    2 !-> No            answer to question 2 is not "No"
+
+Relations of the first format ('2 -> Rock & Roll', one answer which may contain ' & ') are still
+compiled, so quizzes stored before the operators were added keep their conditions.
+"""
+
+
+import typing
+
+
+class Condition(typing.NamedTuple):
+    """One compiled condition of question relation"""
+    quest_id: int
+    values: frozenset
+    negate: bool
+
+    def check(self, answers: dict) -> bool:
+        """Checks condition against user answers like {quest_id: answer_text}"""
+        return (answers.get(self.quest_id) in self.values) != self.negate
+
+    def describe(self) -> str:
+        """Returns human-readable condition"""
+        shown = [value for value in self.values if ' | ' not in value] or self.values
+        values = ' или '.join(f'"{value}"' for value in sorted(shown))
+        return f'на вопрос {self.quest_id} ответ {"не " if self.negate else ""}{values}'
+
+
+def compile_clause(clause: str, quest_id: int) -> Condition:
+    """Compiles one condition like '2 -> Yes | Maybe' or '2 !-> No' of question {quest_id}"""
+    negate = ' !-> ' in clause
+    check_quest_id, separator, values = clause.partition(' !-> ' if negate else ' -> ')
+    check_quest_id = check_quest_id.strip()
+    if not separator or not check_quest_id.isdigit() or not values.strip():
+        raise ValueError(f'Некорректное условие "{clause}" в вопросе {quest_id}')
+    if not 0 < int(check_quest_id) < quest_id:
+        raise ValueError(f'Вопрос {quest_id} может зависеть только от предыдущих вопросов')
+    # the whole value is kept too: an answer option of an old quiz may contain ' | '
+    return Condition(
+        int(check_quest_id),
+        frozenset(value.strip() for value in values.split(' | ')) | {values.strip()},
+        negate
+    )
+
+
+def compile_legacy_relation(relation: str, quest_id: int) -> tuple or None:
+    """Compiles relation of the first format 'N -> answer' or returns None if it isn't one"""
+    parts = relation.split(' -> ')
+    if len(parts) != 2 or not parts[0].strip().isdigit():
+        return None
+    if not 0 < int(parts[0]) < quest_id:
+        return None
+    return (Condition(int(parts[0]), frozenset([parts[1]]), False), )
+
+
+def compile_relation(relation: str or None, quest_id: int) -> tuple:
+    """Compiles relation string of question {quest_id} into a tuple of quiz_plan.Condition
+
+    :param relation: relation like '2 -> Yes & 3 !-> No' or None
+    :param quest_id: id of question with this relation
+    :return: tuple with conditions (empty for question without relation)
+    :raise ValueError: if relation doesn't match the patterns or refers not to a previous question
+    """
+    if not relation:
+        return tuple()
+    try:
+        return tuple(compile_clause(clause, quest_id) for clause in relation.split(' & '))
+    except ValueError:
+        conditions = compile_legacy_relation(relation, quest_id)
+        if conditions is None:
+            raise
+        return conditions
+
+
+class BranchPlan:
+    """Compiled relations of all quiz questions
+
+    Call this with a sequence of questions (objects with quest_id and quest_relation) ordered by
+    quest_id. A question with broken relation is asked unconditionally, the error is kept in
+    self.errors (db_handler logs them when the quiz is loaded).
+    """
+
+    def __init__(self, questions: list or tuple):
+        conditions = []
+        self.errors = []
+        for question in questions:
+            try:
+                conditions.append(compile_relation(question.quest_relation, question.quest_id))
+            except ValueError as exc:
+                conditions.append(tuple())
+                self.errors.append(str(exc))
+        self.conditions = tuple(conditions)
+
+    def get_conditions(self, quest_id: int) -> tuple:
+        """Returns conditions of question {quest_id}"""
+        if 1 <= quest_id <= len(self.conditions):
+            return self.conditions[quest_id - 1]
+        return tuple()
+
+    def resolve(self, quest_id: int, answers: dict) -> tuple:
+        """Finds the first question starting from {quest_id} which should be asked
+
+        Skipped questions get the answer 'None' in {answers}, so the next conditions can use it.
+
+        :param quest_id: id of question to start from
+        :param answers: user answers in this quiz like {quest_id: answer_text}
+        :return: (id of question to ask or None if the quiz is over, list with skipped ids)
+        """
+        skipped = []
+        for current_quest_id in range(quest_id, len(self.conditions) + 1):
+            if all(condition.check(answers) for condition in self.get_conditions(current_quest_id)):
+                return current_quest_id, skipped
+            skipped.append(current_quest_id)
+            answers[current_quest_id] = 'None'
+        return None, skipped
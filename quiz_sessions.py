@@ -0,0 +1,86 @@
+"""
+In-memory view of quiz sessions (table 'quiz_session').
+"""
+
+
+import collections
+import datetime
+import threading
+import typing
+
+
+class SessionState(typing.NamedTuple):
+    """Quiz session of one user, like db_handler.QuizSession"""
+    quiz_id: int
+    quest_id: int  # current question
+    mode: str  # 'answer' - passing the quiz, 'rewrite' - rewriting the answer to quest_id
+    started_at: datetime.datetime
+    last_activity: datetime.datetime
+
+    @property
+    def is_rewrite(self) -> bool:
+        return self.mode == 'rewrite'
+
+
+class ActiveSessions:
+    """Cache of quiz sessions by tg id
+
+    Keeps active sessions and known absence of a session (None) of {max_size} recently seen users,
+    max_size=0 disables the cache. A session whose last activity is older than {timeout} is
+    treated as absent, so the cache agrees with bulk expiration in the DB even if the expiration
+    was done by another process.
+
+    The cache is correct while updates of one user are handled by one process (see dispatcher and
+    cluster), all changes go through db_handler.
+    """
+
+    def __init__(self, timeout: datetime.timedelta, max_size: int = 100000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.sessions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def is_expired(self, state: SessionState) -> bool:
+        return state.last_activity < datetime.datetime.now() - self.timeout
+
+    def get(self, tg_id) -> tuple:
+        """Returns (is cached, SessionState or None)"""
+        with self.lock:
+            if tg_id not in self.sessions:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.sessions.move_to_end(tg_id)
+            state = self.sessions[tg_id]
+        if state is not None and self.is_expired(state):
+            return True, None
+        return True, state
+
+    def set(self, tg_id, state: SessionState or None):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.sessions[tg_id] = state
+            self.sessions.move_to_end(tg_id)
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+
+    def drop(self, tg_ids: list or tuple):
+        """Forgets sessions of {tg_ids} (they are loaded from the DB next time)"""
+        with self.lock:
+            for tg_id in tg_ids:
+                self.sessions.pop(tg_id, None)
+
+    def get_stats(self) -> dict:
+        """Returns hits, misses, hit rate, number of cached users and active sessions"""
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0,
+                'size': len(self.sessions),
+                'active': sum(1 for i in self.sessions.values() if i is not None)
+            }
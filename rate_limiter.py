@@ -0,0 +1,125 @@
+"""
+Per-user rate limiting (token bucket) without touching the database.
+"""
+
+
+import collections
+import threading
+import time
+
+
+class LocalBackend:
+    """In-memory storage of token buckets for one process
+
+    Keeps at most {max_keys} buckets, the least recently used bucket is evicted first (an evicted
+    user simply gets a full bucket again)
+    """
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self.buckets = collections.OrderedDict()  # key: (tokens, timestamp)
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, period: float) -> bool:
+        """Takes one token from bucket {key}, returns True if there was a token"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, stamp = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * capacity / period)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+                self.evicted += 1
+        return allowed
+
+    def __len__(self):
+        with self.lock:
+            return len(self.buckets)
+
+
+class RedisBackend:
+    """Token buckets in Redis, shared by several bot processes
+
+    Requires the "redis" package (pip install redis)
+    """
+
+    script = """
+        local capacity = tonumber(ARGV[1])
+        local period = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+        local tokens = tonumber(state[1]) or capacity
+        local stamp = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - stamp) * capacity / period)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(period * 1000))
+        return allowed
+    """
+
+    def __init__(self, url: str, prefix: str = 'quiz_bot:rate:'):
+        import redis  # optional dependency, only needed for the shared backend
+
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self.consume_script = self.client.register_script(self.script)
+
+    def consume(self, key: str, capacity: int, period: float) -> bool:
+        """Takes one token from bucket {key}, returns True if there was a token"""
+        # wall clock, because monotonic clocks of different processes are not comparable
+        return bool(self.consume_script(
+            keys=[self.prefix + key],
+            args=[capacity, period, time.time()]
+        ))
+
+
+class RateLimiter:
+    """Per-user limiter with separate limits for commands and content types
+
+    Call this with limits like {'default': (1, 2), 'document': (3, 60)} where value is
+    (messages, seconds): burst of {messages} and refill of {messages} per {seconds}.
+    Kinds without their own limit share the 'default' bucket.
+    """
+
+    def __init__(self, limits: dict, max_users: int = 10000, backend=None):
+        self.limits = limits
+        self.backend = backend if backend is not None else LocalBackend(max_users)
+        self.allowed = 0
+        self.limited = 0
+        self.lock = threading.Lock()  # hit() is called by several dispatcher threads
+
+    def hit(self, tg_id: int, kind: str = 'default') -> bool:
+        """Registers a message from user and returns True if it fits into the limit
+
+        :param tg_id: telegram user id
+        :param kind: command name or content type, like 'quiz', 'text' or 'callback'
+        :return: bool
+        """
+        if kind not in self.limits:
+            kind = 'default'
+        capacity, period = self.limits[kind]
+        allowed = self.backend.consume(f'{tg_id}:{kind}', capacity, period)
+        with self.lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return allowed
+
+    def get_stats(self) -> dict:
+        """Returns numbers of allowed and limited messages (and buckets of the local backend)"""
+        with self.lock:
+            stats = {'allowed': self.allowed, 'limited': self.limited}
+        if isinstance(self.backend, LocalBackend):
+            with self.backend.lock:
+                stats['buckets'] = len(self.backend.buckets)
+                stats['evicted'] = self.backend.evicted
+        return stats
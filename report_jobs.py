@@ -0,0 +1,78 @@
+"""
+Builds /quiz {id} reports outside of the polling thread.
+"""
+
+
+import concurrent.futures
+import threading
+
+import analytics
+import db_handler
+from bot_init import init_logger
+
+
+class ReportJobs:
+    """Report jobs: data is loaded in a thread, documents are built in a process pool
+
+    Call this with send_documents(chat_id, [(file name, bytes), ...]) and
+    send_message(chat_id, text). Requests for a quiz whose report is already being built don't
+    start a new job - they get the documents of the running one.
+    """
+
+    def __init__(self, send_documents, send_message, workers: int = 2):
+        self.send_documents = send_documents
+        self.send_message = send_message
+        self.workers = workers
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(workers, 'report_job')
+        self.process_pool = None
+        self.waiting_chats = dict()  # {quiz_id: [chat_id, ...]}
+        self.lock = threading.Lock()
+
+    def submit(self, quiz_id: int, chat_id: int) -> bool:
+        """Requests report of quiz {quiz_id} for chat {chat_id}
+
+        :return: True if a new job is started, False if the chat joined a running job
+        """
+        with self.lock:
+            if quiz_id in self.waiting_chats:
+                if chat_id not in self.waiting_chats[quiz_id]:  # a repeated request gets one report
+                    self.waiting_chats[quiz_id].append(chat_id)
+                return False
+            self.waiting_chats[quiz_id] = [chat_id]
+            if self.process_pool is None:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.thread_pool.submit(self.run, quiz_id)
+        return True
+
+    def run(self, quiz_id: int):
+        documents = None
+        try:
+            questions_info = db_handler.get_list_of_questions_in_quiz(quiz_id)
+            documents = self.process_pool.submit(
+                analytics.build_report_documents,
+                quiz_id,
+                db_handler.get_quiz_answer_rows(quiz_id),
+                db_handler.get_quiz_answer_counts(quiz_id),
+                [i.quest_text for i in questions_info]
+            ).result()
+        except Exception as exc:
+            init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+        with self.lock:
+            chats_id = self.waiting_chats.pop(quiz_id)
+        for chat_id in chats_id:
+            try:
+                if documents is None:
+                    self.send_message(chat_id, 'Не получилось подготовить отчёт по опросу %s'
+                                      % quiz_id)
+                else:
+                    self.send_documents(chat_id, documents)
+            except Exception as exc:
+                init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+
+    def get_stats(self) -> dict:
+        """Returns number of running jobs and waiting chats"""
+        with self.lock:
+            return {
+                'jobs': len(self.waiting_chats),
+                'waiting_chats': sum(len(i) for i in self.waiting_chats.values())
+            }
@@ -0,0 +1,103 @@
+"""
+Timer scheduler: one thread sleeps until the nearest deadline.
+"""
+
+
+import datetime
+import heapq
+import itertools
+import threading
+
+from bot_init import init_logger
+
+
+class Scheduler:
+    """Runs jobs at their deadlines
+
+    Deadlines are kept in a min-heap, the thread sleeps until the nearest one and is woken up when
+    an earlier job is scheduled. Each job has a key: scheduling with the same key replaces the job,
+    cancel(key) removes it. A periodic job is scheduled again only if its key still has the same
+    generation, so cancel() and schedule() win even if they are called while the job is running.
+    """
+
+    def __init__(self):
+        self.heap = []  # (deadline, sequence number, key)
+        self.jobs = dict()  # {key: (deadline, sequence number, func, args)}
+        self.generations = dict()  # {key: generation} of periodic jobs
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def schedule(self, deadline: datetime.datetime, key, func, *args):
+        """Runs func(*args) at {deadline} (naive local time, like in the DB)"""
+        with self.condition:
+            self.generations.pop(key, None)  # a periodic job with this key isn't repeated
+            self.push(deadline, key, func, args)
+
+    def schedule_every(self, interval: datetime.timedelta, key, func, *args):
+        """Runs func(*args) every {interval}, the first run is after {interval}"""
+        generation = next(self.sequence)
+
+        def periodic_job():
+            with self.condition:
+                # not repeated if it was cancelled or replaced after run() took it from the heap
+                if self.generations.get(key) == generation:
+                    self.push(datetime.datetime.now() + interval, key, periodic_job, ())
+            func(*args)
+
+        with self.condition:
+            self.generations[key] = generation
+            self.push(datetime.datetime.now() + interval, key, periodic_job, ())
+
+    def push(self, deadline: datetime.datetime, key, func, args: tuple):
+        sequence = next(self.sequence)
+        self.jobs[key] = (deadline, sequence, func, args)
+        heapq.heappush(self.heap, (deadline, sequence, key))
+        self.condition.notify()
+
+    def cancel(self, key):
+        """Removes job {key} if it's scheduled (a running periodic job isn't scheduled again)"""
+        with self.condition:
+            self.jobs.pop(key, None)
+            self.generations.pop(key, None)
+
+    def cancel_all(self, kind):
+        """Removes all jobs with keys like ({kind}, ...)"""
+        with self.condition:
+            keys = set(self.jobs) | set(self.generations)
+            for key in [i for i in keys if isinstance(i, tuple) and i[0] == kind]:
+                self.jobs.pop(key, None)
+                self.generations.pop(key, None)
+
+    def is_actual(self, heap_item) -> bool:
+        job = self.jobs.get(heap_item[2])
+        return job is not None and job[1] == heap_item[1]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # replaced and cancelled jobs are removed from the heap lazily
+                    while self.heap and not self.is_actual(self.heap[0]):
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = (self.heap[0][0] - datetime.datetime.now()).total_seconds()
+                    if delay <= 0:
+                        key = heapq.heappop(self.heap)[2]
+                        _, _, func, args = self.jobs.pop(key)
+                        break
+                    self.condition.wait(delay)
+            try:
+                func(*args)
+            except Exception as exc:
+                init_logger.error('Exception in scheduled job %s: %s\n%s' % (key, type(exc), exc))
+
+    def __len__(self):
+        with self.condition:
+            return len(self.jobs)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+
+# the bot modules are plain top-level modules of the repository root
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+if not os.path.exists(os.path.join(root, 'vars.env')):
+    # db_handler reads vars.env at import (and asks for it in the console), the tests don't
+    # connect to the database, so placeholders are enough
+    import env_vars
+
+    env_vars.load_vars = lambda: None
+    for name, value in (('db_username', 'bot'), ('db_password', 'bot'), ('db_host', 'localhost'),
+                        ('db_port', '5432'), ('db_name', 'bot'), ('echo_mode', 'False'),
+                        ('is_looped', 'False')):
+        os.environ.setdefault(name, value)
@@ -0,0 +1,74 @@
+import threading
+import time
+import types
+
+import dispatcher
+
+
+def get_update(update_id: int, user_id: int):
+    """Update with a message like telebot.types.Update"""
+    user = types.SimpleNamespace(id=user_id)
+    return types.SimpleNamespace(
+        update_id=update_id,
+        message=types.SimpleNamespace(from_user=user)
+    )
+
+
+def test_user_id_of_update():
+    assert dispatcher.get_update_user_id(get_update(1, 42)) == 42
+    assert dispatcher.get_update_user_id(types.SimpleNamespace(update_id=7)) == 7
+    assert dispatcher.get_update_json_user_id({'update_id': 1, 'callback_query': {
+        'from': {'id': 42}
+    }}) == 42
+
+
+def test_updates_of_one_user_are_handled_in_order():
+    handled = []
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def process_updates(updates: list):
+        user_id = updates[0].message.from_user.id
+        with lock:
+            if user_id in running:
+                overlaps.append(user_id)
+            running.add(user_id)
+        time.sleep(0.001)
+        with lock:
+            running.discard(user_id)
+            handled.append((user_id, updates[0].update_id))
+
+    dispatched = []
+    update_dispatcher = dispatcher.UpdateDispatcher(
+        process_updates,
+        shards=4,
+        on_dispatched=lambda update: dispatched.append(update.update_id)
+    )
+    update_dispatcher.start()
+    updates = [get_update(update_id, update_id % 7) for update_id in range(1, 141)]
+    update_dispatcher.dispatch(updates)
+    deadline = time.monotonic() + 10
+    while len(handled) < len(updates) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert dispatched == list(range(1, 141))
+    assert overlaps == []
+    for user_id in range(7):
+        assert [i for j, i in handled if j == user_id] == \
+            [update.update_id for update in updates if update.message.from_user.id == user_id]
+    assert sum(stats['processed'] for stats in update_dispatcher.get_stats()) == 140
+
+
+def test_dispatch_waits_while_shard_queue_is_full():
+    update_dispatcher = dispatcher.UpdateDispatcher(lambda updates: None, 1, 2)
+    finished = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (update_dispatcher.dispatch([get_update(i, 1) for i in range(3)]),
+                        finished.set()),
+        daemon=True
+    )
+    thread.start()
+    assert not finished.wait(0.2)
+    assert update_dispatcher.get_stats()[0]['depth'] == 2
+    update_dispatcher.start()
+    assert finished.wait(5)
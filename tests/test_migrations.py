@@ -0,0 +1,84 @@
+import sqlalchemy
+from sqlalchemy import event
+
+import db_handler
+import migrations
+
+
+class FakeConnection:
+    """Answers the pg_index query with {is_valid} and records the other statements"""
+
+    def __init__(self, is_valid: bool or None):
+        self.is_valid = is_valid
+        self.statements = []
+
+    def execute(self, statement, parameters=None):
+        if 'pg_index' in str(statement):
+            return self
+        self.statements.append(str(statement))
+
+    def scalar(self):
+        return self.is_valid
+
+
+def get_sqlite_engine():
+    """In-memory SQLite with the advisory lock functions which upgrade() calls"""
+    engine = sqlalchemy.create_engine(
+        'sqlite://',
+        poolclass=sqlalchemy.pool.StaticPool,
+        connect_args={'check_same_thread': False}
+    )
+
+    @event.listens_for(engine, 'connect')
+    def add_lock_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('pg_try_advisory_lock', 1, lambda lock_id: True)
+        dbapi_connection.create_function('pg_advisory_unlock', 1, lambda lock_id: True)
+
+    return engine
+
+
+def test_versions_are_consecutive():
+    versions = [migration.version for migration in migrations.migrations]
+    assert versions == list(range(1, len(versions) + 1))
+
+
+def test_valid_index_is_kept():
+    connection = FakeConnection(True)
+    migrations.create_index_concurrently(connection, 'ix_test', 'ON test (id)')
+    assert connection.statements == []
+
+
+def test_invalid_index_is_built_again():
+    connection = FakeConnection(False)
+    migrations.create_index_concurrently(connection, 'ix_test', 'ON test (id)')
+    assert connection.statements == [
+        'DROP INDEX CONCURRENTLY ix_test',
+        'CREATE INDEX CONCURRENTLY ix_test ON test (id)'
+    ]
+
+
+def test_missing_index_is_built():
+    connection = FakeConnection(None)
+    migrations.create_index_concurrently(connection, 'ix_test', 'ON test (id)')
+    assert connection.statements == ['CREATE INDEX CONCURRENTLY ix_test ON test (id)']
+
+
+def test_upgrade_applies_only_missing_migrations(monkeypatch):
+    applied = []
+    fake_migrations = tuple(
+        migrations.Migration(version, f'Step {version}', lambda c, v=version: applied.append(v))
+        for version in (1, 2, 3)
+    )
+    monkeypatch.setattr(db_handler, 'engine', get_sqlite_engine())
+    monkeypatch.setattr(migrations, 'migrations', fake_migrations[:2])
+    assert migrations.upgrade() == 2
+    monkeypatch.setattr(migrations, 'migrations', fake_migrations)
+    assert migrations.upgrade() == 3
+    assert migrations.upgrade() == 3
+    assert applied == [1, 2, 3]
+    with db_handler.engine.connect() as connection:
+        rows = connection.execute(sqlalchemy.select(
+            migrations.schema_version.c.version,
+            migrations.schema_version.c.description
+        ).order_by(migrations.schema_version.c.version)).all()
+    assert [tuple(row) for row in rows] == [(1, 'Step 1'), (2, 'Step 2'), (3, 'Step 3')]
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import broadcast
+import outbound
+
+
+class FakeBot:
+    """Records requests, errors[chat_id] is a list of error codes for the next requests"""
+
+    def __init__(self, errors: dict = None):
+        self.errors = errors or dict()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, chat_id, payload):
+        with self.lock:
+            codes = self.errors.get(chat_id)
+            if codes:
+                code = codes.pop(0)
+                raise ApiTelegramException('sendMessage', None, {
+                    'error_code': code,
+                    'description': 'test',
+                    'parameters': {'retry_after': 0}
+                })
+            self.requests.append((time.monotonic(), chat_id, payload))
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        self.request(chat_id, text)
+
+    def send_document(self, chat_id, content, visible_file_name=None):
+        self.request(chat_id, visible_file_name)
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None):
+        self.request(chat_id, message_id)
+
+
+def get_dispatcher(bot, **kwargs) -> outbound.OutboundDispatcher:
+    return outbound.OutboundDispatcher(bot, rate=broadcast.AdaptiveRate(1000, 1000), **kwargs)
+
+
+@pytest.fixture
+def results():
+    """on_done callback and the errors it got"""
+    errors = []
+    done = threading.Event()
+
+    def on_done(error):
+        errors.append(error)
+        done.set()
+
+    return on_done, errors, done
+
+
+def test_messages_of_a_chat_keep_their_order():
+    bot = FakeBot()
+    dispatcher = get_dispatcher(bot, workers=2, chat_burst=100, chat_rate=100)
+    dispatcher.start()
+    for number in range(20):
+        dispatcher.put(1, f'first {number}')
+        dispatcher.put(2, f'second {number}')
+    dispatcher.put_document(1, 'report.xlsx', b'data')
+    dispatcher.stop()
+    assert [payload for _, chat_id, payload in bot.requests if chat_id == 1] == \
+        [f'first {number}' for number in range(20)] + ['report.xlsx']
+    assert [payload for _, chat_id, payload in bot.requests if chat_id == 2] == \
+        [f'second {number}' for number in range(20)]
+    assert dispatcher.get_stats()['sent'] == 41
+
+
+def test_chat_is_paced_after_burst():
+    bot = FakeBot()
+    dispatcher = get_dispatcher(bot, workers=1, chat_burst=2, chat_rate=20)
+    dispatcher.start()
+    for number in range(4):
+        dispatcher.put(1, str(number))
+    dispatcher.stop()
+    times = [sent_at for sent_at, _, _ in bot.requests]
+    assert len(times) == 4
+    assert times[1] - times[0] < 0.04
+    assert times[3] - times[1] >= 2 / 20 - 0.01
+
+
+def test_too_many_requests_is_retried(results):
+    on_done, errors, done = results
+    bot = FakeBot({1: [429, 502]})
+    dispatcher = get_dispatcher(bot, workers=1)
+    dispatcher.start()
+    dispatcher.put(1, 'text', on_done=on_done)
+    assert done.wait(10)
+    dispatcher.stop()
+    assert errors == [None]
+    assert [payload for _, _, payload in bot.requests] == ['text']
+    assert dispatcher.get_stats()['retried'] == 2
+
+
+def test_dropped_message_is_reported(results):
+    on_done, errors, done = results
+    bot = FakeBot({1: [403]})
+    dispatcher = get_dispatcher(bot, workers=1)
+    dispatcher.start()
+    dispatcher.put(1, 'blocked', on_done=on_done)
+    dispatcher.put(1, 'next')
+    assert done.wait(10)
+    dispatcher.stop()
+    assert isinstance(errors[0], ApiTelegramException)
+    assert [payload for _, _, payload in bot.requests] == ['next']
+    assert dispatcher.get_stats()['failed'] == 1
+
+
+def test_on_done_may_queue_to_its_own_full_shard(results):
+    on_done, errors, done = results
+    bot = FakeBot()
+    dispatcher = get_dispatcher(bot, workers=1, queue_size=1)
+    dispatcher.start()
+    dispatcher.put(1, 'text', on_done=lambda error: dispatcher.put(2, 'report', on_done=on_done))
+    assert done.wait(10)
+    dispatcher.stop()
+    assert [payload for _, _, payload in bot.requests] == ['text', 'report']
+
+
+def test_requests_are_made_directly_before_start(results):
+    on_done, errors, _ = results
+    bot = FakeBot({2: [400]})
+    dispatcher = get_dispatcher(bot)
+    dispatcher.put(1, 'text', on_done=on_done)
+    dispatcher.put(2, 'broken', on_done=on_done)
+    dispatcher.put_markup_edit(1, 10)
+    assert errors[0] is None and isinstance(errors[1], ApiTelegramException)
+    assert [payload for _, _, payload in bot.requests] == ['text', 10]
@@ -0,0 +1,60 @@
+import io
+import zipfile
+
+import pytest
+
+import quiz_handler
+
+
+def make_quiz(name: str, relation: str = '1 -> Да') -> str:
+    return '\n'.join([
+        name,
+        'Заголовок',
+        '1. Вы здесь?//\\\\Да/\\Нет',
+        '[{%s}]2. Почему?//\\\\Так/\\Иначе' % relation,
+        'Спасибо'
+    ])
+
+
+def test_quizzes_of_one_file_are_split_by_separator():
+    content = '\n\n'.join([make_quiz('Первый'), '===', make_quiz('Второй'), ''])
+    quizzes, errors = quiz_handler.parse_quizzes('quiz.txt', content.encode('utf-8'))
+    assert errors == []
+    assert [quiz.name for quiz in quizzes] == ['Первый', 'Второй']
+    questions = quizzes[1].questions
+    assert [question.line_number for question in questions] == [11, 12]
+    assert questions[1].relation == '1 -> Да'
+    assert questions[1].answers == ['Так', 'Иначе']
+
+
+def test_errors_have_source_and_line_numbers():
+    content = make_quiz('Опрос', '1 => Да').replace('2. Почему?', '3. Почему?')
+    quizzes, errors = quiz_handler.parse_quizzes('quiz.txt', content.encode('utf-8'))
+    assert len(quizzes) == 1
+    assert len(errors) == 2
+    assert all(error.startswith('quiz.txt, опрос 1 "Опрос": строка 4: ') for error in errors)
+
+
+def test_short_quiz_and_broken_encoding_are_reported():
+    content = 'Опрос\nЗаголовок\n'.encode('utf-8') + b'\xff'
+    quizzes, errors = quiz_handler.parse_quizzes('quiz.txt', content)
+    assert quizzes == []
+    assert errors[0] == 'quiz.txt, строка 3: текст не в кодировке UTF-8'
+    assert errors[1].startswith('quiz.txt, опрос 1: строка 1: ')
+
+
+def test_question_needs_one_separator():
+    with pytest.raises(ValueError):
+        quiz_handler.parse_question(7, '1. Вопрос без ответов')
+
+
+def test_zip_gives_its_txt_files_in_order():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        zip_file.writestr('b.txt', 'второй')
+        zip_file.writestr('a.txt', 'первый')
+        zip_file.writestr('readme.md', 'не опрос')
+    quiz_files = quiz_handler.get_quiz_files('quizzes.ZIP', archive.getvalue())
+    assert quiz_files == [('a.txt', 'первый'.encode('utf-8')), ('b.txt', 'второй'.encode('utf-8'))]
+    with pytest.raises(ValueError):
+        quiz_handler.get_quiz_files('quizzes.zip', b'not a zip')
@@ -0,0 +1,51 @@
+import typing
+
+import pytest
+
+import quiz_plan
+
+
+class Question(typing.NamedTuple):
+    quest_id: int
+    quest_relation: str or None
+
+
+def test_conditions_are_joined_with_and():
+    conditions = quiz_plan.compile_relation('1 -> Yes | Maybe & 2 !-> No', 3)
+    assert all(condition.check({1: 'Maybe', 2: 'Yes'}) for condition in conditions)
+    assert not all(condition.check({1: 'No', 2: 'Yes'}) for condition in conditions)
+    assert not all(condition.check({1: 'Yes', 2: 'No'}) for condition in conditions)
+
+
+def test_legacy_relation_with_operators_in_answer():
+    conditions = quiz_plan.compile_relation('1 -> Rock & Roll', 2)
+    assert len(conditions) == 1
+    assert conditions[0].check({1: 'Rock & Roll'})
+    assert not conditions[0].check({1: 'Rock'})
+
+
+def test_legacy_answer_with_pipe_is_still_matched():
+    (condition, ) = quiz_plan.compile_relation('1 -> Rock | Roll', 2)
+    assert condition.check({1: 'Rock | Roll'})
+    assert condition.check({1: 'Roll'})
+    assert condition.describe() == 'на вопрос 1 ответ "Rock" или "Roll"'
+
+
+@pytest.mark.parametrize('relation', ['1 => Yes', 'x -> Yes', '2 -> Yes', '1 -> Yes & 3 -> No'])
+def test_broken_relations_are_rejected(relation):
+    with pytest.raises(ValueError):
+        quiz_plan.compile_relation(relation, 2)
+
+
+def test_plan_skips_questions_and_keeps_errors():
+    plan = quiz_plan.BranchPlan([
+        Question(1, None),
+        Question(2, '1 -> Yes'),
+        Question(3, '2 !-> None'),
+        Question(4, '5 -> Yes')
+    ])
+    answers = {1: 'No'}
+    assert plan.resolve(2, answers) == (4, [2, 3])
+    assert answers == {1: 'No', 2: 'None', 3: 'None'}
+    assert plan.get_conditions(4) == tuple()
+    assert len(plan.errors) == 1
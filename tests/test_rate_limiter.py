@@ -0,0 +1,54 @@
+import threading
+import time
+
+import rate_limiter
+
+
+def test_burst_and_refill():
+    limiter = rate_limiter.RateLimiter({'default': (2, 0.2)})
+    assert [limiter.hit(1) for _ in range(3)] == [True, True, False]
+    assert limiter.hit(2)  # every user has own bucket
+    time.sleep(0.12)
+    assert limiter.hit(1)
+    assert not limiter.hit(1)
+    assert limiter.get_stats()['allowed'] == 4
+    assert limiter.get_stats()['limited'] == 2
+
+
+def test_kinds_without_limit_share_default_bucket():
+    limiter = rate_limiter.RateLimiter({'default': (1, 60), 'document': (1, 60)})
+    assert limiter.hit(1, 'text')
+    assert not limiter.hit(1, 'callback')
+    assert limiter.hit(1, 'document')
+    assert not limiter.hit(1, 'document')
+
+
+def test_least_recently_used_bucket_is_evicted():
+    limiter = rate_limiter.RateLimiter({'default': (1, 60)}, max_users=2)
+    for tg_id in (1, 2):
+        assert limiter.hit(tg_id)
+    assert not limiter.hit(1)  # user 1 is used again, so user 2 is evicted
+    assert limiter.hit(3)
+    assert limiter.hit(2)  # evicted user gets a full bucket
+    stats = limiter.get_stats()
+    assert stats['buckets'] == 2
+    assert stats['evicted'] == 2
+
+
+def test_counters_are_exact_with_threads():
+    limiter = rate_limiter.RateLimiter({'default': (5, 3600)})
+    barrier = threading.Barrier(8)
+
+    def hit_many(tg_id: int):
+        barrier.wait()
+        for _ in range(2000):
+            limiter.hit(tg_id % 4)
+
+    threads = [threading.Thread(target=hit_many, args=(i, )) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = limiter.get_stats()
+    assert stats['allowed'] == 4 * 5
+    assert stats['allowed'] + stats['limited'] == 8 * 2000
@@ -0,0 +1,82 @@
+import datetime
+import threading
+import time
+
+import scheduler
+
+
+def after(seconds: float) -> datetime.datetime:
+    return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_jobs_run_by_deadline_and_replace_each_other():
+    timer_scheduler = scheduler.Scheduler()
+    timer_scheduler.start()
+    runs = []
+    timer_scheduler.schedule(after(0.2), 'late', runs.append, 'late')
+    timer_scheduler.schedule(after(0.1), 'early', runs.append, 'early')
+    timer_scheduler.schedule(after(0.05), ('unban', 1), runs.append, 'replaced')
+    timer_scheduler.schedule(after(0.15), ('unban', 1), runs.append, 'unban')
+    timer_scheduler.schedule(after(0.05), ('unban', 2), runs.append, 'cancelled')
+    timer_scheduler.cancel_all('unban')
+    timer_scheduler.schedule(after(0.05), ('unban', 3), runs.append, 'unban 3')
+    timer_scheduler.cancel(('unban', 3))
+    assert wait_for(lambda: len(runs) == 2)
+    time.sleep(0.1)
+    assert runs == ['early', 'late']
+    assert len(timer_scheduler) == 0
+
+
+def test_periodic_job_cancelled_while_running_is_not_repeated():
+    timer_scheduler = scheduler.Scheduler()
+    timer_scheduler.start()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def job():
+        runs.append(time.monotonic())
+        started.set()
+        release.wait(5)
+
+    timer_scheduler.schedule_every(datetime.timedelta(seconds=0.05), 'job', job)
+    assert started.wait(5)
+    timer_scheduler.cancel('job')
+    release.set()
+    time.sleep(0.2)
+    assert len(runs) == 1
+    assert len(timer_scheduler) == 0
+
+
+def test_periodic_job_is_repeated_until_replaced():
+    timer_scheduler = scheduler.Scheduler()
+    timer_scheduler.start()
+    runs = []
+    timer_scheduler.schedule_every(datetime.timedelta(seconds=0.02), 'job', runs.append, 'old')
+    assert wait_for(lambda: len(runs) >= 3)
+    timer_scheduler.schedule(after(0.02), 'job', runs.append, 'once')
+    assert wait_for(lambda: 'once' in runs)
+    time.sleep(0.1)
+    assert runs[-1] == 'once'
+    assert len(timer_scheduler) == 0
+
+
+def test_periodic_job_cancelled_after_it_is_taken_is_not_repeated():
+    timer_scheduler = scheduler.Scheduler()  # not started: the test takes the job like run() does
+    runs = []
+    timer_scheduler.schedule_every(datetime.timedelta(seconds=10), 'job', runs.append, 'run')
+    with timer_scheduler.condition:
+        _, _, periodic_job, args = timer_scheduler.jobs.pop('job')
+    timer_scheduler.cancel('job')
+    periodic_job(*args)
+    assert runs == ['run']
+    assert len(timer_scheduler) == 0
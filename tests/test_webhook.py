@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+import telebot
+
+import dispatcher
+import webhook
+
+
+secret = 'test-secret'
+
+
+def get_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'},
+            'text': str(update_id)
+        }
+    }
+
+
+class Bot:
+    """Webhook server and dispatcher wired like bot_body does it"""
+
+    def __init__(self, shard_queue_size: int = 100, ingress_size: int = 100):
+        self.handled = []
+        self.lock = threading.Lock()
+        self.dispatcher = dispatcher.UpdateDispatcher(self.handle, 2, shard_queue_size)
+        self.server = webhook.WebhookServer(
+            self.process_update_json,
+            secret,
+            '127.0.0.1',
+            0,
+            '/bot',
+            ingress_size
+        )
+        self.url = 'http://127.0.0.1:%s/bot' % self.server.http_server.server_address[1]
+
+    def process_update_json(self, update_json: dict):
+        self.dispatcher.dispatch([telebot.types.Update.de_json(update_json)])
+
+    def handle(self, updates: list):
+        with self.lock:
+            self.handled.extend((i.message.from_user.id, i.update_id) for i in updates)
+
+    def wait_handled(self, count: int, timeout: float = 5) -> list:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self.handled) >= count:
+                    return list(self.handled)
+            time.sleep(0.01)
+        return list(self.handled)
+
+
+@pytest.fixture
+def bot():
+    bots = []
+
+    def start(**kwargs) -> Bot:
+        bots.append(Bot(**kwargs))
+        bots[-1].server.start()
+        return bots[-1]
+
+    yield start
+    for started_bot in bots:
+        started_bot.server.stop()
+
+
+def test_update_with_secret_is_handled(bot):
+    started_bot = bot()
+    started_bot.dispatcher.start()
+    assert webhook.post_update(started_bot.url, get_update(1, 10), secret) == 200
+    assert started_bot.wait_handled(1) == [(10, 1)]
+
+
+def test_wrong_secret_and_path_are_rejected(bot):
+    started_bot = bot()
+    started_bot.dispatcher.start()
+    assert webhook.post_update(started_bot.url, get_update(1, 10), 'wrong') == 403
+    assert webhook.post_update(started_bot.url, get_update(2, 10), '') == 403
+    assert webhook.post_update(started_bot.url + '/other', get_update(3, 10), secret) == 404
+    time.sleep(0.1)
+    assert started_bot.handled == []
+
+
+def test_full_shard_queue_answers_503(bot):
+    started_bot = bot(shard_queue_size=1, ingress_size=1)
+    statuses = [
+        webhook.post_update(started_bot.url, get_update(update_id, 10), secret)
+        for update_id in range(1, 11)
+    ]
+    assert 503 in statuses
+    assert started_bot.server.get_stats()['rejected'] == statuses.count(503)
+    # updates which got 200 are handled in order once the workers run
+    started_bot.dispatcher.start()
+    accepted = [update_id for update_id, status in enumerate(statuses, 1) if status == 200]
+    assert started_bot.wait_handled(len(accepted)) == [(10, update_id) for update_id in accepted]
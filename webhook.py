@@ -0,0 +1,121 @@
+"""
+Webhook ingestion: embedded HTTP server which receives updates from Telegram.
+"""
+
+
+import hmac
+import http.server
+import json
+import queue
+import threading
+import urllib.error
+import urllib.request
+
+from bot_init import init_logger
+
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Checks the secret token, parses the update and puts it into the ingress queue"""
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.send_status(404)
+            return
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), webhook.secret.encode()):
+            self.send_status(403)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > webhook.max_body_size:
+            self.send_status(413)
+            return
+        try:
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_status(400)
+            return
+        try:
+            webhook.ingress.put_nowait(update)
+        except queue.Full:
+            # Telegram will deliver it again later
+            with webhook.lock:
+                webhook.rejected += 1
+            self.send_status(503)
+            return
+        self.send_status(200)
+
+    def send_status(self, code: int):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        init_logger.debug('Webhook: ' + format % args)
+
+
+class WebhookServer:
+    """HTTP server for Telegram webhook
+
+    Call this with process_update(update_dict) - it's called by {workers} threads for each
+    update from the bounded ingress queue. The HTTP handler only validates and queues updates, so
+    Telegram gets the answer at once.
+    """
+
+    def __init__(self, process_update, secret: str, host: str = '0.0.0.0', port: int = 8080,
+                 path: str = '/', queue_size: int = 1000, workers: int = 1,
+                 max_body_size: int = 1024 * 1024):
+        self.process_update = process_update
+        self.secret = secret
+        self.path = path
+        self.ingress = queue.Queue(queue_size)
+        self.workers = workers
+        self.max_body_size = max_body_size
+        self.rejected = 0
+        self.lock = threading.Lock()  # requests are handled by several threads
+        self.http_server = http.server.ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.webhook = self
+
+    def start(self):
+        """Starts HTTP server and workers in separate threads"""
+        threading.Thread(target=self.http_server.serve_forever, name='webhook', daemon=True).start()
+        for index in range(self.workers):
+            threading.Thread(target=self.work, name=f'webhook_worker_{index}', daemon=True).start()
+        init_logger.info('Webhook server is listening on %s:%s'
+                         % self.http_server.server_address[:2])
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def work(self):
+        while True:
+            update = self.ingress.get()
+            try:
+                self.process_update(update)
+            except Exception as exc:
+                init_logger.error('Exception: %s\n%s' % (type(exc), exc))
+
+    def get_stats(self) -> dict:
+        """Returns ingress queue size and number of rejected updates"""
+        with self.lock:
+            return {'queued': self.ingress.qsize(), 'rejected': self.rejected}
+
+
+def post_update(url: str, update: dict, secret: str, timeout: float = 5) -> int:
+    """Posts update like Telegram does (for checking the webhook locally), returns HTTP status"""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode('utf-8'),
+        headers={
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': secret
+        },
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as exc:
+        return exc.code